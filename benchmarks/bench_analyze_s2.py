@@ -0,0 +1,218 @@
+'''
+Benchmark of pdf_processor/analyze_pdf_s2_data.py against the per-row script it replaces, on synthetic data.
+
+The synthetic data mirrors darwin/: test.qrel.cid, link-recorder-final-1, classification_meta.jsonl and empty
+query_papers/candidate_papers pdfs, with --scale times the pairs, papers, links and labels of the base size
+(655 query/candidate pairs, about the size of the current test set). Each stage is timed in its legacy form
+(iterrows, linear scans of classification_meta, boolean masks per query) and in its indexed form, and the
+results of both are compared. Legacy stages are skipped above --legacy_max_scale, and the legacy dense matrix
+stages above --max_matrix_cells; the sparse matrix and its .npz file are built at every scale.
+
+Usage:
+    python benchmarks/bench_analyze_s2.py --scale 1 10 100
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_processor'))
+import analyze_pdf_s2_data as analysis  # noqa: E402
+from citation_matrix import citation_matrix_paths, save_citation_matrix  # noqa: E402
+
+BASE = {'queries': 100, 'pairs': 655, 'candidates': 600, 'retrieved': 1500, 'links': 9000, 'labelled': 2000}
+
+
+def generate(directory, scale, seed=0, present=0.9):
+    '''Writes a synthetic darwin/ layout with scale times the base sizes.'''
+    rng = random.Random(seed)
+    sizes = {name: count * scale for name, count in BASE.items()}
+    query_ids = rng.sample(range(10_000_000, 20_000_000), sizes['queries'])
+    candidate_ids = rng.sample(range(20_000_000, 30_000_000), sizes['candidates'])
+    retrieved_ids = rng.sample(range(30_000_000, 40_000_000), sizes['retrieved'])
+
+    with open(os.path.join(directory, 'test.qrel.cid'), 'w') as f:
+        for _ in range(sizes['pairs']):
+            f.write(f'{rng.choice(query_ids)} {rng.choice(candidate_ids)} {int(rng.random() < 0.12)}\n')
+    with open(os.path.join(directory, 'link-recorder-final-1'), 'w') as f:
+        for i in range(sizes['links']):
+            # every candidate has at least one link, a few links are recorded twice
+            candidate = candidate_ids[i] if i < len(candidate_ids) else rng.choice(candidate_ids)
+            f.write(f'{candidate}\t{rng.choice(retrieved_ids)}\n')
+    with open(os.path.join(directory, 'classification_meta.jsonl'), 'w') as f:
+        for corpus_id in rng.sample(query_ids + candidate_ids + retrieved_ids, sizes['labelled']):
+            f.write(json.dumps({'corpus_id': corpus_id, 'labels': rng.sample(range(23), rng.randint(1, 3))}) + '\n')
+
+    for folder, ids in (('query_papers', query_ids), ('candidate_papers', candidate_ids)):
+        os.makedirs(os.path.join(directory, folder))
+        for corpus_id in ids:
+            if rng.random() < present:
+                open(os.path.join(directory, folder, f'{corpus_id}.pdf'), 'w').close()
+    return sizes
+
+
+def _append(frame, row):
+    # DataFrame._append is gone in pandas 3, concat of the one-row frame copies the same way
+    if hasattr(frame, '_append'):
+        return frame._append(row)
+    return pd.concat([frame, row.to_frame().T]) if len(frame) else row.to_frame().T
+
+
+def legacy_valid_rows(query_candidate_data, query_dir, candidate_dir):
+    valid_rows = pd.DataFrame()
+    for _, row in query_candidate_data.iterrows():
+        query_file = os.path.join(query_dir, str(row['query']) + '.pdf')
+        candidate_file = os.path.join(candidate_dir, str(row['candidate']) + '.pdf')
+        if os.path.isfile(query_file) and os.path.isfile(candidate_file):
+            valid_rows = _append(valid_rows, row)
+    valid_rows.reset_index(drop=True, inplace=True)
+    return valid_rows
+
+
+def legacy_query_statistics(valid_rows):
+    unique_query_papers = valid_rows['query'].unique()
+    query_paper_counts = valid_rows['query'].value_counts()
+    for query_paper in query_paper_counts[query_paper_counts > 1].index:
+        print(f'{query_paper=}, {valid_rows[valid_rows["query"] == query_paper]["bool"].sum()/len(valid_rows[valid_rows["query"] == query_paper]):.2%} ({valid_rows[valid_rows["query"] == query_paper]["bool"].sum()}) of {len(valid_rows[valid_rows["query"] == query_paper])} candidates are positive')
+    no_positive = []
+    for query_paper in unique_query_papers:
+        if valid_rows[valid_rows["query"] == query_paper]["bool"].sum() == 0:
+            no_positive.append(query_paper)
+    return unique_query_papers, query_paper_counts, no_positive
+
+
+def legacy_query_candidate_classifications(valid_rows, unique_query_papers, classification_meta):
+    found_classifications = []
+    for query_paper in unique_query_papers:
+        query_classification = [meta['labels'] for meta in classification_meta if meta['corpus_id'] == query_paper]
+        if len(query_classification) != 0:
+            related_candidates = valid_rows[valid_rows['query'] == query_paper]['candidate'].tolist()
+            for candidate_paper in related_candidates:
+                classification = [meta['labels'] for meta in classification_meta if meta['corpus_id'] == candidate_paper]
+                if len(classification) != 0:
+                    found_classifications.append((query_classification[0], classification[0]))
+    return found_classifications
+
+
+def legacy_citation_matrix(candidate_retrieved_data):
+    candidate_paper_ids = sorted(set(candidate_retrieved_data['candidate_paper'].tolist()))
+    retrieved_paper_ids = sorted(set(candidate_retrieved_data['retrieved_paper'].tolist()))
+    candidate_id_to_index = {paper_id: index for index, paper_id in enumerate(candidate_paper_ids)}
+    retrieved_id_to_index = {paper_id: index for index, paper_id in enumerate(retrieved_paper_ids)}
+    matrix = np.zeros((len(candidate_id_to_index), len(retrieved_id_to_index)))
+    for _, row in candidate_retrieved_data.iterrows():
+        matrix[candidate_id_to_index[row['candidate_paper']], retrieved_id_to_index[row['retrieved_paper']]] = 1
+    return matrix, candidate_paper_ids, retrieved_paper_ids
+
+
+def legacy_candidate_retrieved_classifications(matrix_df, candidate_paper_ids, classification_meta):
+    found_classification_candidate = []
+    for candidate_paper in candidate_paper_ids:
+        classification = [meta['labels'] for meta in classification_meta if meta['corpus_id'] == candidate_paper]
+        if len(classification) != 0:
+            retrieved_paper_for_candidate = matrix_df.loc[candidate_paper][matrix_df.loc[candidate_paper] == 1].index.tolist()
+            for retrieved_paper in retrieved_paper_for_candidate:
+                classification_retrieved = [meta['labels'] for meta in classification_meta if meta['corpus_id'] == retrieved_paper]
+                if len(classification_retrieved) != 0:
+                    found_classification_candidate.append((candidate_paper, classification))
+    return found_classification_candidate
+
+
+def timed(function, *args, **kwargs):
+    # the stages print per paper, only the time is of interest here
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run(scale, legacy, max_matrix_cells):
+    with tempfile.TemporaryDirectory() as directory:
+        sizes = generate(directory, scale)
+        candidate_retrieved_data, query_candidate_data, classification_meta = analysis.load_data(directory)
+        query_dir = os.path.join(directory, 'query_papers')
+        candidate_dir = os.path.join(directory, 'candidate_papers')
+        n_cells = (candidate_retrieved_data['candidate_paper'].nunique()
+                   * candidate_retrieved_data['retrieved_paper'].nunique())
+        dense = n_cells <= max_matrix_cells
+        stages = []
+
+        def stage(name, new, old):
+            new_result, new_time = timed(*new)
+            old_result, old_time = timed(*old) if legacy and old is not None else (None, None)
+            stages.append((name, old_time, new_time))
+            return new_result, old_result
+
+        valid_rows, legacy_rows = stage('valid rows', (analysis.find_valid_rows, query_candidate_data, query_dir, candidate_dir),
+                                          (legacy_valid_rows, query_candidate_data, query_dir, candidate_dir))
+        if legacy_rows is not None:
+            assert valid_rows.astype('int64').equals(legacy_rows.astype('int64')), 'valid rows differ'
+
+        labels, _ = stage('label table', (analysis.label_table, classification_meta), None)
+        statistics, legacy_statistics = stage('query statistics', (analysis.query_statistics, valid_rows),
+                                                (legacy_query_statistics, valid_rows))
+        if legacy_statistics is not None:
+            assert list(statistics[2]) == list(legacy_statistics[2]), 'query papers without positives differ'
+
+        found, legacy_found = stage('query/candidate labels',
+                                      (analysis.query_candidate_classifications, valid_rows, statistics[0], labels),
+                                      (legacy_query_candidate_classifications, valid_rows, statistics[0], classification_meta))
+        if legacy_found is not None:
+            assert found == legacy_found, 'query/candidate classifications differ'
+
+        legacy_dense = legacy and dense
+        matrix, legacy_matrix = stage('citation matrix', (analysis.citation_matrix, candidate_retrieved_data),
+                                      (legacy_citation_matrix, candidate_retrieved_data) if legacy_dense else None)
+        if legacy_matrix is not None:
+            assert np.array_equal(matrix[0].toarray(), legacy_matrix[0]) and list(matrix[1:]) == list(legacy_matrix[1:]), \
+                'matrices differ'
+
+        npz_path = os.path.join(directory, 'candidate_retrieved_citation_matrix.npz')
+        csv_path = os.path.join(directory, 'candidate_retrieved_citation_matrix.csv')
+        legacy_write = None
+        if legacy_matrix is not None:
+            matrix_df = pd.DataFrame(legacy_matrix[0], index=legacy_matrix[1], columns=legacy_matrix[2])
+            legacy_write = (matrix_df.to_csv, csv_path)
+        stage('matrix file', (save_citation_matrix, npz_path, *matrix), legacy_write)
+        file_sizes = {'npz + sidecars': sum(os.path.getsize(path) for path in citation_matrix_paths(npz_path))}
+        if legacy_write is not None:
+            file_sizes['dense csv'] = os.path.getsize(csv_path)
+
+        stage('retrieved statistics', (analysis.retrieved_statistics, matrix[0], matrix[1]), None)
+        found, legacy_found = stage('candidate/retrieved labels',
+                                    (analysis.candidate_retrieved_classifications, candidate_retrieved_data, labels),
+                                    (legacy_candidate_retrieved_classifications, matrix_df, legacy_matrix[1], classification_meta)
+                                    if legacy_matrix is not None else None)
+        if legacy_found is not None:
+            assert found == legacy_found, 'candidate/retrieved classifications differ'
+
+    print(f'scale {scale}x: {sizes["pairs"]} pairs, {sizes["links"]} links, {sizes["labelled"]} labels, '
+          f'{n_cells:.2e} matrix cells, ' + ', '.join(f'{name} {size / 1e6:.1f} MB' for name, size in file_sizes.items()))
+    for name, old_time, new_time in stages:
+        old = f'{old_time:9.3f}s' if old_time is not None else '        -'
+        speedup = f'{old_time / new_time:8.1f}x' if old_time is not None else ''
+        print(f'  {name:28s} legacy {old}  indexed {new_time:9.3f}s {speedup}')
+    total_new = sum(new_time for _, _, new_time in stages)
+    print(f'  {"total":28s} indexed {total_new:9.3f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the indexed analysis against the per-row script')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10, 100], help='Multiples of the base data size')
+    parser.add_argument('--legacy_max_scale', type=int, default=10, help='Largest scale the legacy stages are run at')
+    parser.add_argument('--max_matrix_cells', type=float, default=1e8, help='Largest dense citation matrix built')
+    args = parser.parse_args()
+    for scale in args.scale:
+        run(scale, scale <= args.legacy_max_scale, args.max_matrix_cells)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+'''
+Micro-benchmark of pdf_processor/chunking.py against the implementations it replaces.
+
+    legacy Chunker                  the notebooks' Chunker, re-slicing the remaining paper per window
+    legacy chunk_text_to_fit_tokens pandas_pdf_reader_vector_db, decoding every token window separately
+
+The input is a synthetic thesis of --chars characters, or the concatenated text of the --pdf files.
+Outputs of old and new implementations are compared before timing.
+
+Usage:
+    python benchmarks/bench_chunking.py --chars 2000000 --context_window 1000
+    python benchmarks/bench_chunking.py --pdf darwin/query_papers/1323414.pdf
+'''
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_processor'))
+from chunking import Chunker, TokenChunker, get_encoding  # noqa: E402
+
+
+class LegacyChunker:
+    def __init__(self, context_window=3000, max_windows=5):
+        self.context_window = context_window
+        self.max_windows = max_windows
+        self.window_overlap = 0.02
+
+    def __call__(self, paper):
+        snippet_idx = 0
+
+        while snippet_idx < self.max_windows and paper:
+            endpos = int(self.context_window * (1.0 + self.window_overlap))
+            snippet, paper = paper[:endpos], paper[endpos:]
+
+            next_newline_pos = snippet.rfind('\n')
+            if paper and next_newline_pos != -1 and next_newline_pos >= self.context_window // 2:
+                paper = snippet[next_newline_pos+1:] + paper
+                snippet = snippet[:next_newline_pos]
+
+            yield snippet_idx, snippet.strip()
+            snippet_idx += 1
+
+
+def legacy_chunk_text_to_fit_tokens(text, encoding_name='cl100k_base', max_tokens=8191):
+    encoding = get_encoding(encoding_name)
+    tokens = encoding.encode(text, disallowed_special=())
+    chunks = []
+    for i in range(0, len(tokens), max_tokens):
+        chunks.append(encoding.decode(tokens[i:i + max_tokens]))
+    return chunks
+
+
+def synthetic_thesis(n_chars, seed=0):
+    rng = random.Random(seed)
+    words = ['citation', 'graph', 'neural', 'retrieval', 'embedding', 'model', 'paper', 'layout', 'vector',
+             'token', 'dataset', 'method', 'the', 'of', 'and', 'a', 'in', 'we', 'show', 'that', '(2019)', 'et', 'al.']
+    lines = []
+    size = 0
+    while size < n_chars:
+        line = ' '.join(rng.choice(words) for _ in range(rng.randint(3, 18)))
+        lines.append(line)
+        size += len(line) + 1
+    return '\n'.join(lines)[:n_chars]
+
+
+def pdf_text(paths):
+    from PyPDF2 import PdfReader
+    text = ''
+    for path in paths:
+        for page in PdfReader(path).pages:
+            page_text = page.extract_text()
+            if page_text:
+                text += page_text + '\n'
+    return text
+
+
+def timed(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark character and token chunking')
+    parser.add_argument('--chars', type=int, default=2000000, help='Length of the synthetic thesis')
+    parser.add_argument('--pdf', nargs='*', default=None, help='PDF files to use as input instead')
+    parser.add_argument('--context_window', type=int, default=1000, help='Chunker context window')
+    parser.add_argument('--max_tokens', type=int, default=1000, help='Token window size')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per implementation, the best is reported')
+    parser.add_argument('--skip_tokens', action='store_true', help='Skip the token chunking benchmark')
+    args = parser.parse_args()
+
+    text = pdf_text(args.pdf) if args.pdf else synthetic_thesis(args.chars)
+    print(f'Input: {len(text):,} characters')
+
+    # every window of the paper, the regime where re-slicing the remainder goes quadratic
+    max_windows = len(text) // args.context_window + 2
+    legacy_time, legacy = timed(lambda: list(LegacyChunker(args.context_window, max_windows)(text)), args.repeat)
+    new_time, new = timed(lambda: list(Chunker(args.context_window, max_windows)(text)), args.repeat)
+    assert new == legacy, 'Chunker output differs from the legacy Chunker'
+    print(f'Chunker        {len(new):>7} chunks  legacy {legacy_time:8.3f}s  new {new_time:8.3f}s  '
+          f'speedup {legacy_time / new_time:6.1f}x')
+
+    if args.skip_tokens:
+        return
+    legacy_time, legacy = timed(lambda: legacy_chunk_text_to_fit_tokens(text, max_tokens=args.max_tokens), args.repeat)
+    new_time, new = timed(lambda: [chunk for _, chunk in TokenChunker(args.max_tokens)(text)], args.repeat)
+    # legacy windows decode a multi-byte character split between two windows as U+FFFD, the new ones
+    # cut before it, so the check is that windows line up and cover the text exactly
+    assert len(new) == len(legacy) and ''.join(new) == text, 'TokenChunker output differs'
+    print(f'TokenChunker   {len(new):>7} chunks  legacy {legacy_time:8.3f}s  new {new_time:8.3f}s  '
+          f'speedup {legacy_time / new_time:6.1f}x')
+
+
+if __name__ == '__main__':
+    main()
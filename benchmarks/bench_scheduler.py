@@ -0,0 +1,97 @@
+'''
+Benchmark of per-example evaluation against globally scheduled chunk-pair predictions, on a fake LM.
+
+    per-example  Evaluate(num_threads=8) semantics: 8 examples at a time, pairs predicted serially
+    scheduled    pdf_processor/prediction_scheduler.py: every pair of every example in one queue
+
+Both modes run the same program and must produce the same predictions.
+
+Usage:
+    python benchmarks/bench_scheduler.py --examples 200 --pairs 15 --latency 0.05 --workers 64
+'''
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_processor'))
+from prediction_scheduler import PredictionScheduler, evaluate_scheduled  # noqa: E402
+from fake_lm import FakeLM, FakePrediction  # noqa: E402
+
+
+class Example(dict):
+    def inputs(self):
+        return {'query_file': self['query_file'], 'candidate_file': self['candidate_file']}
+
+
+class FakeProgram:
+    '''Same shape as PredictCitationRetrieveAndResolve: stops at the first pair predicted to cite.'''
+
+    def __init__(self, lm, n_pairs, stop_early=True):
+        self.lm = lm
+        self.n_pairs = n_pairs
+        self.stop_on = (lambda output: output.answer == 'True') if stop_early else None
+
+    def pairs(self, query_file, candidate_file):
+        return [{'query_chunk': f'{query_file}:{i}', 'candidate_chunk': f'{candidate_file}:{i}'}
+                for i in range(self.n_pairs)]
+
+    def predict_pair(self, inputs):
+        return self.lm(**inputs)
+
+    def resolve(self, pairs, outputs):
+        predictions = [output.answer == 'True' for output in outputs]
+        return FakePrediction(predictions=predictions, resolved=any(predictions))
+
+    def __call__(self, query_file, candidate_file):
+        pairs = self.pairs(query_file, candidate_file)
+        outputs = []
+        for inputs in pairs:
+            outputs.append(self.predict_pair(inputs))
+            if self.stop_on is not None and self.stop_on(outputs[-1]):
+                break
+        return self.resolve(pairs, outputs)
+
+
+def metric(example, prediction):
+    return 1 if example['cites'] == prediction.resolved else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark per-example against globally scheduled predictions')
+    parser.add_argument('--examples', type=int, default=200, help='Number of (query, candidate) examples')
+    parser.add_argument('--pairs', type=int, default=15, help='Chunk pairs per example')
+    parser.add_argument('--latency', type=float, default=0.05, help='Fake LM latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Fake LM extra random latency in seconds')
+    parser.add_argument('--num_threads', type=int, default=8, help='Evaluate threads of the per-example mode')
+    parser.add_argument('--workers', type=int, default=64, help='Calls in flight of the scheduled mode')
+    parser.add_argument('--rpm', type=int, default=None, help='Requests per minute limit of the scheduled mode')
+    parser.add_argument('--no_stop', action='store_true', help='Predict every pair instead of stopping at the first hit')
+    args = parser.parse_args()
+
+    devset = [Example(query_file=f'q{i}', candidate_file=f'c{i}', cites=i % 2 == 0) for i in range(args.examples)]
+
+    lm = FakeLM(latency=args.latency, jitter=args.jitter)
+    program = FakeProgram(lm, args.pairs, stop_early=not args.no_stop)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.num_threads) as executor:
+        serial = list(executor.map(lambda example: program(**example.inputs()), devset))
+    serial_time = time.perf_counter() - start
+    print(f'per-example  {serial_time:7.2f}s  {lm.calls} calls  max in flight {lm.max_in_flight}')
+
+    lm = FakeLM(latency=args.latency, jitter=args.jitter)
+    program = FakeProgram(lm, args.pairs, stop_early=not args.no_stop)
+    scheduler = PredictionScheduler(workers=args.workers, requests_per_minute=args.rpm)
+    start = time.perf_counter()
+    score, results = evaluate_scheduled(program, devset, metric, scheduler)
+    scheduled_time = time.perf_counter() - start
+    print(f'scheduled    {scheduled_time:7.2f}s  {lm.calls} calls  max in flight {lm.max_in_flight}  '
+          f'speedup {serial_time / scheduled_time:.1f}x  score {score}')
+
+    assert [p['predictions'] for p in serial] == [prediction['predictions'] for _, prediction, _ in results], \
+        'scheduled predictions differ from per-example predictions'
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+'''
+Benchmark of pdf_processor/specter_svm.py against the cells of "cs224u specter svm.ipynb", on synthetic SPECTER data.
+
+The synthetic data has the notebook's shape at --scale 1: 768-dimensional text embeddings of query, candidate and
+retrieved papers, a link recorder with about 234 test-set -> retrieved links and a 655-pair qrel file. Cited
+retrieved papers and positive candidates share a shifted mean, so the SVM has something to learn.
+
+    load      np.loadtxt of the three text files  vs  load_embeddings from the .npy written on first load
+    pairs     list.index + np.hstack + list.append  vs  index pairs and one fancy-indexed float32 copy
+    train     GridSearchCV LinearSVC on float64  vs  the same on float32  vs  fit_streaming (SGD partial_fit)
+
+Legacy stages are skipped above --legacy_max_scale, the grid searches (minutes at --scale 1, mostly liblinear
+running into max_iter at C=100) above --grid_max_scale.
+
+Usage:
+    python benchmarks/bench_specter_svm.py --scale 1 10 100
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_processor'))
+import specter_svm  # noqa: E402
+
+BASE = {'queries': 300, 'candidates': 400, 'retrieved': 240, 'links': 234, 'qrel': 655}
+DIM = 768
+
+
+def generate(directory, scale, seed=0):
+    '''Writes qpaper/cpaper/rpaper ids and .specter text embeddings, the link recorder and the qrel file.'''
+    rng = np.random.default_rng(seed)
+    sizes = {name: count * scale for name, count in BASE.items()}
+    ids = {name: [str(i) for i in rng.choice(10 ** 9, sizes[key], replace=False)]
+           for name, key in (('qpaper', 'queries'), ('cpaper', 'candidates'), ('rpaper', 'retrieved'))}
+    shift = np.zeros(DIM, dtype=np.float32)
+    shift[:32] = 0.5
+
+    embeddings = {name: rng.normal(size=(len(ids[name]), DIM)).astype(np.float32) for name in ids}
+    cited = rng.choice(sizes['retrieved'], sizes['links'], replace=False)
+    embeddings['rpaper'][cited] += shift
+    qrel = [(rng.integers(sizes['queries']), rng.integers(sizes['candidates']), int(rng.random() < 0.12))
+            for _ in range(sizes['qrel'])]
+    for _, c, label in qrel:
+        if label:
+            embeddings['cpaper'][c] = rng.normal(size=DIM) + shift
+
+    for name in ids:
+        with open(os.path.join(directory, f'{name}_to_emb'), 'w') as f:
+            f.write('\n'.join(ids[name]) + '\n')
+        np.savetxt(os.path.join(directory, f'{name}.specter'), embeddings[name], fmt='%.6f')
+    targets = ids['qpaper'] + ids['cpaper']
+    with open(os.path.join(directory, 'link-recorder-final-1'), 'w') as f:
+        for r in cited:
+            f.write(f'{targets[rng.integers(len(targets))]}\t{ids["rpaper"][r]}\n')
+    with open(os.path.join(directory, 'reduced.test.qrel.cid'), 'w') as f:
+        for q, c, label in qrel:
+            f.write(f'{ids["qpaper"][q]} {ids["cpaper"][c]} {label}\n')
+    return sizes
+
+
+def legacy_pairs(qpaper, cpaper, rpaper, q_emb, c_emb, r_emb, r_corpus, qrel):
+    '''Cells 16-18 of the notebook, random.sample over a list since sets are no longer accepted.'''
+    X_train = []
+    for idx in range(len(rpaper)):
+        r_id = rpaper[idx]
+        if r_id not in r_corpus:
+            continue
+        retrieved_emb = r_emb[idx]
+        for t_id in r_corpus[r_id]:
+            if t_id in qpaper:
+                t_emb = q_emb[qpaper.index(t_id)]
+            else:
+                t_emb = c_emb[cpaper.index(t_id)]
+            X_train.append(np.hstack((t_emb, retrieved_emb)))
+            for id in random.sample(sorted(set(range(len(rpaper))) - {idx}), 8):
+                X_train.append(np.hstack((t_emb, r_emb[id])))
+    X_train = np.array(X_train, dtype=np.float64)
+    y_train = np.array([1] + [0] * 8, dtype=np.float64)[np.arange(len(X_train)) % 9]
+
+    X_test, y_test = [], []
+    for qid, cid, label in qrel:
+        X_test.append(np.hstack((q_emb[qpaper.index(qid)], c_emb[cpaper.index(cid)])))
+        y_test.append(label)
+    return X_train, y_train, np.array(X_test, dtype=np.float64), np.array(y_test, dtype=np.float64)
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run(scale, legacy, grid, epochs):
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        sizes = generate(directory, scale)
+        path = lambda name: os.path.join(directory, name)  # noqa: E731
+        qpaper, cpaper, rpaper = (specter_svm.read_ids(path(f'{name}_to_emb')) for name in ('qpaper', 'cpaper', 'rpaper'))
+
+        if legacy:
+            legacy_emb, legacy_time = timed(lambda: [np.loadtxt(path(f'{name}.specter')) for name in ('qpaper', 'cpaper', 'rpaper')])
+        _, parse_time = timed(lambda: [specter_svm.load_embeddings(path(f'{name}.specter')) for name in ('qpaper', 'cpaper', 'rpaper')])
+        (q_emb, c_emb, r_emb), load_time = timed(
+            lambda: [specter_svm.load_embeddings(path(f'{name}.specter'), mmap=True) for name in ('qpaper', 'cpaper', 'rpaper')])
+        rows.append(('load (first parse)', legacy_time if legacy else None, parse_time))
+        rows.append(('load (binary)', legacy_time if legacy else None, load_time))
+
+        targets, target_rows = specter_svm.stack_targets(qpaper, q_emb, cpaper, c_emb)
+        r_corpus = specter_svm.read_links(path('link-recorder-final-1'), target_rows)
+        triples = specter_svm.read_qrel(path('reduced.test.qrel.cid'))
+
+        def build():
+            pairs = specter_svm.training_pairs(rpaper, r_corpus, target_rows, n_retrieved=len(r_emb))
+            test = specter_svm.test_pairs(triples, specter_svm.id_rows(qpaper), specter_svm.id_rows(cpaper))
+            return pairs, specter_svm.pair_features(targets, r_emb, pairs), specter_svm.pair_features(q_emb, c_emb, test)
+
+        (pairs, (X_train, y_train), (X_test, y_test)), build_time = timed(build)
+        if legacy:
+            legacy_data, legacy_build_time = timed(legacy_pairs, qpaper, cpaper, rpaper, *legacy_emb, r_corpus, triples)
+            assert legacy_data[0].shape == X_train.shape and np.array_equal(legacy_data[1], y_train), 'training pairs differ'
+            assert np.allclose(legacy_data[2], X_test, atol=1e-5), 'test features differ'
+        rows.append(('pairs', legacy_build_time if legacy else None, build_time))
+
+        results = {}
+        if grid:
+            svm, legacy_train_time = timed(specter_svm.fit_svm, legacy_data[0], legacy_data[1], n_jobs=1)
+            results['grid search float64'] = (legacy_train_time, specter_svm.accuracy(svm.predict(legacy_data[2]), y_test))
+            svm, train_time = timed(specter_svm.fit_svm, X_train, y_train, n_jobs=1)
+            results['grid search float32'] = (train_time, specter_svm.accuracy(svm.predict(X_test), y_test))
+        model, stream_time = timed(specter_svm.fit_streaming, targets, r_emb, pairs, epochs=epochs, alpha=1e-3)
+        results['streaming partial_fit'] = (stream_time, specter_svm.accuracy(model.predict(X_test), y_test))
+
+    print(f'scale {scale}x: {len(y_train)} training pairs ({X_train.nbytes / 1e6:.0f} MB as float32 features, '
+          f'{sum(array.nbytes for array in pairs) / 1e6:.1f} MB as index pairs), {len(y_test)} test pairs')
+    for name, old_time, new_time in rows:
+        old = f'{old_time:8.3f}s' if old_time is not None else '       -'
+        speedup = f'{old_time / new_time:8.1f}x' if old_time is not None else ''
+        print(f'  {name:22s} notebook {old}  module {new_time:8.3f}s {speedup}')
+    for name, (train_time, test_accuracy) in results.items():
+        print(f'  train {name:22s} {train_time:8.3f}s  test accuracy {test_accuracy:.3f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the SPECTER SVM module against the notebook cells')
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 10, 100], help='Multiples of the notebook data size')
+    parser.add_argument('--legacy_max_scale', type=int, default=10, help='Largest scale the notebook cells are run at')
+    parser.add_argument('--grid_max_scale', type=int, default=1, help='Largest scale the grid searches are run at')
+    parser.add_argument('--epochs', type=int, default=5, help='Epochs of the streaming trainer')
+    args = parser.parse_args()
+    random.seed(specter_svm.RANDOM_STATE)
+    for scale in args.scale:
+        run(scale, scale <= args.legacy_max_scale, scale <= min(args.grid_max_scale, args.legacy_max_scale), args.epochs)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,492 @@
+'''
+Offline end-to-end benchmark suite of the pipelines, against the local fakes of fake_services.py.
+
+Every stage runs one pipeline on a synthetic corpus (synthetic_corpus.py) in a fresh interpreter, so its
+peak RSS is its own and module state never leaks between stages:
+
+    simple_cid          download_papers_concurrent: S2 batch metadata, candidate races and PDF downloads
+    pdf_processor       ingestDocuments through a CachedLayoutPDFReader into a recording Neo4j driver,
+                        cold and warm parse cache, then with the local layout reader (layout_readers.py,
+                        --extract_workers processes, no cache), then create_citation_edges
+    vector_db_pdf       pandas_pdf_reader_vector_db.create_vector_db, PyPDF2 text, embeddings endpoint
+    vector_db_sherpa    pandas_llm_sherpa_vector_db.create_vector_db, layout parser and embeddings endpoint,
+                        then the same with the local layout reader
+    citation_predictor  the zero-shot notebook's chunk/embed/top-1 pairs and one LLM call per pair,
+                        run by evaluate_scheduled, with plain HTTP calls in place of dspy
+
+A stage reports, per phase, the items processed, wall time, throughput and per-item latency percentiles
+where items are timed one by one, plus the request count, failures and latency percentiles seen by every
+fake service and the peak RSS of the stage process (and of its worker processes). Results go to a JSON
+file stamped with the git commit, and --compare diffs two such files and exits non-zero on a throughput
+or memory regression beyond --tolerance.
+
+The local layout reader phases compare its throughput against the HTTP parser path: the fake parser's
+cost is --parser_latency per PDF whatever the PDF, the local reader's is real PyPDF2 parsing of the
+synthetic PDFs, so the ratio depends on --parser_latency, --pages and the CPU count. With --metrics every stage also records the pipelines' own
+counters and timers (metrics.py) and adds them to its result, which measures the instrumentation overhead
+when compared to a run without.
+
+The vector DB stages count tokens with tiktoken, which downloads its encodings on first use: on a machine
+without network access they need a warm TIKTOKEN_CACHE_DIR, otherwise the stage records the error.
+
+Usage:
+    python benchmarks/bench_suite.py --papers 32 --output before.json
+    python benchmarks/bench_suite.py --stages pdf_processor citation_predictor --failure_rate 0.02
+    python benchmarks/bench_suite.py --compare before.json after.json
+'''
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from datetime import datetime, timezone
+from pathlib import Path
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY = os.path.dirname(BENCHMARKS)
+sys.path.insert(0, os.path.join(REPOSITORY, 'pdf_processor'))
+from fake_lm import FakePrediction  # noqa: E402
+from fake_services import (EmbeddingService, LayoutParserService, LLMService, RecordingDriver, S2Service,  # noqa: E402
+                           latency_summary)
+from synthetic_corpus import corpus_ids, make_corpus, make_devset, make_work_units  # noqa: E402
+import metrics  # noqa: E402
+
+STAGES = ['simple_cid', 'pdf_processor', 'vector_db_pdf', 'vector_db_sherpa', 'citation_predictor']
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    scale = 1e6 if sys.platform == 'darwin' else 1e3
+    return resource.getrusage(who).ru_maxrss / scale
+
+
+def phase(items, unit, seconds, durations=None, **outputs):
+    '''Result of one timed phase of a stage.'''
+    result = {'items': items, 'unit': unit, 'seconds': seconds, 'throughput': items / seconds if seconds else 0.0}
+    if durations is not None:
+        result['latency'] = latency_summary(durations)
+    result.update(outputs)
+    return result
+
+
+class Timed:
+    '''Wraps one method of an object, recording the duration of every call.'''
+
+    def __init__(self, target, method):
+        self.target = target
+        self.method = method
+        self.durations = []
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.target, name)
+        if name != self.method:
+            return attribute
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self.durations.append(time.perf_counter() - start)
+        return timed
+
+
+def service_options(config, name):
+    '''Latency, jitter and failure rate of one fake service, from the suite configuration.'''
+    latency = config[f'{name}_latency']
+    return {'latency': latency, 'jitter': latency * config['jitter'], 'failure_rate': config['failure_rate'],
+            'seed': config['seed']}
+
+
+def quiet():
+    '''The pipelines print or log a line per paper, only their timings are of interest here.'''
+    stack = contextlib.ExitStack()
+    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+    stack.enter_context(contextlib.redirect_stderr(io.StringIO()))
+    return stack
+
+
+def stage_simple_cid(config, workdir):
+    with S2Service(pdf_latency=config['pdf_latency'], n_pages=config['pages'], **service_options(config, 's2')) as s2:
+        # read by simple_cid at import time
+        os.environ['S2_API_URL'] = s2.api_url
+        sys.path.insert(0, os.path.join(REPOSITORY, 'pdf_download'))
+        import simple_cid
+        from metadata_cache import MetadataCache
+
+        test_ids = corpus_ids(config['papers'], seed=config['seed'] + 1)
+        candidate_ids = corpus_ids(config['papers'] * config['candidates'], seed=config['seed'] + 2)
+        work_units = make_work_units(test_ids, candidate_ids, n_candidates=config['candidates'], seed=config['seed'])
+        cache = MetadataCache(os.path.join(workdir, 's2_metadata.sqlite'))
+        start = time.perf_counter()
+        with quiet():
+            links = simple_cid.download_papers_concurrent(
+                iter(work_units), directory=os.path.join(workdir, 'retrieved_papers'), workers=config['workers'],
+                api_rate=config['api_rate'], api_burst=config['workers'], per_host=config['workers'],
+                lookahead=config['lookahead'], cache=cache)
+        elapsed = time.perf_counter() - start
+        cache.close()
+    return {'phases': {'download': phase(len(work_units), 'test papers', elapsed, resolved=len(links),
+                                         megabytes=s2.pdf_bytes / 1e6)},
+            'services': {'s2': s2.stats()}}
+
+
+def stage_pdf_processor(config, workdir):
+    with LayoutParserService(**service_options(config, 'parser')) as parser:
+        import pdf_processor as processor
+        from layout_readers import LocalLayoutPDFReader
+        from parse_cache import CachedLayoutPDFReader
+        processor.logger.setLevel(logging.CRITICAL)
+
+        paths = make_corpus(os.path.join(workdir, 'papers'), config['papers'], n_pages=config['pages'], seed=config['seed'])
+        pdf_files = [Path(path) for path in paths.values()]
+        driver = RecordingDriver(latency=config['neo4j_latency'], failure_rate=config['failure_rate'], seed=config['seed'])
+        reader = CachedLayoutPDFReader(parser.url, cache_dir=os.path.join(workdir, 'parse_cache'))
+        phases = {}
+        for name in ('ingest (cold parse cache)', 'ingest (warm parse cache)'):
+            timed_reader = Timed(reader, 'read_pdf')
+            start = time.perf_counter()
+            ingested, failed = processor.ingestDocuments(pdf_files, timed_reader, driver, parse_workers=config['workers'],
+                                                         write_workers=config['write_workers'], batch_size=1000)
+            phases[name] = phase(len(pdf_files), 'documents', time.perf_counter() - start, timed_reader.durations,
+                                 ingested=len(ingested), failed=len(failed))
+        with LocalLayoutPDFReader(workers=config['extract_workers']) as local_reader:
+            timed_reader = Timed(local_reader, 'read_pdf')
+            start = time.perf_counter()
+            ingested, failed = processor.ingestDocuments(pdf_files, timed_reader, driver, parse_workers=config['workers'],
+                                                         write_workers=config['write_workers'], batch_size=1000)
+            phases['ingest (local reader)'] = phase(len(pdf_files), 'documents', time.perf_counter() - start,
+                                                    timed_reader.durations, ingested=len(ingested), failed=len(failed))
+
+        # a sparse random citation graph between the documents, about 5 citations each
+        rng = random.Random(config['seed'])
+        hashes = [processor.documentUrlHash(str(pdf_file)) for pdf_file in pdf_files]
+        edges = [(rng.choice(hashes), rng.choice(hashes)) for _ in range(5 * len(hashes))]
+        start = time.perf_counter()
+        processor.create_citation_edges(driver, edges, batch_size=1000)
+        phases['citation edges'] = phase(len(edges), 'edges', time.perf_counter() - start)
+    return {'phases': phases, 'services': {'parser': parser.stats(), 'neo4j': driver.stats()},
+            'parse_cache': {'hits': reader.hits, 'misses': reader.misses}}
+
+
+def embedding_batcher(config, service):
+    from embedding_batcher import EmbeddingBatcher, HTTPEmbeddingClient
+    return EmbeddingBatcher(HTTPEmbeddingClient(service.url + '/v1/embeddings'), workers=config['workers'],
+                            backoff=config['backoff'])
+
+
+def stage_vector_db_pdf(config, workdir):
+    with EmbeddingService(dim=config['dim'], **service_options(config, 'embedding')) as embeddings:
+        import pandas_pdf_reader_vector_db as script
+
+        paths = make_corpus(os.path.join(workdir, 'papers'), config['papers'], n_pages=config['pages'], seed=config['seed'])
+        batcher = embedding_batcher(config, embeddings)
+        start = time.perf_counter()
+        with quiet():
+            frame, vectors = script.create_vector_db([Path(path) for path in paths.values()],
+                                                     os.path.join(workdir, 'vector_db'), batcher=batcher,
+                                                     extract_workers=config['extract_workers'])
+        elapsed = time.perf_counter() - start
+    return {'phases': {'create_vector_db': phase(len(paths), 'documents', elapsed, chunks=len(frame),
+                                                 requests=batcher.requests, retries=batcher.retries)},
+            'services': {'embedding': embeddings.stats()}}
+
+
+def stage_vector_db_sherpa(config, workdir):
+    with LayoutParserService(**service_options(config, 'parser')) as parser, \
+            EmbeddingService(dim=config['dim'], **service_options(config, 'embedding')) as embeddings:
+        # read by the script at import time
+        os.environ['LLMSHERPA_API_URL'] = parser.url
+        import pandas_llm_sherpa_vector_db as script
+        from layout_readers import LocalLayoutPDFReader
+
+        paths = make_corpus(os.path.join(workdir, 'papers'), config['papers'], n_pages=config['pages'], seed=config['seed'])
+        # the script writes failed_pdfs to the working directory
+        os.chdir(workdir)
+        phases = {}
+        for name, backend in (('create_vector_db', 'llmsherpa'), ('create_vector_db (local)', 'local')):
+            batcher = embedding_batcher(config, embeddings)
+            with LocalLayoutPDFReader(workers=config['extract_workers']) as local_reader:
+                options = ({'parse_cache': os.path.join(workdir, 'parse_cache')} if backend == 'llmsherpa' else
+                           {'pdf_reader': local_reader, 'parse_workers': config['extract_workers']})
+                start = time.perf_counter()
+                with quiet():
+                    frame, vectors = script.create_vector_db([Path(path) for path in paths.values()],
+                                                             os.path.join(workdir, f'vector_db_{backend}'), batcher=batcher,
+                                                             **options)
+                elapsed = time.perf_counter() - start
+            phases[name] = phase(len(paths), 'documents', elapsed, chunks=len(frame), requests=batcher.requests,
+                                 retries=batcher.retries)
+    return {'phases': phases, 'services': {'parser': parser.stats(), 'embedding': embeddings.stats()}}
+
+
+class Example(dict):
+    def inputs(self):
+        return {'query_file': self['query_file'], 'candidate_file': self['candidate_file']}
+
+
+class HTTPCitationProgram:
+    '''
+    PredictCitationAndResolve of the zero-shot notebook without dspy: the same pairs (chunks, stored
+    embeddings, top-1 candidate chunk per query chunk), one chat completion per pair
+    '''
+
+    INSTRUCTIONS = 'Predict if the two chunks are related by a citation. Answer with True or False after "Answer:".'
+    # every pair is predicted, like the notebook
+    stop_on = None
+
+    def __init__(self, llm_url, embed_client, text_store, embedding_store, folders, context_window=3000, max_windows=5):
+        from chunking import Chunker
+
+        self.llm_url = llm_url
+        self.embed_client = embed_client
+        self.text_store = text_store
+        self.embedding_store = embedding_store
+        self.folders = folders
+        self.chunk = Chunker(context_window=context_window, max_windows=max_windows)
+        self.local = threading.local()
+
+    def session(self):
+        import requests
+
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def pairs(self, query_file, candidate_file):
+        from similarity import top_k
+
+        query_chunks = self.text_store.chunks(query_file, self.chunk, path=f'{self.folders[0]}/{query_file}.pdf')
+        candidate_chunks = self.text_store.chunks(candidate_file, self.chunk, path=f'{self.folders[1]}/{candidate_file}.pdf')
+        candidate_embeddings = self.embedding_store.embed(candidate_chunks, self.embed_client.embed)
+        query_embeddings = self.embedding_store.embed(query_chunks, self.embed_client.embed)
+        most_similar_idx, _ = top_k(query_embeddings, candidate_embeddings, k=1)
+        return [dict(query_chunk=snippet, candidate_chunk=candidate_chunks[candidate_idx])
+                for snippet, candidate_idx in zip(query_chunks, most_similar_idx[:, 0])]
+
+    def predict_pair(self, inputs):
+        messages = [{'role': 'system', 'content': self.INSTRUCTIONS},
+                    {'role': 'user', 'content': f'Query Chunk: {inputs["query_chunk"]}\n\n'
+                                                f'Candidate Chunk: {inputs["candidate_chunk"]}'}]
+        response = self.session().post(self.llm_url, json={'model': 'fake', 'messages': messages}, timeout=60)
+        response.raise_for_status()
+        content = response.json()['choices'][0]['message']['content']
+        rationale, _, answer = content.rpartition('Answer:')
+        return FakePrediction(rationale=rationale.strip(), answer=answer.strip())
+
+    def resolve(self, pairs, outputs):
+        predictions = [output.answer == 'True' for output in outputs]
+        return FakePrediction(predictions=predictions, resolved=any(predictions))
+
+
+def stage_citation_predictor(config, workdir):
+    with EmbeddingService(dim=config['dim'], **service_options(config, 'embedding')) as embeddings, \
+            LLMService(**service_options(config, 'llm')) as llm:
+        from embedding_batcher import HTTPEmbeddingClient
+        from embedding_store import EmbeddingStore
+        from prediction_scheduler import PredictionScheduler, evaluate_scheduled
+        from text_store import TextStore
+
+        n_queries = max(1, config['papers'] // 4)
+        query_ids = corpus_ids(n_queries, seed=config['seed'] + 3)
+        candidate_ids = corpus_ids(config['papers'], seed=config['seed'] + 4)
+        folders = (os.path.join(workdir, 'query_papers'), os.path.join(workdir, 'candidate_papers'))
+        query_paths = make_corpus(folders[0], n_pages=config['pages'], ids=query_ids)
+        candidate_paths = make_corpus(folders[1], n_pages=config['pages'], ids=candidate_ids)
+        devset = [Example(query_file=query, candidate_file=candidate, cites=cites)
+                  for query, candidate, cites in make_devset(query_ids, candidate_ids, config['examples'], seed=config['seed'])]
+
+        text_store = TextStore(os.path.join(workdir, 'text_store'))
+        start = time.perf_counter()
+        with quiet():
+            text_store.populate({**query_paths, **candidate_paths}, workers=config['extract_workers'])
+        phases = {'text extraction': phase(len(query_paths) + len(candidate_paths), 'documents', time.perf_counter() - start)}
+
+        program = HTTPCitationProgram(llm.url + '/v1/chat/completions', HTTPEmbeddingClient(embeddings.url + '/v1/embeddings'),
+                                      text_store, EmbeddingStore(os.path.join(workdir, 'embedding_store')), folders)
+        timed_program = Timed(program, 'predict_pair')
+        scheduler = PredictionScheduler(workers=config['llm_workers'], backoff=config['backoff'])
+        start = time.perf_counter()
+        with quiet():
+            score, results = evaluate_scheduled(timed_program, devset, lambda example, prediction: int(example['cites'] == prediction.resolved),
+                                                scheduler, prepare_workers=config['workers'])
+        phases['evaluate'] = phase(len(devset), 'examples', time.perf_counter() - start, score=score,
+                                   failed=sum(prediction is None for _, prediction, _ in results), **scheduler.stats())
+        phases['predict_pair'] = phase(len(timed_program.durations), 'calls', scheduler.elapsed, timed_program.durations)
+    return {'phases': phases, 'services': {'embedding': embeddings.stats(), 'llm': llm.stats()}}
+
+
+def run_child(stage, config, result_path):
+    '''Runs one stage in this process and writes its result, with the peak RSS, to result_path.'''
+    workdir = os.path.dirname(result_path)
+    baseline_rss = peak_rss_mb()
+    recorder = metrics.configure(jsonl=os.path.join(workdir, 'metrics.jsonl')) if config.get('metrics') else None
+    start = time.perf_counter()
+    try:
+        result = globals()[f'stage_{stage}'](config, workdir)
+    except Exception:
+        result = {'error': traceback.format_exc()}
+    result['seconds'] = time.perf_counter() - start
+    if recorder is not None:
+        result['metrics'] = recorder.snapshot()
+        recorder.close()
+        with open(os.path.join(workdir, 'metrics.jsonl')) as f:
+            result['metrics']['spans'] = sum(1 for line in f) - 1
+    result['baseline_rss_mb'] = baseline_rss
+    result['peak_rss_mb'] = peak_rss_mb()
+    result['peak_worker_rss_mb'] = peak_rss_mb(resource.RUSAGE_CHILDREN)
+    with open(result_path, 'w') as f:
+        json.dump(result, f)
+
+
+def run_stage(stage, config):
+    '''Runs a stage in a fresh interpreter and returns its result.'''
+    with tempfile.TemporaryDirectory() as workdir:
+        result_path = os.path.join(workdir, 'result.json')
+        command = [sys.executable, os.path.abspath(__file__), '--child', stage, '--child_config', json.dumps(config),
+                   '--child_result', result_path]
+        try:
+            completed = subprocess.run(command, cwd=workdir, capture_output=True, text=True, timeout=config['timeout'])
+        except subprocess.TimeoutExpired:
+            return {'error': f'timed out after {config["timeout"]}s'}
+        if not os.path.exists(result_path):
+            return {'error': f'exit status {completed.returncode}: {completed.stderr[-4000:]}'}
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=REPOSITORY, capture_output=True, text=True).stdout.strip()
+    try:
+        return git('rev-parse', 'HEAD') or None, bool(git('status', '--porcelain', '--untracked-files=no'))
+    except OSError:
+        return None, None
+
+
+def print_results(results):
+    for stage, result in results['stages'].items():
+        if 'peak_rss_mb' in result:
+            print(f'{stage}: {result["seconds"]:.1f}s, peak RSS {result["peak_rss_mb"]:.0f} MB '
+                  f'(workers {result["peak_worker_rss_mb"]:.0f} MB)')
+        else:
+            print(f'{stage}:')
+        if 'error' in result:
+            print('  error: ' + result['error'].strip().splitlines()[-1])
+        for name, values in result.get('phases', {}).items():
+            latency = values.get('latency', {})
+            percentiles = (f'  p50 {latency["p50_ms"]:8.1f} ms  p99 {latency["p99_ms"]:8.1f} ms'
+                           if latency.get('count') else '')
+            print(f'  {name:28s} {values["items"]:6d} {values["unit"]:12s} {values["seconds"]:8.2f}s '
+                  f'{values["throughput"]:9.2f}/s{percentiles}')
+        for name, values in result.get('services', {}).items():
+            latency = values['latency']
+            percentiles = (f'  p50 {latency["p50_ms"]:8.1f} ms  p99 {latency["p99_ms"]:8.1f} ms'
+                           if latency.get('count') else '')
+            count = values.get('requests', values.get('transactions', 0))
+            print(f'  {"service " + name:28s} {count:6d} requests     {values["failures"]:4d} failed{percentiles}')
+
+
+def compare(baseline, current, tolerance=0.1):
+    '''
+    Prints throughput and peak RSS of the stages of two result files side by side
+    :param tolerance: relative throughput drop or RSS growth reported as a regression
+    :return: list of (stage, phase or metric) that regressed
+    '''
+    print(f'baseline {baseline.get("commit") or "?"} ({baseline["created"]})  vs  current {current.get("commit") or "?"} '
+          f'({current["created"]})')
+    regressions = []
+    for stage, result in current['stages'].items():
+        old = baseline['stages'].get(stage)
+        if old is None or 'error' in old or 'error' in result:
+            print(f'{stage}: ' + ('not in baseline' if old is None else 'failed in one of the runs'))
+            continue
+        print(f'{stage}:')
+        rows = [(name, old['phases'][name]['throughput'], values['throughput'], True)
+                for name, values in result['phases'].items() if name in old['phases']]
+        rows.append(('peak RSS (MB)', old['peak_rss_mb'], result['peak_rss_mb'], False))
+        for name, old_value, new_value, higher_is_better in rows:
+            ratio = new_value / old_value if old_value else float('inf')
+            regressed = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+            if regressed:
+                regressions.append((stage, name))
+            print(f'  {name:28s} {old_value:10.2f} -> {new_value:10.2f}  {ratio:6.2f}x{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline end-to-end benchmarks of the pipelines against local fakes')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='Stages to run')
+    parser.add_argument('--output', help='Result file (default: bench_suite-<commit>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help='Compare two result files and exit')
+    parser.add_argument('--baseline', help='Result file the new results are compared to')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative change reported as a regression')
+    parser.add_argument('--papers', type=int, default=32, help='Papers per corpus')
+    parser.add_argument('--pages', type=int, default=8, help='Pages per paper')
+    parser.add_argument('--candidates', type=int, default=5, help='Retrieved candidates per test paper for simple_cid')
+    parser.add_argument('--examples', type=int, default=64, help='Devset size of the citation predictor')
+    parser.add_argument('--workers', type=int, default=8, help='Download, parse, embedding request and pair preparation threads')
+    parser.add_argument('--write_workers', type=int, default=2, help='Neo4j writer threads of pdf_processor')
+    parser.add_argument('--extract_workers', type=int, default=os.cpu_count(), help='PDF text extraction processes')
+    parser.add_argument('--llm_workers', type=int, default=32, help='LLM calls in flight')
+    parser.add_argument('--lookahead', type=int, default=2, help='Candidates of one test paper resolved at once')
+    parser.add_argument('--api_rate', type=float, default=100.0, help='S2 API requests per second')
+    parser.add_argument('--dim', type=int, default=1536, help='Embedding dimension')
+    parser.add_argument('--s2_latency', type=float, default=0.02, help='Seconds per S2 metadata request')
+    parser.add_argument('--pdf_latency', type=float, default=0.05, help='Extra seconds per PDF download')
+    parser.add_argument('--parser_latency', type=float, default=0.2, help='Seconds per layout parse')
+    parser.add_argument('--embedding_latency', type=float, default=0.05, help='Seconds per embeddings request')
+    parser.add_argument('--llm_latency', type=float, default=0.2, help='Seconds per LLM call')
+    parser.add_argument('--neo4j_latency', type=float, default=0.002, help='Seconds per Neo4j statement')
+    parser.add_argument('--jitter', type=float, default=0.5, help='Uniform random extra latency, as a fraction of the latency')
+    parser.add_argument('--failure_rate', type=float, default=0.0, help='Fraction of requests and statements failing')
+    parser.add_argument('--backoff', type=float, default=0.1, help='Seconds before the first retry of the embedding and LLM clients')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', action='store_true', help='Record the pipeline metrics in every stage')
+    parser.add_argument('--timeout', type=float, default=1800, help='Seconds a stage may run')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--child_config', help=argparse.SUPPRESS)
+    parser.add_argument('--child_result', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, json.loads(args.child_config), args.child_result)
+        return
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            sys.exit(1 if compare(json.load(f), json.load(g), args.tolerance) else 0)
+
+    config = {name: value for name, value in vars(args).items()
+              if name not in ('stages', 'output', 'compare', 'baseline', 'tolerance', 'child', 'child_config', 'child_result')}
+    commit, dirty = git_revision()
+    results = {'commit': commit, 'dirty': dirty, 'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+               'config': config, 'stages': {}}
+    for stage in args.stages:
+        print(f'running {stage}...', flush=True)
+        results['stages'][stage] = run_stage(stage, config)
+
+    output = args.output or f'bench_suite-{(commit or "unknown")[:10]}.json'
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print_results(results)
+    print(f'results written to {output}')
+    if args.baseline:
+        with open(args.baseline) as f:
+            sys.exit(1 if compare(json.load(f), results, args.tolerance) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+'''
+Local stand-in for the citation predictor's LM, for offline benchmarks.
+
+FakeLM answers a chunk pair after a configurable latency with a deterministic answer derived from a
+hash of its inputs, so repeated runs and different schedulers can be compared output for output.
+It counts calls and the peak number of calls in flight.
+'''
+import hashlib
+import random
+import threading
+import time
+
+
+class FakePrediction(dict):
+    '''Dict with attribute access, shaped like the dspy.Prediction of ChainOfThought(PredictCitation).'''
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeLM:
+    '''
+    :param latency: seconds per call
+    :param jitter: uniform random extra latency, in seconds
+    :param positive_rate: fraction of pairs answered 'True'
+    :param failure_rate: fraction of calls raising, to exercise retries
+    '''
+
+    def __init__(self, latency=0.05, jitter=0.0, positive_rate=0.1, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.positive_rate = positive_rate
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def answer(self, **inputs):
+        digest = hashlib.sha256(repr(sorted(inputs.items())).encode('utf-8')).digest()
+        return 'True' if int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.positive_rate else 'False'
+
+    def __call__(self, **inputs):
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            fail = self.rng.random() < self.failure_rate
+            delay = self.latency + self.rng.random() * self.jitter
+        try:
+            time.sleep(delay)
+            if fail:
+                raise RuntimeError('fake LM failure')
+            return FakePrediction(rationale='fake', answer=self.answer(**inputs))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
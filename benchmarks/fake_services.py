@@ -0,0 +1,446 @@
+'''
+Local stand-ins for the remote services of the pipelines, for offline benchmarks.
+
+Every HTTP fake is a ThreadingHTTPServer on a free localhost port, started in a background thread. Each
+request sleeps `latency` plus up to `jitter` seconds and fails with `failure_status` at `failure_rate`, so
+retries, rate limits and concurrency can be exercised without API keys. Answers are deterministic
+functions of the request, so two runs or two implementations can be compared output for output, and
+every service records the time it spent on each request.
+
+    S2Service             Semantic Scholar graph API: /paper/CorpusID:<id>, /paper/batch and the PDFs
+                          at openAccessPdf.url, with Range support; simple_cid reads S2_API_URL
+    LayoutParserService   llmsherpa parseDocument: a multipart upload answered with layout blocks
+    EmbeddingService      OpenAI-style /embeddings with deterministic unit vectors
+    LLMService            OpenAI-style /chat/completions and /completions answering 'Answer: True|False'
+    RecordingDriver       in-process Neo4j driver recording every statement, with latency per statement
+
+Usage:
+    with S2Service(latency=0.05, failure_rate=0.01) as s2:
+        os.environ['S2_API_URL'] = s2.api_url
+        ...
+    print(s2.stats())
+'''
+import email.parser
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+from synthetic_corpus import WORDS, make_pdf
+
+
+def latency_summary(seconds):
+    '''Count, mean, p50/p90/p99 and max of a list of durations, in milliseconds.'''
+    if not seconds:
+        return {'count': 0}
+    values = np.asarray(seconds, dtype=np.float64) * 1000
+    p50, p90, p99 = np.percentile(values, [50, 90, 99])
+    return {'count': int(len(values)), 'mean_ms': float(values.mean()), 'p50_ms': float(p50), 'p90_ms': float(p90),
+            'p99_ms': float(p99), 'max_ms': float(values.max())}
+
+
+def stable_fraction(*parts):
+    '''Deterministic number in [0, 1) derived from a hash of parts.'''
+    digest = hashlib.sha256('\0'.join(str(part) for part in parts).encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') / 2 ** 64
+
+
+class FakeService:
+    '''
+    Threaded HTTP server with injected latency and failures, subclasses implement handle()
+    :param latency: seconds added to every request
+    :param jitter: uniform random extra latency, in seconds
+    :param failure_rate: fraction of requests answered with failure_status instead
+    :param failure_status: HTTP status of an injected failure, e.g. 500 or 429
+    '''
+
+    def __init__(self, latency=0.0, jitter=0.0, failure_rate=0.0, failure_status=500, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.rng = random.Random(seed)
+        self.durations = []
+        self.requests = 0
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def handle(self, method, path, query, headers, body):
+        '''Answers one request, returns (status, content type, body bytes, extra headers).'''
+        raise NotImplementedError
+
+    def _serve(self, request, method):
+        start = time.perf_counter()
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            fail = self.rng.random() < self.failure_rate
+            delay = self.latency + self.rng.random() * self.jitter
+        try:
+            length = int(request.headers.get('content-length') or 0)
+            body = request.rfile.read(length) if length else b''
+            time.sleep(delay)
+            if fail:
+                status, content_type, payload, extra = self.failure_status, 'application/json', b'{"error": "injected"}', {}
+            else:
+                parsed = urlparse(request.path)
+                status, content_type, payload, extra = self.handle(method, parsed.path, parse_qs(parsed.query),
+                                                                   request.headers, body)
+            request.send_response(status)
+            request.send_header('content-type', content_type)
+            request.send_header('content-length', str(len(payload)))
+            for name, value in extra.items():
+                request.send_header(name, value)
+            request.end_headers()
+            request.wfile.write(payload)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.failures += fail
+                self.durations.append(time.perf_counter() - start)
+
+    def start(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                service._serve(self, 'GET')
+
+            def do_POST(self):
+                service._serve(self, 'POST')
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'failures': self.failures, 'max_in_flight': self.max_in_flight,
+                    'latency': latency_summary(self.durations)}
+
+
+def json_response(value, status=200):
+    return status, 'application/json', json.dumps(value).encode('utf-8'), {}
+
+
+class S2Service(FakeService):
+    '''
+    Semantic Scholar metadata and open-access PDFs
+    :param open_access_rate: fraction of papers with an openAccessPdf
+    :param known_rate: fraction of corpus IDs the API knows, the others are 404 or null in a batch
+    :param pdf_latency: extra seconds per PDF download, on top of latency
+    :param n_pages: pages of the served PDFs
+    '''
+
+    def __init__(self, open_access_rate=0.5, known_rate=0.95, pdf_latency=0.0, n_pages=8, **kwargs):
+        super().__init__(**kwargs)
+        self.open_access_rate = open_access_rate
+        self.known_rate = known_rate
+        self.pdf_latency = pdf_latency
+        self.n_pages = n_pages
+        self.pdf_bytes = 0
+        self._pdfs = {}
+
+    @property
+    def api_url(self):
+        return self.url + '/graph/v1'
+
+    def metadata(self, corpus_id):
+        if stable_fraction('known', corpus_id) >= self.known_rate:
+            return None
+        open_access = stable_fraction('open', corpus_id) < self.open_access_rate
+        return {'corpusId': int(corpus_id), 'paperId': hashlib.sha1(corpus_id.encode()).hexdigest(),
+                'isOpenAccess': open_access,
+                'openAccessPdf': {'url': f'{self.url}/pdf/{corpus_id}.pdf'} if open_access else None}
+
+    def pdf(self, corpus_id):
+        with self._lock:
+            if corpus_id not in self._pdfs:
+                self._pdfs[corpus_id] = make_pdf(self.n_pages, seed=int(corpus_id))
+            return self._pdfs[corpus_id]
+
+    def handle(self, method, path, query, headers, body):
+        if method == 'GET' and (match := re.fullmatch(r'/graph/v1/paper/CorpusID:(\d+)', path)):
+            paper = self.metadata(match.group(1))
+            return json_response(paper) if paper is not None else json_response({'error': 'Paper not found'}, 404)
+        if method == 'POST' and path == '/graph/v1/paper/batch':
+            ids = json.loads(body)['ids']
+            return json_response([self.metadata(paper_id.split(':', 1)[1]) for paper_id in ids])
+        if method == 'GET' and (match := re.fullmatch(r'/pdf/(\d+)\.pdf', path)):
+            time.sleep(self.pdf_latency)
+            pdf = self.pdf(match.group(1))
+            with self._lock:
+                self.pdf_bytes += len(pdf)
+            if (range_header := headers.get('range')) and (match := re.fullmatch(r'bytes=(\d+)-', range_header)):
+                start = int(match.group(1))
+                if start >= len(pdf):
+                    return 416, 'application/pdf', b'', {'content-range': f'bytes */{len(pdf)}'}
+                return 206, 'application/pdf', pdf[start:], {'content-range': f'bytes {start}-{len(pdf) - 1}/{len(pdf)}'}
+            return 200, 'application/pdf', pdf, {}
+        return json_response({'error': 'not found'}, 404)
+
+
+def parse_multipart(headers, body):
+    '''Dictionary of field name to (file name, bytes) of a multipart/form-data body.'''
+    message = email.parser.BytesParser().parsebytes(
+        b'content-type: ' + headers['content-type'].encode('latin-1') + b'\r\n\r\n' + body)
+    return {part.get_param('name', header='content-disposition'): (part.get_filename(), part.get_payload(decode=True))
+            for part in message.get_payload()}
+
+
+class LayoutParserService(FakeService):
+    '''
+    llmsherpa layout parser, answering an uploaded PDF with the blocks of a synthetic layout. The layout
+    does not come from the PDF text, only its size and a seed from its hash: sections of a header, a
+    subsection header and paragraphs, about blocks_per_kb blocks per KB of PDF
+    :param seconds_per_mb: extra parse time per MB of PDF, on top of latency
+    '''
+
+    def __init__(self, blocks_per_kb=2.0, seconds_per_mb=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.blocks_per_kb = blocks_per_kb
+        self.seconds_per_mb = seconds_per_mb
+        self.documents = 0
+
+    def blocks(self, contents):
+        rng = random.Random(hashlib.sha256(contents).digest())
+        n_blocks = max(3, int(len(contents) / 1024 * self.blocks_per_kb))
+        blocks = []
+        page = 0
+        while len(blocks) < n_blocks:
+            section = f'{page + 1} ' + ' '.join(rng.choice(WORDS) for _ in range(2)).title()
+            blocks.append({'tag': 'header', 'level': 0, 'page_idx': page, 'sentences': [section]})
+            blocks.append({'tag': 'header', 'level': 1, 'page_idx': page,
+                           'sentences': [f'{page + 1}.1 ' + rng.choice(WORDS).title()]})
+            for _ in range(rng.randint(2, 6)):
+                sentences = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + '.'
+                             for _ in range(rng.randint(1, 4))]
+                blocks.append({'tag': 'para', 'level': 2, 'page_idx': page, 'sentences': sentences})
+            page += 1
+        for block_idx, block in enumerate(blocks):
+            block.update(block_idx=block_idx, bbox=[50.0, 700.0 - 12 * (block_idx % 50), 560.0, 712.0 - 12 * (block_idx % 50)])
+        return blocks
+
+    def handle(self, method, path, query, headers, body):
+        if method != 'POST':
+            return json_response({'error': 'not found'}, 404)
+        _, contents = parse_multipart(headers, body)['file']
+        time.sleep(self.seconds_per_mb * len(contents) / 1e6)
+        with self._lock:
+            self.documents += 1
+        return json_response({'status': 200, 'return_dict': {'result': {'blocks': self.blocks(contents)}}})
+
+
+class EmbeddingService(FakeService):
+    '''
+    OpenAI-compatible embeddings endpoint at /embeddings and /v1/embeddings, a text's vector is a random
+    unit vector seeded by the text, so equal texts get equal embeddings
+    :param dim: embedding dimension
+    :param seconds_per_item: extra seconds per embedded text, on top of latency
+    '''
+
+    def __init__(self, dim=1536, seconds_per_item=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.dim = dim
+        self.seconds_per_item = seconds_per_item
+        self.items = 0
+
+    def embedding(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'big')
+        vector = np.random.default_rng(seed).standard_normal(self.dim, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+
+    def handle(self, method, path, query, headers, body):
+        if method != 'POST' or not path.endswith('/embeddings'):
+            return json_response({'error': 'not found'}, 404)
+        request = json.loads(body)
+        texts = [request['input']] if isinstance(request['input'], str) else request['input']
+        time.sleep(self.seconds_per_item * len(texts))
+        with self._lock:
+            self.items += len(texts)
+        n_tokens = sum(len(text) // 4 for text in texts)
+        return json_response({
+            'object': 'list', 'model': request.get('model', 'text-embedding-3-small'),
+            'data': [{'object': 'embedding', 'index': i, 'embedding': self.embedding(text).tolist()}
+                     for i, text in enumerate(texts)],
+            'usage': {'prompt_tokens': n_tokens, 'total_tokens': n_tokens},
+        })
+
+
+class LLMService(FakeService):
+    '''
+    OpenAI-compatible completions at /chat/completions and /completions (with or without a /v1 prefix),
+    answering every prompt with a short rationale and 'Answer: True' or 'Answer: False'
+    :param positive_rate: fraction of prompts answered True, decided by a hash of the prompt
+    :param seconds_per_token: extra seconds per prompt token (4 characters), on top of latency
+    '''
+
+    def __init__(self, positive_rate=0.1, seconds_per_token=0.0, **kwargs):
+        super().__init__(**kwargs)
+        self.positive_rate = positive_rate
+        self.seconds_per_token = seconds_per_token
+        self.prompt_tokens = 0
+
+    def answer(self, prompt):
+        return 'True' if stable_fraction(prompt) < self.positive_rate else 'False'
+
+    def handle(self, method, path, query, headers, body):
+        if method != 'POST' or not path.endswith('completions'):
+            return json_response({'error': 'not found'}, 404)
+        request = json.loads(body)
+        chat = path.endswith('/chat/completions')
+        prompt = ('\n'.join(str(message.get('content', '')) for message in request.get('messages', []))
+                  if chat else str(request.get('prompt', '')))
+        n_tokens = len(prompt) // 4
+        time.sleep(self.seconds_per_token * n_tokens)
+        with self._lock:
+            self.prompt_tokens += n_tokens
+        text = f'Reasoning: Let\'s think step by step in order to compare the chunks.\nAnswer: {self.answer(prompt)}'
+        choice = {'index': 0, 'finish_reason': 'stop'}
+        choice.update({'message': {'role': 'assistant', 'content': text}} if chat else {'text': text})
+        return json_response({
+            'id': f'fake-{hashlib.sha1(body).hexdigest()[:12]}', 'object': 'chat.completion' if chat else 'text_completion',
+            'created': int(time.time()), 'model': request.get('model', 'fake'), 'choices': [choice],
+            'usage': {'prompt_tokens': n_tokens, 'completion_tokens': 20, 'total_tokens': n_tokens + 20},
+        })
+
+
+class RecordingResult:
+    def consume(self):
+        return None
+
+    def __iter__(self):
+        return iter(())
+
+    def single(self):
+        return None
+
+    def data(self):
+        return []
+
+
+class RecordingTransaction:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def run(self, query, parameters=None, **kwargs):
+        return self.driver.record(query, {**(parameters or {}), **kwargs})
+
+
+class RecordingSession:
+    def __init__(self, driver):
+        self.driver = driver
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        pass
+
+    def run(self, query, parameters=None, **kwargs):
+        return self.driver.record(query, {**(parameters or {}), **kwargs})
+
+    def _transaction(self, transaction_function, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return transaction_function(RecordingTransaction(self.driver), *args, **kwargs)
+        finally:
+            with self.driver._lock:
+                self.driver.transactions += 1
+                self.driver.transaction_durations.append(time.perf_counter() - start)
+
+    execute_write = _transaction
+    execute_read = _transaction
+    write_transaction = _transaction
+    read_transaction = _transaction
+
+
+class RecordingDriver:
+    '''
+    Stand-in for a neo4j Driver: sessions run nothing and return empty results, every statement is
+    recorded with the number of $rows it carried
+    :param latency: seconds per statement, the round trip and server time of a real database
+    :param seconds_per_row: extra seconds per element of an UNWIND $rows parameter
+    :param failure_rate: fraction of statements raising, the transaction function sees the error
+    :param keep_statements: keep (query, row count) of every statement, not only the counters
+    '''
+
+    def __init__(self, latency=0.0, seconds_per_row=0.0, failure_rate=0.0, keep_statements=False, seed=0):
+        self.latency = latency
+        self.seconds_per_row = seconds_per_row
+        self.failure_rate = failure_rate
+        self.keep_statements = keep_statements
+        self.rng = random.Random(seed)
+        self.statement_log = []
+        self.statements = 0
+        self.rows = 0
+        self.failures = 0
+        self.transactions = 0
+        self.transaction_durations = []
+        self._lock = threading.Lock()
+
+    def session(self, **kwargs):
+        return RecordingSession(self)
+
+    def verify_connectivity(self):
+        return None
+
+    def close(self):
+        pass
+
+    def record(self, query, parameters):
+        n_rows = len(parameters.get('rows', ()))
+        with self._lock:
+            self.statements += 1
+            self.rows += n_rows
+            fail = self.rng.random() < self.failure_rate
+            self.failures += fail
+            if self.keep_statements:
+                self.statement_log.append((query, n_rows))
+        time.sleep(self.latency + self.seconds_per_row * n_rows)
+        if fail:
+            raise RuntimeError('injected Neo4j failure')
+        return RecordingResult()
+
+    def stats(self):
+        with self._lock:
+            return {'statements': self.statements, 'rows': self.rows, 'failures': self.failures,
+                    'transactions': self.transactions, 'latency': latency_summary(self.transaction_durations)}
@@ -0,0 +1,115 @@
+'''
+Synthetic PDFs and corpora for the offline benchmarks.
+
+make_pdf writes a minimal, valid PDF without any PDF library: every page starts with a numbered section
+heading in 14pt Helvetica-Bold followed by paragraphs of 10pt Helvetica, one text line per `Tj T*`, so
+PyPDF2 extracts one line of text per line and a layout reader can tell headings from body text by font
+size. The words come from a small scientific vocabulary seeded per paper, so every paper has different
+text (different chunks, different embeddings) and the same seed always gives the same bytes.
+
+Usage:
+    paths = make_corpus('papers', n_papers=64, n_pages=8)          # corpus ID -> PDF path
+    work_units = make_work_units(test_ids, candidate_ids, n_candidates=5)
+    devset = make_devset(query_ids, candidate_ids, n_examples=100)
+'''
+import os
+import random
+
+WORDS = ('citation graph neural retrieval embedding model paper layout vector token dataset method attention '
+         'transformer baseline evaluation corpus query candidate document section result analysis training '
+         'inference benchmark precision recall accuracy encoder decoder representation similarity ranking '
+         'experiment ablation parameter optimization gradient loss sample distribution structure').split()
+SECTIONS = ('Introduction', 'Related Work', 'Method', 'Experiments', 'Results', 'Discussion', 'Conclusion')
+
+
+def paper_lines(rng, n_lines, words_per_line=12):
+    '''Lines of random words, a paragraph ends every 4 to 8 lines with a period.'''
+    lines = []
+    remaining = 0
+    for _ in range(n_lines):
+        if remaining == 0:
+            remaining = rng.randint(4, 8)
+        line = ' '.join(rng.choice(WORDS) for _ in range(words_per_line))
+        remaining -= 1
+        lines.append((line + '.' if remaining == 0 else line, remaining == 0))
+    return lines
+
+
+def make_pdf(n_pages=8, lines_per_page=40, seed=0):
+    '''
+    Bytes of a PDF with n_pages pages of lines_per_page lines each
+    :param seed: seed of the page text, the same seed gives the same file
+    '''
+    rng = random.Random(seed)
+    contents = []
+    for page in range(n_pages):
+        heading = f'{page + 1} {SECTIONS[page % len(SECTIONS)]}'
+        ops = ['BT', '/F2 14 Tf 50 750 Td 18 TL', f'({heading}) Tj T*', '/F1 10 Tf 12 TL']
+        for line, paragraph_end in paper_lines(rng, lines_per_page):
+            ops.append(f'({line}) Tj T*')
+            if paragraph_end:
+                # an empty line between paragraphs
+                ops.append('T*')
+        ops.append('ET')
+        contents.append('\n'.join(ops).encode('latin-1'))
+
+    # 1 catalog, 2 page tree, 3 and 4 fonts, then a page and a content stream object per page
+    objects = {
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        3: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+        4: b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica-Bold >>',
+    }
+    kids = []
+    for page, content in enumerate(contents):
+        page_id, content_id = 5 + 2 * page, 6 + 2 * page
+        kids.append(f'{page_id} 0 R')
+        objects[page_id] = (f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                            f'/Resources << /Font << /F1 3 0 R /F2 4 0 R >> >> /Contents {content_id} 0 R >>').encode()
+        objects[content_id] = b'<< /Length %d >>\nstream\n' % len(content) + content + b'\nendstream'
+    objects[2] = f'<< /Type /Pages /Kids [{" ".join(kids)}] /Count {n_pages} >>'.encode()
+
+    out = bytearray(b'%PDF-1.4\n')
+    offsets = {}
+    for object_id in sorted(objects):
+        offsets[object_id] = len(out)
+        out += b'%d 0 obj\n' % object_id + objects[object_id] + b'\nendobj\n'
+    xref = len(out)
+    size = max(objects) + 1
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % size
+    for object_id in range(1, size):
+        out += b'%010d 00000 n \n' % offsets[object_id]
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, xref)
+    return bytes(out)
+
+
+def corpus_ids(n, seed=0, low=10_000_000, high=300_000_000):
+    '''n distinct corpus IDs as strings.'''
+    return [str(corpus_id) for corpus_id in random.Random(seed).sample(range(low, high), n)]
+
+
+def make_corpus(directory, n_papers=None, n_pages=8, lines_per_page=40, ids=None, seed=0):
+    '''
+    Writes one PDF per corpus ID to directory as <corpus ID>.pdf
+    :param ids: corpus IDs of the papers, n_papers random ones if None
+    :return: dictionary of corpus ID to PDF path
+    '''
+    os.makedirs(directory, exist_ok=True)
+    ids = corpus_ids(n_papers, seed=seed) if ids is None else ids
+    paths = {}
+    for corpus_id in ids:
+        paths[corpus_id] = os.path.join(directory, f'{corpus_id}.pdf')
+        with open(paths[corpus_id], 'wb') as f:
+            f.write(make_pdf(n_pages, lines_per_page, seed=int(corpus_id)))
+    return paths
+
+
+def make_work_units(test_ids, candidate_ids, n_candidates=5, seed=0):
+    '''simple_cid work units: (test set paper, ranked list of n_candidates retrieved corpus IDs) pairs.'''
+    rng = random.Random(seed)
+    return [(test_id, rng.sample(candidate_ids, n_candidates)) for test_id in test_ids]
+
+
+def make_devset(query_ids, candidate_ids, n_examples, positive_rate=0.12, seed=0):
+    '''(query ID, candidate ID, cites) triples shaped like the rows of test.qrel.cid.'''
+    rng = random.Random(seed)
+    return [(rng.choice(query_ids), rng.choice(candidate_ids), rng.random() < positive_rate) for _ in range(n_examples)]
@@ -0,0 +1,89 @@
+'''
+Journaled link manifest for download runs.
+
+Every test paper is appended to the manifest as soon as it is resolved, as `test_paper\tcorpusId`
+(corpusId left empty when every candidate was answered as not open access), and the line is flushed
+and fsynced before the next one is written. A test paper whose candidates failed with network or HTTP
+errors is not recorded. A crashed or interrupted run therefore keeps all linkage found so far, and
+`--resume` can skip the test papers already listed, or only the hits with `--retry-misses`.
+'''
+import os
+import threading
+from typing import Optional
+
+
+def load_manifest(path: str) -> dict:
+    '''
+    Reads a manifest into a dictionary mapping test paper to corpusId (None for a miss).
+    The first hit of a test paper is kept, a miss recorded after it never replaces it.
+    A torn last line left behind by a crash is ignored.
+    '''
+    resolved = {}
+    if not os.path.exists(path):
+        return resolved
+    with open(path, 'r') as f:
+        for line in f:
+            if not line.endswith('\n'):
+                break
+            temp = line.rstrip('\n').split('\t')
+            if len(temp) != 2 or not temp[0]:
+                continue
+            if resolved.get(temp[0]) is None:
+                resolved[temp[0]] = temp[1] or None
+    return resolved
+
+
+class LinkManifest:
+    '''
+    Append-only, fsynced journal of resolved test papers. Safe to share between threads.
+    :param path: manifest file location
+    :param fsync: fsync after each record, disable only when durability does not matter
+    '''
+
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._file = open(path, 'a+')
+        # terminate a line torn by a previous crash so the next record starts cleanly
+        if self._file.tell() > 0:
+            self._file.seek(self._file.tell() - 1)
+            if self._file.read(1) != '\n':
+                self._file.write('\n')
+
+    def record(self, test_set_paper: str, corpusId: Optional[str]) -> None:
+        line = f'{test_set_paper}\t{corpusId if corpusId is not None else ""}\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def merge_manifests(manifest_paths: list, link_recorder: str) -> int:
+    '''
+    Combines manifests, e.g. the per-shard manifests of a sharded run, into a link recorder in the
+    `test_paper\tcorpusId` format. When a test paper appears more than once the first hit wins.
+    :return: number of links written
+    '''
+    resolved = {}
+    for path in manifest_paths:
+        for k, v in load_manifest(path).items():
+            if resolved.get(k) is None:
+                resolved[k] = v
+    links = {k: v for k, v in resolved.items() if v is not None}
+    with open(link_recorder, 'w') as f:
+        for k, v in links.items():
+            f.write(f'{k}\t{v}\n')
+    return len(links)
+
+
+def write_link_recorder(manifest_path: str, link_recorder: str) -> int:
+    '''
+    Writes the hits of a manifest to a link recorder in the `test_paper\tcorpusId` format.
+    :return: number of links written
+    '''
+    return merge_manifests([manifest_path], link_recorder)
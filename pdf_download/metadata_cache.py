@@ -0,0 +1,117 @@
+'''
+Persistent Semantic Scholar metadata cache for CorpusIDs.
+
+Stores the fields `download_paper` needs (corpusId, paperId, isOpenAccess, openAccessPdf) in a
+SQLite file so re-runs and overlapping input files spend no API calls on papers already seen.
+IDs are resolved in bulk with the `/paper/batch` endpoint, which accepts up to 500 IDs per request.
+'''
+import sqlite3
+import threading
+import time
+from typing import Iterable, Optional
+
+from requests import Session
+
+METADATA_FIELDS = 'corpusId,paperId,isOpenAccess,openAccessPdf'
+BATCH_SIZE = 500
+
+
+class MetadataCache:
+    '''
+    SQLite-backed store of paper metadata with TTL-based invalidation.
+    :param path: location of the SQLite file
+    :param ttl: seconds after which an entry is considered stale and re-fetched
+    '''
+
+    def __init__(self, path: str, ttl: float = 30 * 24 * 3600):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS papers ('
+            ' corpus_id TEXT PRIMARY KEY,'
+            ' paper_id TEXT,'
+            ' is_open_access INTEGER,'
+            ' pdf_url TEXT,'
+            ' fetched_at REAL)'
+        )
+        self._conn.commit()
+
+    def get(self, c_id: str) -> Optional[dict]:
+        '''
+        Returns the cached metadata in the shape of a S2 API response, or None if unknown or stale.
+        Papers the API did not find are cached as closed access.
+        '''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT corpus_id, paper_id, is_open_access, pdf_url, fetched_at FROM papers WHERE corpus_id = ?',
+                (str(c_id),)
+            ).fetchone()
+        if row is None or time.time() - row[4] > self.ttl:
+            return None
+        corpus_id, paper_id, is_open_access, pdf_url, _ = row
+        return {
+            'corpusId': corpus_id,
+            'paperId': paper_id,
+            'isOpenAccess': bool(is_open_access),
+            'openAccessPdf': {'url': pdf_url} if pdf_url is not None else None,
+        }
+
+    def missing(self, c_ids: Iterable[str]) -> list:
+        '''Returns the IDs, in order and without duplicates, that have no fresh entry.'''
+        return [c_id for c_id in dict.fromkeys(str(c_id) for c_id in c_ids) if self.get(c_id) is None]
+
+    def put(self, c_id: str, paper: Optional[dict]) -> None:
+        self.put_many([(c_id, paper)])
+
+    def put_many(self, entries: Iterable[tuple]) -> None:
+        '''
+        Stores (corpus id, paper) pairs. A paper of None records that the API has no such paper.
+        '''
+        now = time.time()
+        rows = []
+        for c_id, paper in entries:
+            if paper is None:
+                rows.append((str(c_id), None, 0, None, now))
+            else:
+                pdf = paper.get('openAccessPdf')
+                rows.append((str(c_id), paper.get('paperId'), int(bool(paper.get('isOpenAccess'))),
+                             pdf['url'] if pdf else None, now))
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO papers VALUES (?, ?, ?, ?, ?)', rows)
+            self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def get_papers_batch(session: Session, c_ids: list, api_url: str, api_key: str, fields: str = METADATA_FIELDS) -> list:
+    '''
+    Fetches metadata for up to BATCH_SIZE CorpusIDs in one request.
+    :return: list aligned with c_ids, None where the API does not know the paper
+    '''
+    headers = {
+        'X-API-KEY': api_key,
+    }
+    with session.post(f'{api_url}/paper/batch', params={'fields': fields},
+                      json={'ids': [f'CorpusID:{c_id}' for c_id in c_ids]}, headers=headers) as response:
+        response.raise_for_status()
+        return response.json()
+
+
+def resolve_papers(session: Session, cache: MetadataCache, c_ids: Iterable[str], api_url: str, api_key: str,
+                   batch_size: int = BATCH_SIZE, api_limiter=None) -> int:
+    '''
+    Makes sure every ID in c_ids has a fresh cache entry, fetching unknown ones in bulk.
+    :param api_limiter: optional rate limiter with an `acquire()` method, called once per request
+    :return: number of IDs fetched from the API
+    '''
+    todo = cache.missing(c_ids)
+    for start in range(0, len(todo), batch_size):
+        batch = todo[start:start + batch_size]
+        if api_limiter is not None:
+            api_limiter.acquire()
+        papers = get_papers_batch(session, batch, api_url, api_key)
+        cache.put_many(zip(batch, papers))
+    return len(todo)
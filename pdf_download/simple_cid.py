@@ -3,15 +3,93 @@ import dotenv
 dotenv.load_dotenv()
 
 import argparse
+import math
 import os
+import sys
+import threading
 import time
-from requests import Session
-from typing import Generator, Union
+import zlib
+from collections.abc import Mapping
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+from requests import HTTPError, Session
+from typing import Callable, Generator, Iterable, Optional, Union
 
 import urllib3
+from manifest import LinkManifest, load_manifest, merge_manifests, write_link_recorder
+from metadata_cache import BATCH_SIZE, METADATA_FIELDS, MetadataCache, resolve_papers
+# metrics.py is shared with the pdf_processor scripts, appended so it never shadows a module of this folder
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'pdf_processor'))
+import metrics
 urllib3.disable_warnings()
 
-S2_API_KEY = os.environ['S2_API_KEY']
+# optional, requests leaves out the X-API-KEY header when it is None (unauthenticated rate limits)
+S2_API_KEY = os.environ.get('S2_API_KEY')
+# point this at a local fake server to exercise the downloader offline
+S2_API_URL = os.environ.get('S2_API_URL', 'https://api.semanticscholar.org/graph/v1')
+PDF_MAGIC = b'%PDF'
+
+
+class DownloadCancelled(Exception):
+    '''Raised when a download is abandoned because another candidate already won.'''
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket limiting how often the Semantic Scholar API is hit.
+    :param rate: tokens added per second
+    :param capacity: maximum burst size
+    '''
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_time = (1 - self._tokens) / self.rate
+            time.sleep(wait_time)
+
+
+class HostLimiter:
+    '''
+    Caps the number of simultaneous connections opened to any single PDF host.
+    :param per_host: maximum concurrent downloads per host name
+    '''
+
+    def __init__(self, per_host: int = 2):
+        self.per_host = per_host
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[host]
+
+
+# one lock per target file so two test papers sharing a candidate never write the same part file
+_path_locks = {}
+_path_locks_lock = threading.Lock()
+
+
+def _path_lock(path: str) -> threading.Lock:
+    with _path_locks_lock:
+        if path not in _path_locks:
+            _path_locks[path] = threading.Lock()
+        return _path_locks[path]
 
 
 def get_paper(session: Session, c_id: str, fields: str = 'paperId,title', **kwargs) -> dict:
@@ -23,36 +101,161 @@ def get_paper(session: Session, c_id: str, fields: str = 'paperId,title', **kwar
         'X-API-KEY': S2_API_KEY,
     }
 
-    with session.get(f'https://api.semanticscholar.org/graph/v1/paper/CorpusID:{c_id}', params=params, headers=headers) as response:
+    with metrics.timer('api_call', service='s2_paper'), \
+            session.get(f'{S2_API_URL}/paper/CorpusID:{c_id}', params=params, headers=headers) as response:
         response.raise_for_status()
+        metrics.count('api_calls', service='s2_paper')
         return response.json()
 
 
-def download_pdf(session: Session, url: str, path: str, user_agent: str = 'requests/2.0.0'):
-    # send a user-agent to avoid server error
+def is_complete_pdf(path: str, expected_size: Optional[int] = None) -> bool:
+    '''
+    The one completeness rule for cached and freshly downloaded PDFs: the `%PDF` magic, and either the size
+    the server announced or an `%%EOF` marker near the end, which truncated files lack. A download that is
+    complete by its Content-Length but has no marker there (e.g. trailing bytes after `%%EOF`) has that
+    length recorded in `<path>.length`, so later runs take it as complete too.
+    :param expected_size: size announced by the server, read from `<path>.length` if None
+    '''
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if f.read(len(PDF_MAGIC)) != PDF_MAGIC:
+                return False
+            if expected_size is None and os.path.exists(path + '.length'):
+                with open(path + '.length') as length_file:
+                    expected_size = int(length_file.read().strip() or -1)
+            if expected_size is not None:
+                return size == expected_size
+            f.seek(max(size - 2048, 0))
+            return b'%%EOF' in f.read()
+    except (OSError, ValueError):
+        return False
+
+
+def download_pdf(session: Session, url: str, path: str, user_agent: str = 'requests/2.0.0',
+                 should_stop: Optional[Callable[[], bool]] = None) -> int:
+    '''
+    Downloads a PDF to `path` through a `.part` temp file that is renamed into place once complete.
+    A `.part` file left behind by an interrupted run is resumed with an HTTP Range request.
+    :return: number of bytes transferred
+    '''
+    part_path = path + '.part'
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+
+    # send a user-agent to avoid server error; PDFs are compressed already, and ask for them unencoded
+    # so that Content-Length and Range offsets count the bytes written to the part file
     headers = {
         'user-agent': user_agent,
+        'accept-encoding': 'identity',
     }
+    if offset:
+        headers['range'] = f'bytes={offset}-'
 
+    n_bytes = 0
+    expected = None
+    encoded_expected = None
     # stream the response to avoid downloading the entire file into memory
     with session.get(url, headers=headers, stream=True, verify=False) as response:
-        # check if the request was successful
-        response.raise_for_status()
+        # a 416 on a resumed download means the part file already holds the whole document
+        if offset and response.status_code == 416:
+            # `bytes */<size>`, the size of the whole document
+            total = response.headers.get('content-range', '').rpartition('/')[2]
+            expected = int(total) if total.isdigit() else None
+        else:
+            # check if the request was successful
+            response.raise_for_status()
 
-        if response.headers['content-type'] != 'application/pdf':
-            raise Exception('The response is not a pdf')
+            if response.headers['content-type'] != 'application/pdf':
+                raise Exception('The response is not a pdf')
 
-        with open(path, 'wb') as f:
-            # write the response to the file, chunk_size bytes at a time
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
+            # iter_content decodes a Content-Encoding, the part file then holds more bytes than were sent
+            encoded = response.headers.get('content-encoding', 'identity') != 'identity'
+            if response.status_code != 206:
+                # the server ignored the range, start over
+                offset = 0
+            elif encoded:
+                # the range counts encoded bytes, it does not line up with the decoded part file
+                os.remove(part_path)
+                raise Exception('Encoded partial response, the download starts over')
+            if 'content-length' in response.headers:
+                if encoded:
+                    encoded_expected = int(response.headers['content-length'])
+                else:
+                    expected = offset + int(response.headers['content-length'])
 
+            cancelled = False
+            with open(part_path, 'ab' if offset else 'wb') as f:
+                # write the response to the file, chunk_size bytes at a time
+                for chunk in response.iter_content(chunk_size=8192):
+                    if should_stop is not None and should_stop():
+                        cancelled = True
+                        break
+                    f.write(chunk)
+                    n_bytes += len(chunk)
+
+            if cancelled:
+                # another candidate won while we were streaming, discard the partial file
+                os.remove(part_path)
+                raise DownloadCancelled(url)
+
+            if encoded_expected is not None:
+                received = response.raw.tell()
+                if received < encoded_expected:
+                    # the part file holds the first bytes of the document decoded, they are resumed unencoded
+                    raise Exception(f'Incomplete download: {received} of {encoded_expected} encoded bytes')
+                # the whole encoded body arrived, so the decoded file is the whole document
+                expected = os.path.getsize(part_path)
+
+    size = os.path.getsize(part_path)
+    if expected is not None and size < expected:
+        # keep the part file so the next attempt resumes where this one stopped
+        raise Exception(f'Incomplete download: {size} of {expected} bytes')
+    if expected is not None and size > expected:
+        # e.g. a resumed part that no longer matches the document, resuming it again would only get a 416
+        os.remove(part_path)
+        raise Exception(f'Size mismatch: {size} bytes where the server announced {expected}')
+    with open(part_path, 'rb') as f:
+        if f.read(len(PDF_MAGIC)) != PDF_MAGIC:
+            os.remove(part_path)
+            raise Exception('The response is not a pdf')
+    if not is_complete_pdf(part_path, expected):
+        # no Content-Length and no end marker, the stream stopped early; keep the part file to resume it
+        raise Exception(f'Incomplete download: no %%EOF marker in {size} bytes')
+    if expected is not None and not is_complete_pdf(part_path):
+        # complete by its length only, record it so the cache check agrees with this one
+        with open(path + '.length', 'w') as f:
+            f.write(str(expected))
+    elif os.path.exists(path + '.length'):
+        os.remove(path + '.length')
+    os.replace(part_path, path)
+    metrics.count('bytes', n_bytes, stage='pdf_download')
+    return n_bytes
 
-def download_paper(session: Session, c_id: str, directory: str = 'retrieved_papers', user_agent: str = 'requests/2.0.0') -> Union[str, None]:
-    paper = get_paper(session, c_id, fields='corpusId,paperId,isOpenAccess,openAccessPdf')
+
+def download_paper(session: Session, c_id: str, directory: str = 'retrieved_papers', user_agent: str = 'requests/2.0.0',
+                   api_limiter: Optional[TokenBucket] = None, host_limiter: Optional[HostLimiter] = None,
+                   should_stop: Optional[Callable[[], bool]] = None, stats: Optional[dict] = None,
+                   cache: Optional[MetadataCache] = None) -> Union[str, None]:
+    # known papers, including closed-access ones, are answered without an API call
+    paper = cache.get(c_id) if cache is not None else None
+    if cache is not None:
+        metrics.count('cache_hits' if paper is not None else 'cache_misses', cache='s2_metadata')
+    if paper is None:
+        if api_limiter is not None:
+            with metrics.timer('rate_limit_wait', limiter='s2_api'):
+                api_limiter.acquire()
+        try:
+            paper = get_paper(session, c_id, fields=METADATA_FIELDS)
+        except HTTPError as e:
+            # the API does not know the paper, a definitive answer unlike other errors
+            if e.response is None or e.response.status_code != 404:
+                raise
+            paper = None
+        if cache is not None:
+            cache.put(c_id, paper)
 
     # check if the paper is open access
-    if not paper['isOpenAccess']:
+    if paper is None or not paper['isOpenAccess']:
         return None
 
     if paper['openAccessPdf'] is None:
@@ -66,49 +269,334 @@ def download_paper(session: Session, c_id: str, directory: str = 'retrieved_pape
     os.makedirs(directory, exist_ok=True)
 
     # check if the pdf has already been downloaded
-    if not os.path.exists(pdf_path):
-        download_pdf(session, pdf_url, pdf_path, user_agent=user_agent)
+    with _path_lock(pdf_path):
+        if not is_complete_pdf(pdf_path):
+            if os.path.exists(pdf_path):
+                # truncated file from an older run, resume it as a part file
+                os.replace(pdf_path, pdf_path + '.part')
+                if os.path.exists(pdf_path + '.length'):
+                    os.remove(pdf_path + '.length')
+            if should_stop is not None and should_stop():
+                raise DownloadCancelled(pdf_url)
+            with metrics.span('pdf_download', corpus_id=str(corpusId), url=pdf_url):
+                if host_limiter is None:
+                    n_bytes = download_pdf(session, pdf_url, pdf_path, user_agent=user_agent, should_stop=should_stop)
+                else:
+                    with host_limiter(pdf_url):
+                        n_bytes = download_pdf(session, pdf_url, pdf_path, user_agent=user_agent, should_stop=should_stop)
+            if stats is not None:
+                stats['bytes'] += n_bytes
 
     return pdf_path, corpusId
 
 
-def download_papers(retrieved_dict, directory: str = 'retrieved_papers', user_agent: str = 'requests/2.0.0') -> Generator[tuple[str, Union[str, None, Exception]], None, None]:
+def shard_of(test_set_paper: str, num_shards: int) -> int:
+    '''Stable shard assignment, identical across processes and machines.'''
+    return zlib.crc32(test_set_paper.encode('utf-8')) % num_shards
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    '''Parses a `i/N` shard specification, 0 <= i < N.'''
+    index, num_shards = (int(x) for x in value.split('/'))
+    if not 0 <= index < num_shards:
+        raise argparse.ArgumentTypeError(f'shard index must be in [0, {num_shards}), got {value}')
+    return index, num_shards
+
+
+def read_work_units(input_file: str, shard: Optional[tuple[int, int]] = None,
+                    skip: Optional[Mapping] = None) -> Generator[tuple[str, list], None, None]:
+    '''
+    Streams (test set paper, retrieved papers) work units from a tab-separated retrieval file.
+
+    Consecutive rows of the same test paper are grouped and yielded as soon as the next test paper
+    starts, so the file is never held in memory. Rows with a score of 1.000000 are the test paper
+    itself and are skipped.
+    :param shard: (i, N) to only yield the test papers assigned to shard i of N
+    :param skip: test papers to leave out, e.g. those already resolved in a manifest
+    '''
+    current, retrieved = None, []
+    with open(input_file, 'r') as f:
+        for line in f:
+            temp = line.split('\t')
+            score = temp[0]
+            if score == '1.000000':
+                continue
+            test_set_paper = temp[1].strip()
+            if test_set_paper != current:
+                if retrieved:
+                    yield current, retrieved
+                current, retrieved = test_set_paper, []
+                if shard is not None and shard_of(test_set_paper, shard[1]) != shard[0]:
+                    current = None
+                    continue
+                if skip is not None and test_set_paper in skip:
+                    current = None
+                    continue
+            if current is not None:
+                retrieved.append(temp[2].strip())
+    if retrieved:
+        yield current, retrieved
+
+
+def prefetch_metadata(work_units: Iterable[tuple], session: Session, cache: Optional[MetadataCache],
+                      batch_size: int = BATCH_SIZE, api_limiter: Optional[TokenBucket] = None) -> Generator[tuple, None, None]:
+    '''
+    Passes (test set paper, candidates) work units through, resolving the metadata of their
+    candidates in bulk a window of about `batch_size` IDs ahead of the consumer.
+    '''
+    if cache is None:
+        yield from work_units
+        return
+
+    def resolve(window):
+        try:
+            with metrics.timer('metadata_prefetch'):
+                fetched = resolve_papers(session, cache, (c_id for _, candidates in window for c_id in candidates),
+                                         S2_API_URL, S2_API_KEY, batch_size=batch_size, api_limiter=api_limiter)
+            metrics.count('api_calls', math.ceil(fetched / batch_size), service='s2_batch')
+        except Exception as e:
+            # fall back to one metadata request per candidate for this window
+            print(f'Batch metadata lookup failed: {e}')
+
+    window, n_ids = [], 0
+    for unit in work_units:
+        window.append(unit)
+        n_ids += len(unit[1])
+        if n_ids >= batch_size:
+            resolve(window)
+            yield from window
+            window, n_ids = [], 0
+    if window:
+        resolve(window)
+        yield from window
+
+
+def record_outcome(manifest: Optional[LinkManifest], test_set_paper: str, corpusId: Optional[str],
+                   error: Optional[Exception]) -> None:
+    '''
+    Counts and journals the outcome of a test paper. A miss is only recorded when every candidate was
+    answered as not open access: after a candidate failed with a network or HTTP error nothing is
+    recorded, so the test paper is tried again by `--resume`.
+    :param error: last error of a candidate, None if every candidate was answered
+    '''
+    if corpusId is None and error is not None:
+        metrics.count('test_papers', status='failed')
+        print(f"Not recording '{test_set_paper}', a candidate failed: {error}")
+        return
+    metrics.count('test_papers', status='resolved' if corpusId is not None else 'unresolved')
+    if manifest is not None:
+        manifest.record(test_set_paper, corpusId)
+
+
+def download_papers(retrieved_dict, directory: str = 'retrieved_papers', user_agent: str = 'requests/2.0.0',
+                    cache: Optional[MetadataCache] = None, manifest: Optional[LinkManifest] = None) -> Generator[tuple[str, Union[str, None, Exception]], None, None]:
     # use a session to reuse the same TCP connection
     link_dict = {}
     with Session() as session:
-        for test_set_paper, retrieved_paper in retrieved_dict.items():
+        work_units = retrieved_dict.items() if isinstance(retrieved_dict, Mapping) else retrieved_dict
+        for test_set_paper, retrieved_paper in prefetch_metadata(work_units, session, cache):
+            error = None
             for c_id in retrieved_paper:
                 try:
-                    pdf_path, corpusId = download_paper(session, c_id, directory=directory, user_agent=user_agent)
-                    if pdf_path:
-                        link_dict[test_set_paper] = corpusId
-                        print(f"Downloaded '{corpusId}' to '{pdf_path}'")
-                        break
+                    with metrics.span('candidate', test_set_paper=test_set_paper, corpus_id=c_id):
+                        result = download_paper(session, c_id, directory=directory, user_agent=user_agent, cache=cache)
                 except Exception as e:
+                    error = e
                     continue
+                # None when the candidate is not open access
+                if result is not None:
+                    pdf_path, corpusId = result
+                    link_dict[test_set_paper] = corpusId
+                    print(f"Downloaded '{corpusId}' to '{pdf_path}'")
+                    break
+            record_outcome(manifest, test_set_paper, link_dict.get(test_set_paper), error)
     return link_dict
-  
+
+
+class _TestPaperRace:
+    '''
+    Tracks the candidates of one test paper while they are resolved concurrently.
+
+    The winner is the lowest-ranked candidate that yields a PDF, which is the same paper
+    the serial loop in `download_papers` would pick. Once a candidate lands, every
+    higher-ranked candidate still in flight is told to stop.
+    '''
+
+    def __init__(self, test_set_paper: str, candidates: list):
+        self.test_set_paper = test_set_paper
+        self.candidates = candidates
+        self.next_rank = 0
+        self.in_flight = set()
+        self.best_rank = None
+        self.corpusId = None
+        self.error = None
+        self.recorded = False
+
+    def beaten(self, rank: int) -> bool:
+        return self.best_rank is not None and self.best_rank < rank
+
+    def done(self) -> bool:
+        if self.best_rank is not None:
+            return not any(rank < self.best_rank for rank in self.in_flight)
+        return not self.in_flight and self.next_rank >= len(self.candidates)
+
+
+def download_papers_concurrent(retrieved_dict, directory: str = 'retrieved_papers', user_agent: str = 'requests/2.0.0',
+                               workers: int = 8, api_rate: float = 1.0, api_burst: int = 1, per_host: int = 2,
+                               lookahead: int = 1, cache: Optional[MetadataCache] = None,
+                               manifest: Optional[LinkManifest] = None) -> dict:
+    '''
+    Concurrent version of `download_papers`. Like it, accepts a dictionary of test set paper to
+    retrieved papers or an iterable of such pairs, which is consumed lazily.
+
+    Test papers are processed in parallel by a pool of `workers` threads. Within a test paper up
+    to `lookahead` candidates are resolved at once; the first open-access hit in candidate order
+    still wins, and in-flight work on later candidates is abandoned as soon as it lands.
+    :param api_rate: Semantic Scholar API requests per second shared by all workers
+    :param api_burst: token bucket capacity for the API limiter
+    :param per_host: maximum simultaneous downloads from any single PDF host
+    :param lookahead: number of candidates of the same test paper resolved speculatively
+    :param cache: metadata cache consulted before the API, filled in bulk ahead of the workers
+    :param manifest: journal each test paper is recorded to as soon as it is resolved
+    :return: dictionary mapping test set paper to the corpusId of the downloaded paper
+    '''
+    api_limiter = TokenBucket(api_rate, api_burst)
+    host_limiter = HostLimiter(per_host)
+    stats = {'bytes': 0}
+    stats_lock = threading.Lock()
+    local = threading.local()
+    sessions = []
+
+    def get_session() -> Session:
+        if not hasattr(local, 'session'):
+            local.session = Session()
+            sessions.append(local.session)
+        return local.session
+
+    def resolve(race: _TestPaperRace, rank: int):
+        if race.beaten(rank):
+            raise DownloadCancelled(race.candidates[rank])
+        paper_stats = {'bytes': 0}
+        try:
+            with metrics.span('candidate', test_set_paper=race.test_set_paper, corpus_id=race.candidates[rank], rank=rank):
+                return download_paper(get_session(), race.candidates[rank], directory=directory, user_agent=user_agent,
+                                      api_limiter=api_limiter, host_limiter=host_limiter,
+                                      should_stop=lambda: race.beaten(rank), stats=paper_stats, cache=cache)
+        finally:
+            with stats_lock:
+                stats['bytes'] += paper_stats['bytes']
+
+    link_dict = {}
+    prefetch_session = Session()
+    work_units = retrieved_dict.items() if isinstance(retrieved_dict, Mapping) else retrieved_dict
+    work_units = prefetch_metadata(work_units, prefetch_session, cache, api_limiter=api_limiter)
+    futures = {}
+    max_in_flight = workers * 2
+    start = time.time()
+
+    def submit_next(race: _TestPaperRace) -> None:
+        while len(race.in_flight) < lookahead and race.next_rank < len(race.candidates) and race.best_rank is None:
+            rank = race.next_rank
+            race.next_rank += 1
+            race.in_flight.add(rank)
+            futures[executor.submit(resolve, race, rank)] = (race, rank)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        exhausted = False
+        while True:
+            # admit new test papers while there is room in the pipeline
+            while not exhausted and len(futures) < max_in_flight:
+                try:
+                    test_set_paper, retrieved_paper = next(work_units)
+                except StopIteration:
+                    exhausted = True
+                    break
+                submit_next(_TestPaperRace(test_set_paper, list(retrieved_paper)))
+            if not futures:
+                break
+
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                race, rank = futures.pop(future)
+                race.in_flight.discard(rank)
+                try:
+                    result = future.result()
+                    if result is not None and not race.beaten(rank):
+                        pdf_path, corpusId = result
+                        race.best_rank = rank
+                        race.corpusId = corpusId
+                        print(f"Downloaded '{corpusId}' to '{pdf_path}'")
+                        # drop queued candidates that can no longer win
+                        for other, (other_race, other_rank) in list(futures.items()):
+                            if other_race is race and other_rank > rank and other.cancel():
+                                futures.pop(other)
+                                race.in_flight.discard(other_rank)
+                except DownloadCancelled:
+                    pass
+                except Exception as e:
+                    race.error = e
+
+                if race.done():
+                    if not race.recorded:
+                        race.recorded = True
+                        if race.corpusId is not None:
+                            link_dict[race.test_set_paper] = race.corpusId
+                        record_outcome(manifest, race.test_set_paper, race.corpusId, race.error)
+                else:
+                    submit_next(race)
+
+    prefetch_session.close()
+    for session in sessions:
+        session.close()
+
+    elapsed = max(time.time() - start, 1e-9)
+    print(f'Resolved {len(link_dict)} papers in {elapsed:.1f}s: '
+          f'{len(link_dict) / elapsed:.2f} papers/s, {stats["bytes"] / 1e6 / elapsed:.2f} MB/s')
+    return link_dict
+
 
 def main(args: argparse.Namespace) -> None:
     start = time.time()
-    retrieved_dict = {}
-    with open (args.input_file, 'r') as input_file:
-        for line in input_file:
-            temp = line.split('\t')
-            score = temp[0]
-            if score != '1.000000':
-                test_set_paper = temp[1].strip()
-                retrieved_paper = temp[2].strip()
-                if test_set_paper not in retrieved_dict:
-                    retrieved_dict[test_set_paper] = []
-                retrieved_dict[test_set_paper].append(retrieved_paper)
-
-    print("Loaded retrieved_dict.", time.time() - start)
-    link_dict = download_papers(retrieved_dict, directory=args.directory, user_agent=args.user_agent)
+    metrics.configure(jsonl=args.metrics_jsonl or None, prometheus=args.metrics_prom or None)
+    if args.merge:
+        n_links = merge_manifests(args.merge, args.link_recorder)
+        print(f'Merged {len(args.merge)} manifests into {n_links} links.', time.time() - start)
+        return
+
+    if args.manifest:
+        manifest_path = args.manifest
+    elif args.shard is not None:
+        manifest_path = f'{args.link_recorder}.{args.shard[0]}-of-{args.shard[1]}.manifest'
+    else:
+        manifest_path = args.link_recorder + '.manifest'
+    resolved = None
+    if args.resume:
+        resolved = load_manifest(manifest_path)
+        if args.retry_misses:
+            resolved = {k: v for k, v in resolved.items() if v is not None}
+        print(f'Resuming, skipping {len(resolved)} test papers already in {manifest_path}')
+    work_units = read_work_units(args.input_file, shard=args.shard, skip=resolved)
+
+    manifest = LinkManifest(manifest_path)
+    cache = MetadataCache(args.metadata_cache, ttl=args.metadata_ttl * 24 * 3600) if args.metadata_cache else None
+    try:
+        if args.workers > 1:
+            download_papers_concurrent(work_units, directory=args.directory, user_agent=args.user_agent,
+                                       workers=args.workers, api_rate=args.api_rate, api_burst=args.api_burst,
+                                       per_host=args.per_host, lookahead=args.lookahead, cache=cache, manifest=manifest)
+        else:
+            download_papers(work_units, directory=args.directory, user_agent=args.user_agent, cache=cache, manifest=manifest)
+    finally:
+        manifest.close()
+        if cache is not None:
+            cache.close()
     print("Downloaded the papers.", time.time() - start)
-    with open(args.link_recorder, 'a') as f:
-        for k, v in link_dict.items():
-            f.write(f'{k}\t{v}\n')
+    if args.shard is not None:
+        # the shards share --link-recorder, it is written once by merging their manifests
+        print(f'Shard done, its links are in {manifest_path}. Once every shard is done, write the link recorder with '
+              f'--merge {args.link_recorder}.*-of-{args.shard[1]}.manifest -l {args.link_recorder}')
+        return
+    write_link_recorder(manifest_path, args.link_recorder)
     print("Created the link tracker.", time.time() - start)
 
 if __name__ == '__main__':
@@ -116,7 +604,25 @@ if __name__ == '__main__':
     parser.add_argument('--directory', '-d', default='retrieved_papers')
     parser.add_argument('--user-agent', '-u', default='requests/2.0.0')
     parser.add_argument('--input-file', '-i', type=str, default='')
-    parser.add_argument('--link-recorder', '-l', type=str, default='')
+    parser.add_argument('--link-recorder', '-l', type=str, default='', help='written from the manifest once the run finishes, or by --merge after a sharded run')
+    parser.add_argument('--workers', '-w', type=int, default=1, help='number of download threads, 1 keeps the serial loop')
+    parser.add_argument('--api-rate', type=float, default=1.0, help='Semantic Scholar API requests per second')
+    parser.add_argument('--api-burst', type=int, default=1, help='burst size of the API rate limiter')
+    parser.add_argument('--per-host', type=int, default=2, help='maximum concurrent downloads per PDF host')
+    parser.add_argument('--lookahead', type=int, default=1, help='candidates of one test paper resolved at once')
+    parser.add_argument('--metadata-cache', '-m', type=str, default='s2_metadata.sqlite', help='SQLite metadata cache, empty string disables it')
+    parser.add_argument('--metadata-ttl', type=float, default=30, help='days before a cached metadata entry is re-fetched')
+    parser.add_argument('--manifest', type=str, default='', help='journal of resolved test papers (default: <link-recorder>.manifest)')
+    parser.add_argument('--resume', action='store_true', help='skip test papers already resolved in the manifest')
+    parser.add_argument('--retry-misses', action='store_true',
+                        help='with --resume, only skip the hits and try the test papers recorded as misses again')
+    parser.add_argument('--shard', type=parse_shard, default=None, help='i/N, only process the test papers hashed to shard i of N')
+    parser.add_argument('--merge', nargs='+', metavar='MANIFEST', default=None,
+                        help='merge these manifests into --link-recorder and exit')
+    parser.add_argument('--metrics-jsonl', type=str, default=os.environ.get(metrics.JSONL_ENV, ''),
+                        help='JSON-lines file of spans and totals, see pdf_processor/metrics.py (default: $PIPELINE_METRICS_JSONL, none)')
+    parser.add_argument('--metrics-prom', type=str, default=os.environ.get(metrics.PROMETHEUS_ENV, ''),
+                        help='Prometheus textfile of counters and timers (default: $PIPELINE_METRICS_PROM, none)')
     # parser.add_argument('paper_ids', nargs='+', default=[])
     args = parser.parse_args()
     main(args)
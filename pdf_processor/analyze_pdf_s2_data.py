@@ -1,5 +1,5 @@
 '''
-This file tries to establish all the relationships between query, candidate papers and the retrieved papers, and the 
+This file tries to establish all the relationships between query, candidate papers and the retrieved papers, and the
 classification of the papers. The goal is to create a matrix where the rows are candidate papers, the columns are
 retrieved papers, and the values are 1 if the candidate paper cites the retrieved paper, and 0 otherwise.
 Also, the classification of the papers is used to find the classification of the query and candidate papers
@@ -11,150 +11,243 @@ retrieved_papers: The papers that are retrieved by the candidate papers
 link-recorder-final-1: The data that contains the relationships between candidate papers and retrieved papers
 test.qrel.cid: The data that contains the test relationships between query papers and candidate papers
 classification_meta: The classification of the papers in the test set
+
+Every step is a join or a groupby rather than a scan per paper:
+    - file existence comes from one directory listing per folder
+    - labels are looked up in a corpus_id-indexed table built once from classification_meta
+    - per-query statistics come from one groupby over the valid pairs
+    - the citation matrix is a sparse CSR matrix built from the ID columns, see citation_matrix.py, and its row
+      statistics come from its index pointers
+The citation matrix is saved as candidate_retrieved_citation_matrix.npz with row and column ID sidecars, the dense
+labeled CSV of the original script is only written with --dense_csv.
+
+Usage:
+    python pdf_processor/analyze_pdf_s2_data.py                      # reads and writes darwin/
+    python pdf_processor/analyze_pdf_s2_data.py darwin --dense_csv   # also writes candidate_retrieved_citation_matrix.csv
+    from analyze_pdf_s2_data import analyze; results = analyze('darwin', verbose=False)
 '''
 import pandas as pd
 import numpy as np
 import os
 import json
-
-# Load the data
-candidate_retrieved_data = pd.read_csv('darwin/link-recorder-final-1', sep='\t', header=None, names=['candidate_paper', 'retrieved_paper'])
-query_candidate_data = pd.read_csv('darwin/test.qrel.cid', sep=' ', header=None, names=['query', 'candidate', 'bool'])
-
-# Load the classification meta data
-with open('darwin/classification_meta.jsonl') as f:
-    classification_meta = [json.loads(line) for line in f]
-
-valid_rows = pd.DataFrame()
-query_dir = 'darwin/query_papers'
-candidate_dir = 'darwin/candidate_papers'
-# Iterate over the rows of the data
-for _, row in query_candidate_data.iterrows():
-    query_file = os.path.join(query_dir, str(row['query']) + '.pdf')
-    candidate_file = os.path.join(candidate_dir, str(row['candidate']) + '.pdf')
-
-    # Check if both files exist
-    if os.path.isfile(query_file) and os.path.isfile(candidate_file):
-        # If both files exist, append the row to valid_rows
-        valid_rows = valid_rows._append(row)
-        
-# See what papers in retrieved papers are in link-recorder-final-1 candidate rows
-
-
-# Reset the index of valid_rows
-valid_rows.reset_index(drop=True, inplace=True)
-print(valid_rows.head())
-print(f'Number of query candidate pairs with valid files: {len(valid_rows)}')
-
-# unique query papers
-unique_query_papers = valid_rows['query'].unique()
-print(f'Number of unique query papers: {len(unique_query_papers)}')
-
-# This is the number of query papers in valid_rows that appears more than once 
-
-query_paper_counts = valid_rows['query'].value_counts()
-print(query_paper_counts)
-print(f'Number of query papers with exactly one candidate paper: {query_paper_counts[query_paper_counts == 1].count()}')
-print(f'Number of query papers with more than one candidate papers: {query_paper_counts[query_paper_counts > 1].count()}')
-
-# for each query paper with more than one candidate papers what is the sum of their boolean values
-for query_paper in query_paper_counts[query_paper_counts > 1].index:
-    print(f'{query_paper=}, {valid_rows[valid_rows["query"] == query_paper]["bool"].sum()/len(valid_rows[valid_rows["query"] == query_paper]):.2%} ({valid_rows[valid_rows["query"] == query_paper]["bool"].sum()}) of {len(valid_rows[valid_rows["query"] == query_paper])} candidates are positive')
-# print(f'the sum of boolean values for each query_papers_with_multiple_candidates: {valid_rows[valid_rows["query"].isin(query_paper_counts[query_paper_counts > 1].index)]["bool"].sum()}')
-
-# for each unique valid query paper, which one has no positive candidate papers
-num_no_positive_candidate_papers = 0
-for query_paper in unique_query_papers:
-    sum_bool = valid_rows[valid_rows["query"] == query_paper]["bool"].sum()
-    if sum_bool == 0:
-        print(f'{query_paper=} has no positive candidate papers')
-        num_no_positive_candidate_papers += 1
-print(f'Number of query papers with no positive candidate papers: {num_no_positive_candidate_papers}')
-        # print(f'{query_paper=}, {sum_bool=}, {len(valid_rows[valid_rows["query"] == query_paper])}')
-
-valid_rows.to_csv('darwin/valid_query_candidate_pairs.csv', index=False)
+from citation_matrix import build_citation_matrix, row_statistics, save_citation_matrix
 
 classification_labels=[(0, 'Agricultural and Food sciences'), (1, 'Art'), (2, 'Biology'), (3, 'Business'), (4, 'Chemistry'), (5, 'Computer science'), (6, 'Economics'), (7, 'Education'), (8, 'Engineering'), (9, 'Environmental science'), (11, 'Geology'), (12, 'History'), (13, 'Law'), (14, 'Linguistics'), (15, 'Materials science'), (16, 'Mathematics'), (17, 'Medicine'), (18, 'Philosophy'), (19, 'Physics'), (20, 'Political science'), (21, 'Psychology'), (22, 'Sociology')]
 
-# Go through each valid query paper and find the classification
-found_classifications = []
-print("Processing query papers and their candidate papers classification")
-for query_paper in unique_query_papers:
-    # print(f'Processing query paper: {query_paper} for classification task')
-    # Find the classification of the query paper
-    query_classification = [meta['labels'] for meta in classification_meta if meta['corpus_id'] == query_paper]
-    if len(query_classification) != 0:
-        print('Processing query paper: {query_paper} for classification task')
-        print(f'{query_paper=}, {query_classification=}')
-
-        # Find the candidate papers that are related to the query paper
-        related_candidates = valid_rows[valid_rows['query'] == query_paper]['candidate'].tolist()
-        print(f'{related_candidates=}')
+
+def load_data(data_dir='darwin'):
+    '''
+    Loads the link recorder, the query/candidate relevance data and the classification meta data
+    :param data_dir: directory with link-recorder-final-1, test.qrel.cid and classification_meta.jsonl
+    :return: candidate_retrieved_data, query_candidate_data, classification_meta
+    '''
+    candidate_retrieved_data = pd.read_csv(os.path.join(data_dir, 'link-recorder-final-1'), sep='\t', header=None, names=['candidate_paper', 'retrieved_paper'])
+    query_candidate_data = pd.read_csv(os.path.join(data_dir, 'test.qrel.cid'), sep=' ', header=None, names=['query', 'candidate', 'bool'])
+
+    # Load the classification meta data
+    with open(os.path.join(data_dir, 'classification_meta.jsonl')) as f:
+        classification_meta = [json.loads(line) for line in f]
+    return candidate_retrieved_data, query_candidate_data, classification_meta
+
+
+def label_table(classification_meta):
+    '''
+    Indexes the labels of classification_meta by corpus_id, the first entry of a corpus_id wins as in a linear scan
+    :return: dict of corpus_id to labels
+    '''
+    labels = {}
+    for meta in classification_meta:
+        labels.setdefault(meta['corpus_id'], meta['labels'])
+    return labels
+
+
+def pdf_ids(directory):
+    '''Corpus ids of the <id>.pdf files in directory, from one listing of it.'''
+    if not os.path.isdir(directory):
+        return set()
+    with os.scandir(directory) as entries:
+        return {entry.name[:-len('.pdf')] for entry in entries if entry.name.endswith('.pdf') and entry.is_file()}
+
+
+def find_valid_rows(query_candidate_data, query_dir, candidate_dir):
+    '''Query/candidate pairs whose two pdfs exist, in their original order with a fresh index.'''
+    query_ids = pdf_ids(query_dir)
+    candidate_ids = pdf_ids(candidate_dir)
+    exists = (query_candidate_data['query'].astype(str).isin(query_ids)
+              & query_candidate_data['candidate'].astype(str).isin(candidate_ids))
+    return query_candidate_data[exists].reset_index(drop=True)
+
+
+def query_statistics(valid_rows, verbose=True):
+    '''
+    Prints the number of candidates and positive candidates of the query papers
+    :return: unique_query_papers, query_paper_counts and the query papers without positive candidate papers
+    '''
+    # unique query papers
+    unique_query_papers = valid_rows['query'].unique()
+    print(f'Number of unique query papers: {len(unique_query_papers)}')
+
+    # This is the number of query papers in valid_rows that appears more than once
+    query_paper_counts = valid_rows['query'].value_counts()
+    print(query_paper_counts)
+    print(f'Number of query papers with exactly one candidate paper: {query_paper_counts[query_paper_counts == 1].count()}')
+    print(f'Number of query papers with more than one candidate papers: {query_paper_counts[query_paper_counts > 1].count()}')
+
+    # one groupby gives the positive count of every query paper
+    positives = valid_rows.groupby('query', sort=False)['bool'].sum()
+
+    # for each query paper with more than one candidate papers what is the sum of their boolean values
+    if verbose:
+        for query_paper, count in query_paper_counts[query_paper_counts > 1].items():
+            sum_bool = positives[query_paper]
+            print(f'{query_paper=}, {sum_bool/count:.2%} ({sum_bool}) of {count} candidates are positive')
+
+    # for each unique valid query paper, which one has no positive candidate papers
+    no_positive = positives[positives == 0].index
+    if verbose:
+        for query_paper in unique_query_papers[np.isin(unique_query_papers, no_positive)]:
+            print(f'{query_paper=} has no positive candidate papers')
+    print(f'Number of query papers with no positive candidate papers: {len(no_positive)}')
+    return unique_query_papers, query_paper_counts, list(no_positive)
+
+
+def query_candidate_classifications(valid_rows, unique_query_papers, labels, verbose=True):
+    '''
+    Pairs the classification of every classified query paper with those of its classified candidate papers
+    :param labels: corpus_id-indexed labels, see label_table
+    :return: list of (query labels, candidate labels)
+    '''
+    found_classifications = []
+    print("Processing query papers and their candidate papers classification")
+    candidates_by_query = valid_rows.groupby('query', sort=False)['candidate'].agg(list)
+    for query_paper in unique_query_papers:
+        if query_paper not in labels:
+            continue
+        query_classification = [labels[query_paper]]
+        related_candidates = [int(candidate) for candidate in candidates_by_query[query_paper]]
+        if verbose:
+            print('Processing query paper: {query_paper} for classification task')
+            print(f'{query_paper=}, {query_classification=}')
+            print(f'{related_candidates=}')
 
         # Find the classification of each candidate paper
         for candidate_paper in related_candidates:
-            classification = [meta['labels'] for meta in classification_meta if meta['corpus_id'] == candidate_paper]
-            if len(classification) != 0:
-                print(f'{candidate_paper=}, {classification=}')
+            if candidate_paper in labels:
+                classification = [labels[candidate_paper]]
+                if verbose:
+                    print(f'{candidate_paper=}, {classification=}')
                 found_classifications.append((query_classification[0], classification[0]))
-
-# Create a list of unique paper IDs in numerical order
-candidate_paper_ids = sorted(set(candidate_retrieved_data['candidate_paper'].tolist()))
-retrieved_paper_ids = sorted(set(candidate_retrieved_data['retrieved_paper'].tolist()))
-
-
-# Create a dictionary that maps paper IDs to matrix indices
-candidate_id_to_index = {paper_id: index for index, paper_id in enumerate(candidate_paper_ids)}
-retrieved_id_to_index = {paper_id: index for index, paper_id in enumerate(retrieved_paper_ids)}
-
-# Create an empty matrix
-matrix = np.zeros((len(candidate_id_to_index), len(retrieved_id_to_index)))
-
-# Fill in the matrix
-for _, row in candidate_retrieved_data.iterrows():
-    i = candidate_id_to_index[row['candidate_paper']]
-    j = retrieved_id_to_index[row['retrieved_paper']]
-    matrix[i, j] = 1
-
-# Convert the matrix to a DataFrame for easier viewing
-matrix_df = pd.DataFrame(matrix, index=candidate_paper_ids, columns=retrieved_paper_ids)
-print(f'{matrix.shape=}')
-
-matrix_df.to_csv('darwin/candidate_retrieved_citation_matrix.csv', index=True)
-print(matrix_df.head(10))
-
-# Are there any candidate papers don't have any retrieved papers?
-papers_without_retrieved_data = []
-for i in range(len(candidate_paper_ids)):
-    if sum(matrix[i, :]) == 0:
-        papers_without_retrieved_data.append(candidate_id_to_index[i])
-print(f'Number of candidate papers without retrieved data: {len(papers_without_retrieved_data)}')
-
-# Print the number of candidate papers that have retrieved data
-print('Number of candidate papers that have retrieved data:')
-papers_with_retrieved_data = set(candidate_paper_ids) - set(papers_without_retrieved_data)
-print(f'\t{len(papers_with_retrieved_data)}')
-
-print('for those candidate papers that have retrieved data:')
-print(f'\tmean: {matrix_df[matrix_df.sum(axis=1) > 0].sum(axis=1).mean()}')
-print(f'\tstd: {matrix_df[matrix_df.sum(axis=1) > 0].sum(axis=1).std()}')
-print(f'\tmin: {matrix_df[matrix_df.sum(axis=1) > 0].sum(axis=1).min()}')
-print(f'\tmax: {matrix_df[matrix_df.sum(axis=1) > 0].sum(axis=1).max()}')
-
-
-found_classification_candidate = []
-print('Processing candidate papers and their retrieved papers classification')
-for candidate_paper in candidate_paper_ids:
-    classification = [meta['labels'] for meta in classification_meta if meta['corpus_id'] == candidate_paper]
-    if len(classification) != 0:
-        # print(f'{candidate_paper=}, {classification=}')
-        # found_classification_candidate.append(('unknown', classification[0]))
-
-        retrieved_paper_for_candidate = matrix_df.loc[candidate_paper][matrix_df.loc[candidate_paper] == 1].index.tolist()
-        # print(f'{retrieved_paper_for_candidate=}')
-        for retrieved_paper in retrieved_paper_for_candidate:
-            classification_retrieved = [meta['labels'] for meta in classification_meta if meta['corpus_id'] == retrieved_paper]
-            if len(classification_retrieved) != 0:
-                print(f'{candidate_paper=}, {classification=}, {retrieved_paper=}, {classification_retrieved=}')
-                found_classification_candidate.append((candidate_paper, classification))
-print(f' found {len(found_classification_candidate)} classification for candidate papers and their retrieved papers')
+    return found_classifications
+
+
+def citation_matrix(candidate_retrieved_data):
+    '''
+    Sparse candidate x retrieved matrix with 1 where the candidate paper cites the retrieved paper
+    :return: CSR matrix, sorted candidate_paper_ids and sorted retrieved_paper_ids
+    '''
+    return build_citation_matrix(candidate_retrieved_data['candidate_paper'].to_numpy(),
+                                 candidate_retrieved_data['retrieved_paper'].to_numpy())
+
+
+def retrieved_statistics(matrix, candidate_paper_ids):
+    '''
+    Prints the number of distinct retrieved papers of the candidate papers, from the row sums of the sparse matrix
+    :return: the candidate papers without retrieved data
+    '''
+    statistics = row_statistics(matrix)
+
+    # Are there any candidate papers don't have any retrieved papers?
+    papers_without_retrieved_data = [candidate_paper_ids[i] for i in statistics['rows_without_citations']]
+    print(f'Number of candidate papers without retrieved data: {len(papers_without_retrieved_data)}')
+
+    # Print the number of candidate papers that have retrieved data
+    print('Number of candidate papers that have retrieved data:')
+    print(f'\t{statistics["rows_with_citations"]}')
+
+    print('for those candidate papers that have retrieved data:')
+    print(f'\tmean: {statistics["mean"]}')
+    print(f'\tstd: {statistics["std"]}')
+    print(f'\tmin: {statistics["min"]}')
+    print(f'\tmax: {statistics["max"]}')
+    return papers_without_retrieved_data
+
+
+def candidate_retrieved_classifications(candidate_retrieved_data, labels, verbose=True):
+    '''
+    Finds the classified candidate papers that cite classified retrieved papers, by merging the links with the labels
+    :param labels: corpus_id-indexed labels, see label_table
+    :return: list of (candidate paper, [candidate labels]), one per classified retrieved paper
+    '''
+    found_classification_candidate = []
+    print('Processing candidate papers and their retrieved papers classification')
+    classified = pd.Index(list(labels.keys()))
+    links = candidate_retrieved_data.drop_duplicates()
+    links = links[links['candidate_paper'].isin(classified) & links['retrieved_paper'].isin(classified)]
+    # candidates in id order and their retrieved papers in column order, as the matrix rows were walked
+    links = links.sort_values(['candidate_paper', 'retrieved_paper'])
+    for candidate_paper, retrieved_paper in zip(links['candidate_paper'].tolist(), links['retrieved_paper'].tolist()):
+        classification = [labels[candidate_paper]]
+        if verbose:
+            classification_retrieved = [labels[retrieved_paper]]
+            print(f'{candidate_paper=}, {classification=}, {retrieved_paper=}, {classification_retrieved=}')
+        found_classification_candidate.append((candidate_paper, classification))
+    print(f' found {len(found_classification_candidate)} classification for candidate papers and their retrieved papers')
+    return found_classification_candidate
+
+
+def analyze(data_dir='darwin', verbose=True, dense_csv=False):
+    '''
+    Runs the whole analysis
+    :param data_dir: directory with the input data and the query_papers/candidate_papers pdf folders,
+                     the outputs are written to it
+    :param verbose: print every paper, the summary lines are always printed
+    :param dense_csv: also write the dense labeled citation matrix CSV, n_candidates x n_retrieved cells
+    :return: dict of the computed tables and lists
+    '''
+    candidate_retrieved_data, query_candidate_data, classification_meta = load_data(data_dir)
+    labels = label_table(classification_meta)
+
+    valid_rows = find_valid_rows(query_candidate_data, os.path.join(data_dir, 'query_papers'),
+                                 os.path.join(data_dir, 'candidate_papers'))
+    print(valid_rows.head())
+    print(f'Number of query candidate pairs with valid files: {len(valid_rows)}')
+
+    unique_query_papers, query_paper_counts, no_positive = query_statistics(valid_rows, verbose=verbose)
+    valid_rows.to_csv(os.path.join(data_dir, 'valid_query_candidate_pairs.csv'), index=False)
+
+    found_classifications = query_candidate_classifications(valid_rows, unique_query_papers, labels, verbose=verbose)
+
+    matrix, candidate_paper_ids, retrieved_paper_ids = citation_matrix(candidate_retrieved_data)
+    print(f'{matrix.shape=}, {matrix.nnz=}')
+    save_citation_matrix(os.path.join(data_dir, 'candidate_retrieved_citation_matrix.npz'), matrix,
+                         candidate_paper_ids, retrieved_paper_ids)
+    if dense_csv:
+        # Convert the matrix to a DataFrame for easier viewing
+        matrix_df = pd.DataFrame(matrix.toarray().astype(np.float64), index=candidate_paper_ids, columns=retrieved_paper_ids)
+        matrix_df.to_csv(os.path.join(data_dir, 'candidate_retrieved_citation_matrix.csv'), index=True)
+        print(matrix_df.head(10))
+
+    papers_without_retrieved_data = retrieved_statistics(matrix, candidate_paper_ids)
+    found_classification_candidate = candidate_retrieved_classifications(candidate_retrieved_data, labels,
+                                                                         verbose=verbose)
+    return {
+        'valid_rows': valid_rows,
+        'query_paper_counts': query_paper_counts,
+        'query_papers_without_positive': no_positive,
+        'found_classifications': found_classifications,
+        'matrix': matrix,
+        'candidate_paper_ids': candidate_paper_ids,
+        'retrieved_paper_ids': retrieved_paper_ids,
+        'papers_without_retrieved_data': papers_without_retrieved_data,
+        'found_classification_candidate': found_classification_candidate,
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('data_dir', nargs='?', default='darwin', help='folder with the S2 data and the pdf folders (default: darwin)')
+    parser.add_argument('--dense_csv', help='also write the dense labeled candidate_retrieved_citation_matrix.csv', action='store_true')
+    args = parser.parse_args()
+    analyze(args.data_dir, dense_csv=args.dense_csv)
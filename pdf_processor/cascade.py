@@ -0,0 +1,202 @@
+'''
+Cheap-first cascade in front of the LLM citation predictor.
+
+A local score of every (query paper, candidate paper) example decides the confident examples outright
+and only the uncertain band between two thresholds is sent to the LLM:
+    score <  low   -> does not cite, no LLM call
+    score >= high  -> cites, no LLM call
+    otherwise      -> chunk pairs predicted by the LLM as before
+The score can be
+    cosine         max cosine similarity of any query chunk to its most similar candidate chunk, free
+                   once the chunks are embedded
+    SPECTER margin decision_function of the SVM of "cs224u specter svm.ipynb" on the concatenated
+                   SPECTER embeddings of the two papers
+    both           a logistic regression of the two, see fit_combiner
+Examples without a score (nan) always go to the LLM.
+
+calibrate_gate picks the thresholds on a labelled set that already has LLM predictions: it keeps the
+pair saving the most LLM calls whose F1 is at most max_f1_drop below the LLM-only F1.
+
+Usage:
+    gate, report = calibrate_gate(scores, labels, llm_predictions, llm_calls, max_f1_drop=0.01)
+    pipeline = PredictCitationAndResolve(..., gate=gate)
+'''
+import math
+
+import numpy as np
+
+
+class GatedPairs(list):
+    '''
+    Chunk pairs of one example together with its local scores and the gate's decision.
+    When the gate decided the example, the list is empty and no LLM call is made.
+    '''
+
+    def __init__(self, pairs=(), cosine=float('nan'), score=float('nan'), decision=None):
+        super().__init__(pairs)
+        self.cosine = cosine
+        self.score = score
+        self.decision = decision
+
+
+class CascadeGate:
+    '''
+    Decides examples from their local score
+    :param low: scores below it are decided as not citing
+    :param high: scores at or above it are decided as citing
+    '''
+
+    def __init__(self, low=-math.inf, high=math.inf):
+        self.low = low
+        self.high = high
+
+    def decide(self, score):
+        '''False or True for a confident score, None when the LLM has to predict.'''
+        if score is None or math.isnan(score):
+            return None
+        if score < self.low:
+            return False
+        if score >= self.high:
+            return True
+        return None
+
+    def __repr__(self):
+        return f'CascadeGate(low={self.low}, high={self.high})'
+
+
+def cosine_scorer(query_file, candidate_file, cosine):
+    '''Scores an example by its max chunk cosine similarity.'''
+    return cosine
+
+
+def load_specter_embeddings(ids_path, embeddings_path):
+    '''
+    Reads SPECTER paper embeddings as written for "cs224u specter svm.ipynb"
+    :param ids_path: file with one corpus id per line, e.g. qpaper_to_emb
+    :param embeddings_path: text matrix with one embedding per line, e.g. qpaper.specter
+    :return: dict of corpus id to embedding
+    '''
+    with open(ids_path, 'r') as f:
+        ids = [line.strip() for line in f]
+    embeddings = np.loadtxt(embeddings_path, dtype=np.float64, ndmin=2)
+    return dict(zip(ids, embeddings))
+
+
+class SpecterScorer:
+    '''
+    Scores an example by the SVM margin of its concatenated SPECTER paper embeddings
+    :param svm: fitted classifier with decision_function, trained on np.hstack((query_emb, candidate_emb))
+    :param embeddings: dict of corpus id to SPECTER embedding, see load_specter_embeddings
+    '''
+
+    def __init__(self, svm, embeddings):
+        self.svm = svm
+        self.embeddings = embeddings
+
+    def __call__(self, query_file, candidate_file, cosine=None):
+        query = self.embeddings.get(str(query_file))
+        candidate = self.embeddings.get(str(candidate_file))
+        if query is None or candidate is None:
+            return float('nan')
+        return float(np.ravel(self.svm.decision_function(np.hstack((query, candidate))[None, :]))[0])
+
+
+def fit_combiner(features, labels):
+    '''
+    Fits a logistic regression on (cosine, SPECTER margin) features, rows with a nan are left out
+    :param features: (n_examples, n_scores) matrix
+    :param labels: whether each example cites
+    '''
+    from sklearn.linear_model import LogisticRegression
+
+    features = np.asarray(features, dtype=np.float64)
+    labels = np.asarray(labels, dtype=bool)
+    valid = ~np.isnan(features).any(axis=1)
+    return LogisticRegression(class_weight='balanced').fit(features[valid], labels[valid])
+
+
+class CombinedScorer:
+    '''
+    Scores an example by a model of its cosine and SPECTER margin, see fit_combiner
+    :param model: fitted classifier with decision_function
+    :param specter_scorer: SpecterScorer
+    '''
+
+    def __init__(self, model, specter_scorer):
+        self.model = model
+        self.specter_scorer = specter_scorer
+
+    def __call__(self, query_file, candidate_file, cosine):
+        margin = self.specter_scorer(query_file, candidate_file)
+        if math.isnan(cosine) or math.isnan(margin):
+            return float('nan')
+        return float(self.model.decision_function([[cosine, margin]])[0])
+
+
+def f1_score(predictions, labels):
+    predictions = np.asarray(predictions, dtype=bool)
+    labels = np.asarray(labels, dtype=bool)
+    true_positives = np.sum(predictions & labels)
+    if true_positives == 0:
+        return 0.0
+    precision = true_positives / np.sum(predictions)
+    recall = true_positives / np.sum(labels)
+    return float(2 * precision * recall / (precision + recall))
+
+
+def calibrate_gate(scores, labels, llm_predictions, llm_calls=None, max_f1_drop=0.0, n_thresholds=40):
+    '''
+    Chooses the gate thresholds on a labelled set the LLM has already predicted
+    :param scores: local score of every example, nan for examples the gate cannot decide
+    :param labels: whether each example cites
+    :param llm_predictions: the LLM-only pipeline's resolved prediction of every example
+    :param llm_calls: LLM calls the LLM-only pipeline made per example, 1 each if None
+    :param max_f1_drop: largest F1 loss, in absolute F1, accepted for saving calls
+    :param n_thresholds: score quantiles tried as thresholds
+    :return: the CascadeGate saving the most calls within max_f1_drop, and the report: one dict per
+             Pareto-optimal (calls saved, F1) threshold pair, most calls saved first
+    '''
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels, dtype=bool)
+    llm_predictions = np.asarray(llm_predictions, dtype=bool)
+    llm_calls = np.ones(len(scores)) if llm_calls is None else np.asarray(llm_calls, dtype=np.float64)
+    total_calls = llm_calls.sum()
+    baseline = f1_score(llm_predictions, labels)
+
+    valid = scores[~np.isnan(scores)]
+    quantiles = np.unique(np.quantile(valid, np.linspace(0, 1, n_thresholds + 1))) if len(valid) else []
+    # the extra thresholds are no gate at all, -inf never decides negative and inf never decides positive
+    lows = [-math.inf, *quantiles, math.inf]
+    highs = [*quantiles, math.inf]
+    # nan compares False both ways, so an unscored example is never below low nor at or above high
+    with np.errstate(invalid='ignore'):
+        rows = []
+        for low in lows:
+            negative = scores < low
+            for high in highs:
+                if high < low:
+                    continue
+                positive = (scores >= high) & ~negative
+                predictions = np.where(negative, False, np.where(positive, True, llm_predictions))
+                gated = negative | positive
+                calls_saved = llm_calls[gated].sum()
+                f1 = f1_score(predictions, labels)
+                rows.append({
+                    'low': float(low), 'high': float(high),
+                    'decided_negative': int(negative.sum()), 'decided_positive': int(positive.sum()),
+                    'sent_to_llm': int((~gated).sum()),
+                    'llm_calls': float(total_calls - calls_saved), 'calls_saved': float(calls_saved),
+                    'calls_saved_fraction': float(calls_saved / total_calls) if total_calls else 0.0,
+                    'f1': f1, 'f1_change': f1 - baseline,
+                })
+
+    # Pareto frontier: a row stays if no row saves at least as many calls with a higher F1
+    rows.sort(key=lambda row: (-row['calls_saved'], -row['f1']))
+    report, best_f1 = [], -math.inf
+    for row in rows:
+        if row['f1'] > best_f1:
+            report.append(row)
+            best_f1 = row['f1']
+    # the frontier ends at the LLM-only F1 or above, so some row is always within max_f1_drop
+    chosen = next(row for row in report if row['f1_change'] >= -max_f1_drop - 1e-12)
+    return CascadeGate(chosen['low'], chosen['high']), report
@@ -0,0 +1,98 @@
+'''
+Linear-time chunking shared by the evaluation notebooks and the vector-DB scripts.
+
+Both chunkers walk the source text with indices and produce (start, end) character offsets, a chunk's
+text is a single slice of the source taken only when it is asked for. Nothing re-slices or
+re-concatenates the remaining text, so chunking a paper is linear in its length.
+
+    Chunker        character windows of context_window * (1 + overlap) characters, snapped back to the
+                   last newline in the second half of the window, same output as the notebooks' Chunker
+    TokenChunker   windows of max_tokens tokens of one cached tiktoken encoding, as used for embeddings
+
+Usage:
+    chunks = [snippet for _, snippet in Chunker(context_window=1000, max_windows=15)(paper)]
+    for i, start, end, n_tokens in TokenChunker(max_tokens=1000).spans(text): ...
+'''
+import functools
+
+import tiktoken
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name='cl100k_base'):
+    # building an encoding is expensive, every caller shares one per name
+    return tiktoken.get_encoding(encoding_name)
+
+
+class Chunker:
+    '''
+    Splits a paper into at most max_windows snippets of about context_window characters
+    :param context_window: target snippet length in characters
+    :param max_windows: maximum number of snippets, None for the whole paper
+    :param window_overlap: fraction of context_window a window may run over before it is cut
+    '''
+
+    def __init__(self, context_window=3000, max_windows=5, window_overlap=0.02):
+        self.context_window = context_window
+        self.max_windows = max_windows
+        self.window_overlap = window_overlap
+
+    def spans(self, paper):
+        '''Yields (snippet index, start, end) offsets of the whitespace-stripped snippets of paper.'''
+        window = int(self.context_window * (1.0 + self.window_overlap))
+        pos = 0
+        snippet_idx = 0
+        while (self.max_windows is None or snippet_idx < self.max_windows) and pos < len(paper):
+            end = min(pos + window, len(paper))
+            next_pos = end
+            if end < len(paper):
+                # cut at the last newline when it leaves at least half a window, the rest is carried over
+                next_newline_pos = paper.rfind('\n', pos, end)
+                if next_newline_pos != -1 and next_newline_pos - pos >= self.context_window // 2:
+                    end = next_newline_pos
+                    next_pos = next_newline_pos + 1
+
+            start = pos
+            while start < end and paper[start].isspace():
+                start += 1
+            while end > start and paper[end - 1].isspace():
+                end -= 1
+            yield snippet_idx, start, end
+            pos = next_pos
+            snippet_idx += 1
+
+    def __call__(self, paper):
+        for snippet_idx, start, end in self.spans(paper):
+            yield snippet_idx, paper[start:end]
+
+
+class TokenChunker:
+    '''
+    Splits text into consecutive windows of max_tokens tokens
+    :param max_tokens: number of tokens per window, the last one may be shorter
+    :param encoding_name: tiktoken encoding, shared through get_encoding
+    '''
+
+    def __init__(self, max_tokens=8191, encoding_name='cl100k_base'):
+        self.max_tokens = max_tokens
+        self.encoding = get_encoding(encoding_name)
+
+    def spans(self, text):
+        '''
+        Yields (window index, start, end, token count) with character offsets into text. The text is
+        encoded once and the token to character offsets come from one decode of the whole sequence.
+        '''
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if not tokens:
+            return
+        # tiktoken round-trips text character for character (a lone surrogate comes back as one U+FFFD),
+        # so offsets into the decoded text are offsets into text
+        _, offsets = self.encoding.decode_with_offsets(tokens)
+        for idx, i in enumerate(range(0, len(tokens), self.max_tokens)):
+            j = min(i + self.max_tokens, len(tokens))
+            end = offsets[j] if j < len(tokens) else len(text)
+            yield idx, offsets[i], end, j - i
+
+    def __call__(self, text):
+        for idx, start, end, _ in self.spans(text):
+            yield idx, text[start:end]
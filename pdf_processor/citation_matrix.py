@@ -0,0 +1,101 @@
+'''
+Sparse citation matrix between corpus IDs.
+
+The link recorder has roughly one edge per candidate paper, so a dense candidate x retrieved matrix is almost all
+zeros and grows as n^2. The matrix is built as CSR straight from the two ID columns and saved as
+    <name>.npz           scipy.sparse CSR matrix, int8 ones
+    <name>.row_ids.txt   corpus ID of every row, one per line
+    <name>.col_ids.txt   corpus ID of every column, one per line
+Rows and columns are in sorted ID order, the same order as the labeled CSV matrix, and row statistics come
+from the CSR index pointers without densifying.
+
+Usage:
+    matrix, row_ids, col_ids = build_citation_matrix(links['candidate_paper'], links['retrieved_paper'])
+    save_citation_matrix('darwin/candidate_retrieved_citation_matrix.npz', matrix, row_ids, col_ids)
+    matrix, row_ids, col_ids = load_citation_matrix('darwin/candidate_retrieved_citation_matrix.npz')
+'''
+import os
+
+import numpy as np
+import scipy.sparse
+
+
+def citation_matrix_paths(path):
+    '''The .npz file and the row and column ID sidecars of a citation matrix.'''
+    path = str(path)
+    stem = path[:-len('.npz')] if path.endswith('.npz') else path
+    return stem + '.npz', stem + '.row_ids.txt', stem + '.col_ids.txt'
+
+
+def build_citation_matrix(citing_ids, cited_ids):
+    '''
+    Builds the citing x cited matrix with a 1 for every link, repeated links count once
+    :param citing_ids: citing corpus ID of every link
+    :param cited_ids: cited corpus ID of every link
+    :return: CSR matrix, sorted unique citing IDs (rows) and sorted unique cited IDs (columns)
+    '''
+    row_ids, rows = np.unique(np.asarray(citing_ids), return_inverse=True)
+    col_ids, cols = np.unique(np.asarray(cited_ids), return_inverse=True)
+    matrix = scipy.sparse.csr_matrix((np.ones(len(rows), dtype=np.int8), (rows.ravel(), cols.ravel())),
+                                     shape=(len(row_ids), len(col_ids)))
+    # the COO -> CSR conversion sums repeated links, a cell is a citation or not
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+    return matrix, row_ids.tolist(), col_ids.tolist()
+
+
+def row_statistics(matrix):
+    '''
+    Number of cited papers of every row, from the CSR index pointers
+    :return: dict with the rows without citations, and mean, std, min and max over the rows with citations
+    '''
+    matrix = scipy.sparse.csr_matrix(matrix)
+    matrix.eliminate_zeros()
+    counts = np.diff(matrix.indptr).astype(np.float64)
+    with_citations = counts[counts > 0]
+    return {
+        'rows_without_citations': np.flatnonzero(counts == 0).tolist(),
+        'rows_with_citations': int(len(with_citations)),
+        'mean': with_citations.mean() if len(with_citations) else float('nan'),
+        'std': with_citations.std(ddof=1) if len(with_citations) > 1 else float('nan'),
+        'min': with_citations.min() if len(with_citations) else float('nan'),
+        'max': with_citations.max() if len(with_citations) else float('nan'),
+    }
+
+
+def _write_ids(path, ids):
+    with open(path + '.tmp', 'w') as f:
+        for corpus_id in ids:
+            f.write(f'{corpus_id}\n')
+    os.replace(path + '.tmp', path)
+
+
+def save_citation_matrix(path, matrix, row_ids, col_ids):
+    '''
+    Writes the matrix and its ID sidecars, each through a temporary file so readers never see a partial file
+    :param path: location of the .npz file, the sidecars are written next to it
+    '''
+    npz_path, row_ids_path, col_ids_path = citation_matrix_paths(path)
+    if matrix.shape != (len(row_ids), len(col_ids)):
+        raise ValueError(f'matrix shape {matrix.shape} does not match {len(row_ids)} row and {len(col_ids)} column IDs')
+    _write_ids(row_ids_path, row_ids)
+    _write_ids(col_ids_path, col_ids)
+    with open(npz_path + '.tmp', 'wb') as f:
+        scipy.sparse.save_npz(f, scipy.sparse.csr_matrix(matrix))
+    os.replace(npz_path + '.tmp', npz_path)
+
+
+def load_citation_matrix(path):
+    '''
+    Reads a matrix written by save_citation_matrix, it stays sparse
+    :return: CSR matrix, row corpus IDs and column corpus IDs, as strings
+    '''
+    npz_path, row_ids_path, col_ids_path = citation_matrix_paths(path)
+    matrix = scipy.sparse.load_npz(npz_path).tocsr()
+    with open(row_ids_path, 'r') as f:
+        row_ids = [line.strip() for line in f]
+    with open(col_ids_path, 'r') as f:
+        col_ids = [line.strip() for line in f]
+    if matrix.shape != (len(row_ids), len(col_ids)):
+        raise ValueError(f'{npz_path} has shape {matrix.shape} but {len(row_ids)} row and {len(col_ids)} column IDs')
+    return matrix, row_ids, col_ids
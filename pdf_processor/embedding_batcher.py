@@ -0,0 +1,260 @@
+'''
+Token-aware, concurrent embedding batching.
+
+EmbeddingBatcher packs texts from any number of documents into requests bounded by both item count
+and total tokens, keeps several requests in flight on a thread pool under a requests/tokens per minute
+rate limiter, and retries failed requests with exponential backoff. Results always come back in input
+order, one embedding per text: a request that keeps failing raises instead of dropping rows.
+
+The client is pluggable, anything with an `embed(texts) -> list of vectors` method works:
+    OpenAIEmbeddingClient   the OpenAI embeddings API (or any OpenAI-compatible base_url)
+    HTTPEmbeddingClient     a plain POST of {"input": [...], "model": ...} to an OpenAI-style endpoint,
+                            used to benchmark against a local fake embedding server
+
+Usage:
+    batcher = EmbeddingBatcher(OpenAIEmbeddingClient('text-embedding-3-small'), store=store)
+    for (file_id, chunk_id), embedding in batcher.embed_iter(((key, text) for key, text in chunks)):
+        ...
+'''
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+import metrics
+from chunking import get_encoding
+
+
+class RateLimiter:
+    '''
+    Token buckets over requests and tokens per minute, either limit can be None
+    :param requests_per_minute: maximum number of requests started per minute
+    :param tokens_per_minute: maximum number of input tokens sent per minute
+    '''
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.limits = (requests_per_minute, tokens_per_minute)
+        self.levels = [limit for limit in self.limits]
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n_tokens=0):
+        '''Blocks until one request carrying n_tokens tokens may be sent.'''
+        costs = (1, n_tokens)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                elapsed, self.updated = now - self.updated, now
+                wait = 0
+                for i, limit in enumerate(self.limits):
+                    if limit is None:
+                        continue
+                    self.levels[i] = min(limit, self.levels[i] + elapsed * limit / 60)
+                    # a request larger than the whole bucket waits for a full bucket instead of forever
+                    cost = min(costs[i], limit)
+                    if self.levels[i] < cost:
+                        wait = max(wait, (cost - self.levels[i]) * 60 / limit)
+                if wait == 0:
+                    for i, limit in enumerate(self.limits):
+                        if limit is not None:
+                            self.levels[i] -= min(costs[i], limit)
+                    return
+            time.sleep(wait)
+
+
+class OpenAIEmbeddingClient:
+    '''
+    Embeds texts through the OpenAI embeddings API
+    :param model: embedding model name
+    :param client: an OpenAI client, created from client_kwargs (api_key, base_url, ...) if None
+    '''
+
+    def __init__(self, model='text-embedding-3-small', client=None, **client_kwargs):
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(**client_kwargs)
+        self.model = model
+        self.client = client
+
+    def embed(self, texts):
+        response = self.client.embeddings.create(input=texts, model=self.model)
+        return [d.embedding for d in sorted(response.data, key=lambda d: d.index)]
+
+
+class HTTPEmbeddingClient:
+    '''
+    Embeds texts by POSTing to an OpenAI-compatible /embeddings endpoint
+    :param url: url of the endpoint
+    :param model: embedding model name
+    :param api_key: sent as a bearer token if given
+    '''
+
+    def __init__(self, url, model='text-embedding-3-small', api_key=None, timeout=60):
+        self.url = url
+        self.model = model
+        self.timeout = timeout
+        self.session = requests.Session()
+        if api_key:
+            self.session.headers['Authorization'] = f'Bearer {api_key}'
+
+    def embed(self, texts):
+        response = self.session.post(self.url, json={'input': texts, 'model': self.model}, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()['data']
+        return [d['embedding'] for d in sorted(data, key=lambda d: d['index'])]
+
+
+class EmbeddingBatcher:
+    '''
+    Packs texts into token-bounded requests and embeds them concurrently
+    :param client: object with an embed(texts) method returning one vector per text
+    :param max_batch_items: maximum number of texts per request
+    :param max_batch_tokens: maximum number of tokens per request
+    :param max_item_tokens: texts longer than this are truncated, the model's context size
+    :param workers: number of requests in flight
+    :param limiter: RateLimiter shared by all requests, or None
+    :param max_retries: number of retries of a failed request before giving up
+    :param backoff: seconds before the first retry, doubled on every retry
+    :param store: optional EmbeddingStore, stored texts are not sent and new embeddings are added to it
+    '''
+
+    def __init__(self, client, max_batch_items=512, max_batch_tokens=100000, max_item_tokens=8191,
+                 workers=4, limiter=None, max_retries=5, backoff=1.0, store=None, encoding_name='cl100k_base'):
+        self.client = client
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
+        self.max_item_tokens = max_item_tokens
+        self.workers = workers
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.store = store
+        self.encoding = get_encoding(encoding_name)
+        self.requests = 0
+        self.retries = 0
+        self.tokens = 0
+        self.store_hits = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, text, n_tokens=None):
+        '''
+        Returns the text to send, truncated to max_item_tokens, and its token count
+        :param n_tokens: token count computed by the caller, saves encoding text again
+        '''
+        if n_tokens is not None and n_tokens <= self.max_item_tokens:
+            return text, n_tokens
+        tokens = self.encoding.encode(text, disallowed_special=())
+        if len(tokens) > self.max_item_tokens:
+            tokens = tokens[:self.max_item_tokens]
+            text = self.encoding.decode(tokens)
+        return text, len(tokens)
+
+    def _embed_batch(self, texts, sent_texts, n_tokens):
+        for attempt in range(self.max_retries + 1):
+            if self.limiter is not None:
+                self.limiter.acquire(n_tokens)
+            try:
+                with metrics.timer('api_call', service='embeddings'):
+                    embeddings = self.client.embed(sent_texts)
+                if len(embeddings) != len(sent_texts):
+                    raise ValueError(f'Number of embeddings does not match number of texts {len(embeddings)} != {len(sent_texts)}')
+                embeddings = np.asarray(embeddings, dtype=np.float32)
+                break
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                metrics.count('retries', service='embeddings')
+                print(f'Embedding request of {len(sent_texts)} texts failed ({e}), retrying')
+                time.sleep(self.backoff * 2 ** attempt)
+        with self._lock:
+            self.requests += 1
+            self.tokens += n_tokens
+        metrics.count('api_calls', service='embeddings')
+        metrics.count('tokens', n_tokens, service='embeddings')
+        if self.store is not None:
+            self.store.add(texts, embeddings)
+        return embeddings
+
+    def embed_iter(self, items):
+        '''
+        Embeds a stream of texts, overlapping requests with the production of later items
+        :param items: iterable of (payload, text) or (payload, text, n_tokens), payload is passed through untouched
+        :return: generator of (payload, embedding) in input order, embeddings are float32 arrays
+        '''
+        # entries are [payload, embedding, future, index in the future's batch]
+        window = collections.deque()
+        batch, batch_texts, batch_sent, batch_tokens = [], [], [], 0
+        # store hits queued behind the batch being packed, they cannot be yielded before it is embedded
+        hits_behind = 0
+        in_flight = collections.deque()
+        max_in_flight = 2 * self.workers
+
+        def pop_ready(block):
+            while window:
+                entry = window[0]
+                if entry[2] is not None:
+                    if not block and not entry[2].done():
+                        return
+                    entry[1] = entry[2].result()[entry[3]]
+                elif entry[1] is None:
+                    # waits on the batch that is still being packed
+                    return
+                window.popleft()
+                yield entry[0], entry[1]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            def submit():
+                nonlocal batch, batch_texts, batch_sent, batch_tokens, hits_behind
+                future = executor.submit(self._embed_batch, batch_texts, batch_sent, batch_tokens)
+                for i, entry in enumerate(batch):
+                    entry[2], entry[3] = future, i
+                in_flight.append(future)
+                batch, batch_texts, batch_sent, batch_tokens, hits_behind = [], [], [], 0, 0
+
+            for item in items:
+                payload, text = item[0], item[1]
+                embedding = self.store.get(text) if self.store is not None else None
+                if embedding is not None:
+                    with self._lock:
+                        self.store_hits += 1
+                    metrics.count('cache_hits', cache='embedding_store')
+                    window.append([payload, np.asarray(embedding), None, None])
+                    # with mostly stored texts a miss's batch is slow to fill, send it partial instead of holding the hits
+                    if batch:
+                        hits_behind += 1
+                        if hits_behind >= self.max_batch_items:
+                            submit()
+                else:
+                    sent, n_tokens = self.prepare(text, item[2] if len(item) > 2 else None)
+                    if batch and (len(batch) == self.max_batch_items or batch_tokens + n_tokens > self.max_batch_tokens):
+                        submit()
+                    entry = [payload, None, None, None]
+                    window.append(entry)
+                    batch.append(entry)
+                    batch_texts.append(text)
+                    batch_sent.append(sent)
+                    batch_tokens += n_tokens
+
+                while in_flight and in_flight[0].done():
+                    in_flight.popleft()
+                yield from pop_ready(block=False)
+                # bounds memory and lets producer exceptions surface, the oldest request is awaited
+                while len(in_flight) >= max_in_flight:
+                    in_flight.popleft().result()
+                    yield from pop_ready(block=False)
+
+            if batch:
+                submit()
+            yield from pop_ready(block=True)
+
+    def embed(self, texts):
+        '''Returns the embeddings of texts as a (len(texts), dim) float32 array.'''
+        embeddings = [embedding for _, embedding in self.embed_iter(enumerate(texts))]
+        if not embeddings:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.stack(embeddings)
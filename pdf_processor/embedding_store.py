@@ -0,0 +1,194 @@
+'''
+Content-addressed embedding store shared by the vector-DB scripts and the evaluation notebooks.
+
+Embeddings are keyed by the SHA-256 of (model name, whitespace-normalized text), so an identical chunk
+is embedded once across query/candidate/retrieved corpora and across runs. Vectors of a model are
+appended as raw float32 rows to `<directory>/<model>/vectors.f32` and located through an append-only
+`index.tsv` of `key<TAB>row` lines. Reads are `np.memmap` slices, no text parsing involved.
+
+Several processes (the scripts and the notebooks) may share a store: appends hold an exclusive flock on
+`<model>/.lock`, number their rows from the size of the vectors file under that lock and pick up the index
+lines other processes appended first, so rows never collide.
+
+Usage:
+    store = EmbeddingStore('embedding_store', model='text-embedding-3-small')
+    embeddings = store.embed(chunks, embed_fn)  # embed_fn(list of texts) -> list of vectors, only called on misses
+'''
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+import numpy as np
+
+import metrics
+
+
+def normalize_text(text):
+    '''Collapses whitespace so chunks differing only in line breaks or spacing share an embedding.'''
+    return ' '.join(text.split())
+
+
+class EmbeddingStore:
+    '''
+    Append-only, memory-mappable float32 embedding store for one model
+    :param directory: root directory of the store, one subdirectory per model
+    :param model: embedding model name, part of every key
+    '''
+
+    def __init__(self, directory='embedding_store', model='text-embedding-3-small'):
+        self.model = model
+        self.path = Path(directory) / model.replace('/', '_')
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.vectors_path = self.path / 'vectors.f32'
+        self.index_path = self.path / 'index.tsv'
+        self.meta_path = self.path / 'meta.json'
+        self.lock_path = self.path / '.lock'
+        self._lock = threading.RLock()
+        self._index = {}
+        self._mmap = None
+        self._n_rows = 0
+        self._index_offset = 0
+        self.dim = None
+        with self._file_lock():
+            self._load_meta()
+            self._load_index()
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        '''Exclusive lock on the store, across processes.'''
+        with open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_meta(self):
+        if self.dim is None and self.meta_path.exists():
+            with open(self.meta_path) as f:
+                self.dim = json.load(f)['dim']
+
+    def _load_index(self):
+        '''Syncs the row count and reads the index lines appended since the last call, under the file lock.'''
+        if self.dim is None:
+            return
+        row_bytes = 4 * self.dim
+        size = self.vectors_path.stat().st_size if self.vectors_path.exists() else 0
+        n_rows = size // row_bytes
+        if size != n_rows * row_bytes:
+            # a crash during an append left a partial row behind
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(n_rows * row_bytes)
+        if self.index_path.exists():
+            with open(self.index_path) as f:
+                f.seek(self._index_offset)
+                for line in f:
+                    temp = line.rstrip('\n').split('\t')
+                    if len(temp) == 2 and temp[1].isdigit() and int(temp[1]) < n_rows:
+                        self._index[temp[0]] = int(temp[1])
+                self._index_offset = f.tell()
+        self._n_rows = n_rows
+
+    def _matrix(self):
+        # remap lazily whenever rows were appended since the last map
+        if self._mmap is None or self._mmap.shape[0] < self._n_rows:
+            self._mmap = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self._n_rows, self.dim))
+        return self._mmap
+
+    def key(self, text):
+        return hashlib.sha256(f'{self.model}\0{normalize_text(text)}'.encode('utf-8')).hexdigest()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, text):
+        return self.key(text) in self._index
+
+    def get(self, text):
+        '''Returns the stored embedding of text as a read-only memmap row, or None.'''
+        with self._lock:
+            row = self._index.get(self.key(text))
+            return None if row is None else self._matrix()[row]
+
+    def add(self, texts, embeddings):
+        '''Appends embeddings for texts that are not stored yet.'''
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if len(texts) == 0:
+            return
+        with self._lock, self._file_lock():
+            # another process may have created the store or appended rows since our last append
+            self._load_meta()
+            if self.dim is None:
+                self.dim = int(embeddings.shape[1])
+                with open(self.meta_path, 'w') as f:
+                    json.dump({'model': self.model, 'dim': self.dim}, f)
+            self._load_index()
+            if embeddings.shape[1] != self.dim:
+                raise ValueError(f'Expected embeddings of dimension {self.dim}, got {embeddings.shape[1]}')
+            new_rows = {}
+            for text, embedding in zip(texts, embeddings):
+                key = self.key(text)
+                if key not in self._index and key not in new_rows:
+                    new_rows[key] = embedding
+            if not new_rows:
+                return
+            # vectors are flushed before the index lines that point at them
+            with open(self.vectors_path, 'ab') as f:
+                f.write(np.stack(list(new_rows.values())).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path, 'a') as f:
+                for i, key in enumerate(new_rows):
+                    f.write(f'{key}\t{self._n_rows + i}\n')
+                self._index_offset = f.tell()
+            for i, key in enumerate(new_rows):
+                self._index[key] = self._n_rows + i
+            self._n_rows += len(new_rows)
+
+    def embed(self, texts, embed_fn, batch_size=100):
+        '''
+        Returns the embeddings of texts as a (len(texts), dim) float32 array, calling embed_fn only for
+        texts that are not stored yet, batch_size unique texts at a time.
+        :param embed_fn: function taking a list of texts and returning one vector per text
+        '''
+        keys = [self.key(text) for text in texts]
+        with self._lock:
+            missing = {}
+            for key, text in zip(keys, texts):
+                if key not in self._index and key not in missing:
+                    missing[key] = text
+        missing_texts = list(missing.values())
+        metrics.count('cache_hits', len(texts) - sum(key in missing for key in keys), cache='embedding_store')
+        metrics.count('cache_misses', len(missing_texts), cache='embedding_store')
+        for start in range(0, len(missing_texts), batch_size):
+            batch = missing_texts[start:start + batch_size]
+            with metrics.timer('api_call', service='embeddings'):
+                embeddings = embed_fn(batch)
+            metrics.count('api_calls', service='embeddings')
+            if len(embeddings) != len(batch):
+                raise ValueError(f'Number of embeddings does not match number of texts {len(embeddings)} != {len(batch)}')
+            self.add(batch, embeddings)
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        with self._lock:
+            return self._matrix()[[self._index[key] for key in keys]]
+
+    def clear(self):
+        '''Removes every stored embedding of this model.'''
+        with self._lock, self._file_lock():
+            for path in (self.vectors_path, self.index_path, self.meta_path):
+                if path.exists():
+                    path.unlink()
+            self._index = {}
+            self._index_offset = 0
+            self._n_rows = 0
+            self._mmap = None
+            self.dim = None
+
+    def __deepcopy__(self, memo):
+        # DSPy optimizers deep-copy programs, the on-disk store is shared rather than copied
+        return self
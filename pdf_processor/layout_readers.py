@@ -0,0 +1,284 @@
+'''
+Layout readers: the remote llmsherpa parser or a local layout extractor, behind one read_pdf interface.
+
+Every reader has `read_pdf(path_or_url, contents=None)` returning an llmsherpa Document, so sections(),
+chunks() and their title, tag, level, page_idx, block_idx, parent, sentences and to_context_text() are
+the same whichever backend parsed the PDF:
+
+    llmsherpa   LayoutPDFReader, one HTTP request per PDF to the parser at --llmsherpa_api_url
+    local       LocalLayoutPDFReader, layout blocks from the PDF's own text and fonts, parsed in a process pool
+
+The local backend builds the blocks llmsherpa would return from PyPDF2's text extraction, line by line:
+    - the body font size is the size of most characters, larger sizes are header levels (largest first)
+    - a short line in a bold font, or starting with a section number like "3" or "3.2", is a header one
+      level below the size-based levels ("3.2 Results" one below "3 Method")
+    - lines starting with a bullet or an item number are list items
+    - other lines are paragraph text, a paragraph ends at a blank line, a page end, a header or a line
+      ending a sentence, and is split into sentences
+PyPDF2 reports no reliable line positions, so there are no bounding boxes and no tables: a table's rows
+come out as paragraph text. Headers and paragraphs are what the ingest and the vector DB scripts use.
+
+create_reader() builds either one behind the content-addressed parse cache (parse_cache.py), and
+read_documents() keeps several reads in flight for callers that go through PDFs one by one.
+
+Usage:
+    pdf_reader = create_reader('local', parse_cache='parse_cache', workers=os.cpu_count())
+    for pdf_file, doc, error in read_documents(pdf_reader.read_pdf, pdf_files, workers=8):
+        ...
+'''
+import collections
+import concurrent.futures
+import importlib.metadata
+import io
+import multiprocessing
+import re
+import threading
+import urllib.request
+
+from llmsherpa.readers import Document, LayoutPDFReader
+from PyPDF2 import PdfReader
+
+from parse_cache import CachedLayoutPDFReader
+
+READERS = ('llmsherpa', 'local')
+# bump when the blocks built from the same PDF change, cached local layouts are then parsed again
+LOCAL_LAYOUT_VERSION = 1
+
+HEADER_SIZE_RATIO = 1.15
+MAX_HEADER_LEVELS = 4
+MAX_HEADER_WORDS = 12
+SECTION_NUMBER = re.compile(r'^(\d{1,2}(?:\.\d{1,2})*)\.?\s+[A-Z]')
+LIST_ITEM = re.compile(r'^(?:[•◦▪‣∙·\-–*]|\(?\d{1,2}[.)]|\(?[a-z][.)]|\(?[ivx]{1,4}\))\s+\S')
+PAGE_NUMBER = re.compile(r'^\d{1,4}$')
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+(?=[A-Z0-9(\["])')
+# font name markers of bold faces, CMBX is TeX's bold and NimbusRomNo9L-Medi the bold Times of LaTeX papers
+BOLD_FONTS = ('Bold', 'Black', 'Heavy', 'Semibold', 'CMBX', 'Medi')
+
+
+def page_lines(page):
+    '''
+    Text lines of a page as (text, font size, bold) triples, the size and font of a line being those of
+    most of its characters, blank lines as None
+    '''
+    lines = []
+    fragments = []
+
+    def end_line():
+        text = ''.join(fragment for fragment, _, _ in fragments).strip()
+        if not text:
+            lines.append(None)
+        else:
+            weights = collections.Counter()
+            for fragment, size, bold in fragments:
+                weights[size, bold] += len(fragment.strip())
+            (size, bold), _ = weights.most_common(1)[0]
+            lines.append((text, size, bold))
+        fragments.clear()
+
+    def visit(text, cm, tm, font_dict, font_size):
+        # the rendered size, fonts set at size 1 and scaled by the text matrix are common
+        size = round(font_size * (abs(tm[3]) or 1.0) * (abs(cm[3]) or 1.0), 1)
+        font = str(font_dict.get('/BaseFont', '')) if font_dict else ''
+        bold = any(marker in font for marker in BOLD_FONTS)
+        parts = text.split('\n')
+        for i, part in enumerate(parts):
+            if part:
+                fragments.append((part, size, bold))
+            if i < len(parts) - 1:
+                end_line()
+
+    page.extract_text(visitor_text=visit)
+    if fragments:
+        end_line()
+    return lines
+
+
+def header_levels(pages):
+    '''Body font size and the header level of each larger font size, by characters over all pages.'''
+    sizes = collections.Counter()
+    for lines in pages:
+        for line in lines:
+            if line is not None:
+                sizes[line[1]] += len(line[0])
+    if not sizes:
+        return 0.0, {}
+    body_size = sizes.most_common(1)[0][0]
+    larger = sorted((size for size in sizes if size >= body_size * HEADER_SIZE_RATIO), reverse=True)
+    return body_size, {size: min(level, MAX_HEADER_LEVELS - 1) for level, size in enumerate(larger)}
+
+
+def line_kind(text, size, bold, body_size, levels):
+    '''
+    Tag of one line and, for a header, its level
+    :return: ('header', level), ('list_item', None) or ('para', None)
+    '''
+    words = len(text.split())
+    if size in levels and words <= 2 * MAX_HEADER_WORDS:
+        return 'header', levels[size]
+    number = SECTION_NUMBER.match(text)
+    if words <= MAX_HEADER_WORDS and (bold or number) and not text.endswith(('.', ',', ';')) and size >= body_size:
+        depth = number.group(1).count('.') if number else 0
+        return 'header', len(levels) + depth
+    if LIST_ITEM.match(text):
+        return 'list_item', None
+    return 'para', None
+
+
+def split_sentences(lines):
+    '''Sentences of the lines of one block, words hyphenated across lines joined again.'''
+    text = re.sub(r'-\n(?=[a-z])', '', '\n'.join(lines)).replace('\n', ' ')
+    return [sentence for sentence in SENTENCE_END.split(text) if sentence]
+
+
+def layout_blocks(source):
+    '''
+    llmsherpa layout blocks of a PDF, see the module docstring
+    :param source: path to the PDF file, or its contents
+    :return: list of block dictionaries, Document(blocks) builds the layout tree
+    '''
+    pdf = PdfReader(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+    pages = [page_lines(page) for page in pdf.pages]
+    body_size, levels = header_levels(pages)
+
+    blocks = []
+    section_level = -1
+    for page_idx, lines in enumerate(pages):
+        # paragraphs do not continue across pages
+        current = None
+        for line in lines:
+            if line is None:
+                current = None
+                continue
+            text, size, bold = line
+            if PAGE_NUMBER.match(text):
+                continue
+            tag, level = line_kind(text, size, bold, body_size, levels)
+            if tag == 'header':
+                # a header wrapped over several lines stays one block
+                if current is None or current['tag'] != 'header' or current['level'] != level:
+                    current = {'tag': 'header', 'level': level, 'page_idx': page_idx, 'lines': []}
+                    blocks.append(current)
+                section_level = level
+            elif tag == 'list_item' or current is None or current['tag'] == 'header' or current['closed']:
+                current = {'tag': tag, 'level': section_level + 1, 'page_idx': page_idx, 'lines': [], 'closed': False}
+                blocks.append(current)
+            current['lines'].append(text)
+            if current['tag'] != 'header':
+                current['closed'] = text.endswith(('.', '!', '?'))
+
+    for block_idx, block in enumerate(blocks):
+        lines = block.pop('lines')
+        block.pop('closed', None)
+        block['block_idx'] = block_idx
+        block['sentences'] = [' '.join(lines)] if block['tag'] == 'header' else split_sentences(lines)
+    return blocks
+
+
+class LocalLayoutPDFReader:
+    '''
+    Drop-in replacement for LayoutPDFReader parsing PDFs locally, see the module docstring. Threads calling
+    read_pdf concurrently share the process pool
+    :param workers: number of processes parsing PDFs, 0 parses in the calling thread
+    :param mp_context: multiprocessing context of the pool, spawn by default since the callers are threaded
+    '''
+    service = 'local_layout'
+
+    def __init__(self, workers=0, mp_context=None):
+        self.workers = workers
+        self.mp_context = mp_context
+        self.parser_id = f'local-layout v{LOCAL_LAYOUT_VERSION}|PyPDF2 {importlib.metadata.version("PyPDF2")}'
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                context = self.mp_context or multiprocessing.get_context('spawn')
+                self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._executor
+
+    def read_pdf(self, path_or_url, contents=None):
+        '''
+        Reads a pdf from a path or a url, or from its contents
+        :param path_or_url: path or url of the pdf file, ignored if contents is given
+        :param contents: contents of the pdf file
+        '''
+        source = contents
+        if source is None:
+            if '://' in str(path_or_url):
+                with urllib.request.urlopen(str(path_or_url)) as response:
+                    source = response.read()
+            else:
+                source = str(path_or_url)
+        if self.workers:
+            blocks = self._pool().submit(layout_blocks, source).result()
+        else:
+            blocks = layout_blocks(source)
+        return Document(blocks)
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+
+def create_reader(backend='llmsherpa', llmsherpa_api_url=None, parse_cache='parse_cache', workers=0):
+    '''
+    Layout reader of one of the READERS backends
+    :param llmsherpa_api_url: parser endpoint of the llmsherpa backend
+    :param parse_cache: directory caching parsed layouts by PDF content hash, None or '' disables it
+    :param workers: processes of the local backend, 0 parses in the calling thread
+    '''
+    if backend == 'llmsherpa':
+        reader = LayoutPDFReader(llmsherpa_api_url)
+        parser_id = llmsherpa_api_url
+    elif backend == 'local':
+        reader = LocalLayoutPDFReader(workers=workers)
+        parser_id = reader.parser_id
+    else:
+        raise ValueError(f'unknown layout reader {backend!r}, expected one of {", ".join(READERS)}')
+    if parse_cache:
+        return CachedLayoutPDFReader(parser_id, cache_dir=parse_cache, reader=reader)
+    return reader
+
+
+def read_documents(read, pdf_paths, workers=1):
+    '''
+    Reads PDFs in order with up to workers reads in flight, so a serial consumer overlaps its own work with
+    parser requests or the local process pool
+    :param read: function of a PDF path returning its Document, e.g. a reader's read_pdf
+    :param workers: number of reads in flight, 1 reads one PDF at a time
+    :return: iterator of (path, Document, None), or (path, None, exception) for a PDF that failed
+    '''
+    if workers <= 1:
+        for path in pdf_paths:
+            try:
+                yield path, read(path), None
+            except Exception as e:
+                yield path, None, e
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = collections.deque()
+
+        def next_result():
+            path, future = pending.popleft()
+            try:
+                return path, future.result(), None
+            except Exception as e:
+                return path, None, e
+
+        for path in pdf_paths:
+            pending.append((path, executor.submit(read, path)))
+            if len(pending) >= 2 * workers:
+                yield next_result()
+        while pending:
+            yield next_result()
@@ -0,0 +1,338 @@
+'''
+Counters, timers and spans shared by the pipelines.
+
+The pipelines report what they do through the module functions below, which forward to one process-wide
+recorder. Until configure() is called that recorder is a no-op: span() and timer() return one shared
+context manager that does nothing and count() returns immediately, so instrumented code costs a function
+call per event when metrics are off.
+
+    count(name, value, **labels)    counter, e.g. bytes, tokens, api_calls, cache_hits, retries
+    timer(name, **labels)           context manager adding its duration to the timer name
+    span(name, parent, **attrs)     timer that is also written to the JSON-lines file, nested spans share
+                                    the trace of their root span (one per document), parent= links a span
+                                    to one opened in another thread, e.g. a parse worker's document span
+
+Enabled, every finished span is appended to the JSON-lines file as
+    {"type": "span", "name": ..., "trace": ..., "span": ..., "parent": ..., "start": ..., "seconds": ..., <attrs>}
+and close() appends the totals. Counters and timers are written as a Prometheus textfile (counters as
+<prefix>_<name>_total, timers as <prefix>_<name>_seconds_count/_sum), atomically and at most every
+prometheus_interval seconds while spans finish, and again at exit. A forked worker process inherits a
+configured recorder but records nothing, only the process that called configure() writes the files.
+
+Usage:
+    import metrics
+    metrics.configure(jsonl='ingest.metrics.jsonl', prometheus='ingest.prom')   # or configure_from_env()
+    with metrics.span('document', path=str(pdf_file)):
+        with metrics.span('parse'):
+            doc = pdf_reader.read_pdf(str(pdf_file))
+        metrics.count('chunks', len(doc.chunks()))
+    with metrics.timer('api_call', service='embeddings'):
+        ...
+'''
+import atexit
+import contextvars
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+JSONL_ENV = 'PIPELINE_METRICS_JSONL'
+PROMETHEUS_ENV = 'PIPELINE_METRICS_PROM'
+
+# innermost open span of the current thread (or asyncio task)
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+class _NullSpan:
+    '''Context manager standing in for timers and spans while metrics are disabled.'''
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class NullMetrics:
+    '''The disabled recorder.'''
+    enabled = False
+
+    def span(self, name, parent=None, **attributes):
+        return NULL_SPAN
+
+    def timer(self, name, **labels):
+        return NULL_SPAN
+
+    def count(self, name, value=1, **labels):
+        pass
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+    def set(self, **labels):
+        self.labels.update(labels)
+
+
+class Span:
+    '''
+    A timed, named unit of work with attributes, see Metrics.span
+    :param parent: enclosing span, the innermost open span of this thread if None
+    '''
+
+    def __init__(self, metrics, name, parent, attributes):
+        self.metrics = metrics
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.span_id = next(metrics._ids)
+
+    def set(self, **attributes):
+        '''Adds attributes known only once the work ran, e.g. a chunk count.'''
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        if self.parent is None:
+            self.parent = _current_span.get()
+        self.trace_id = self.parent.trace_id if self.parent is not None else self.span_id
+        self._token = _current_span.set(self)
+        self.started = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        seconds = time.perf_counter() - self.start
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attributes['error'] = f'{exc_type.__name__}: {exc}'
+        self.metrics._finish(self, seconds)
+        return False
+
+
+def metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{metric_name(key)}="{_label_value(value)}"' for key, value in labels) + '}'
+
+
+class Metrics:
+    '''
+    Enabled recorder, aggregating counters and timers in memory
+    :param jsonl: JSON-lines file spans and totals are appended to, or None
+    :param prometheus: Prometheus textfile written with the counters and timers, or None
+    :param prefix: prefix of the Prometheus metric names
+    :param prometheus_interval: minimum seconds between two textfile writes while the run is going
+    '''
+    enabled = True
+
+    def __init__(self, jsonl=None, prometheus=None, prefix='pipeline', prometheus_interval=15.0):
+        self.jsonl_path = jsonl
+        self.prometheus_path = prometheus
+        self.prefix = prefix
+        self.prometheus_interval = prometheus_interval
+        self.pid = os.getpid()
+        self._counters = {}
+        self._timers = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._last_prometheus = time.monotonic()
+        self._jsonl = None
+        if jsonl:
+            os.makedirs(os.path.dirname(os.path.abspath(jsonl)), exist_ok=True)
+            self._jsonl = open(jsonl, 'a', encoding='utf-8')
+
+    def _inherited(self):
+        # a forked worker shares the parent's file handle, its copy of the buffer must never be written
+        return os.getpid() != self.pid
+
+    def span(self, name, parent=None, **attributes):
+        if self._inherited():
+            return NULL_SPAN
+        return Span(self, name, parent, attributes)
+
+    def timer(self, name, **labels):
+        if self._inherited():
+            return NULL_SPAN
+        return Timer(self, name, labels)
+
+    def count(self, name, value=1, **labels):
+        if self._inherited():
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        '''Adds one duration to the timer name.'''
+        if self._inherited():
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None:
+                timer = self._timers[key] = [0, 0.0, 0.0]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def _finish(self, span, seconds):
+        self.observe(span.name, seconds)
+        if self._jsonl is not None:
+            record = {'type': 'span', 'name': span.name, 'trace': span.trace_id, 'span': span.span_id,
+                      'parent': span.parent.span_id if span.parent is not None else None,
+                      'start': span.started, 'seconds': seconds, **span.attributes}
+            line = json.dumps(record, default=str) + '\n'
+            with self._lock:
+                self._jsonl.write(line)
+        if self.prometheus_path and time.monotonic() - self._last_prometheus >= self.prometheus_interval:
+            self.write_prometheus()
+
+    def snapshot(self):
+        '''Counters and timers (count, total seconds, max seconds) as lists of dicts.'''
+        with self._lock:
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value in sorted(self._counters.items())]
+            timers = [{'name': name, 'labels': dict(labels), 'count': count, 'seconds': total, 'max_seconds': longest}
+                      for (name, labels), (count, total, longest) in sorted(self._timers.items())]
+        return {'counters': counters, 'timers': timers}
+
+    def prometheus_text(self):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            timers = sorted(self._timers.items())
+        lines = []
+        for suffix, kind, series in (('_total', 'counter', [(name, labels, value) for (name, labels), value in counters]),
+                                     ('_seconds', 'summary', [(name, labels, timer) for (name, labels), timer in timers])):
+            declared = set()
+            for name, labels, value in series:
+                full_name = f'{self.prefix}_{metric_name(name)}{suffix}'
+                if full_name not in declared:
+                    declared.add(full_name)
+                    lines.append(f'# TYPE {full_name} {kind}')
+                if kind == 'counter':
+                    lines.append(f'{full_name}{_label_text(labels)} {value}')
+                else:
+                    lines.append(f'{full_name}_count{_label_text(labels)} {value[0]}')
+                    lines.append(f'{full_name}_sum{_label_text(labels)} {value[1]:.6f}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path=None):
+        '''Writes the textfile through a temporary file, a collector never reads a partial file.'''
+        path = path or self.prometheus_path
+        if not path or self._inherited():
+            return
+        self._last_prometheus = time.monotonic()
+        text = self.prometheus_text()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def flush(self):
+        if self._inherited():
+            return
+        if self._jsonl is not None:
+            with self._lock:
+                self._jsonl.flush()
+        self.write_prometheus()
+
+    def close(self):
+        '''Appends the totals to the JSON-lines file and writes the textfile a last time.'''
+        if self._inherited():
+            return
+        if self._jsonl is not None:
+            totals = json.dumps({'type': 'totals', 'time': time.time(), **self.snapshot()}, default=str) + '\n'
+            with self._lock:
+                self._jsonl.write(totals)
+                self._jsonl.close()
+                self._jsonl = None
+        self.write_prometheus()
+
+
+_metrics = NullMetrics()
+
+
+def configure(jsonl=None, prometheus=None, **kwargs):
+    '''
+    Enables metrics for this process, or disables them when neither file is given. The previous recorder
+    is closed, the new one is closed at exit
+    :return: the recorder
+    '''
+    global _metrics
+    _metrics.close()
+    _metrics = Metrics(jsonl, prometheus, **kwargs) if jsonl or prometheus else NullMetrics()
+    return _metrics
+
+
+def configure_from_env(**kwargs):
+    '''configure() with the files named by PIPELINE_METRICS_JSONL and PIPELINE_METRICS_PROM, if set.'''
+    return configure(os.environ.get(JSONL_ENV) or None, os.environ.get(PROMETHEUS_ENV) or None, **kwargs)
+
+
+def get_metrics():
+    return _metrics
+
+
+def span(name, parent=None, **attributes):
+    return _metrics.span(name, parent, **attributes)
+
+
+def timer(name, **labels):
+    return _metrics.timer(name, **labels)
+
+
+def count(name, value=1, **labels):
+    _metrics.count(name, value, **labels)
+
+
+def observe(name, seconds, **labels):
+    _metrics.observe(name, seconds, **labels)
+
+
+def flush():
+    _metrics.flush()
+
+
+def close():
+    _metrics.close()
+
+
+atexit.register(close)
@@ -1,76 +1,143 @@
 import pandas as pd
 from pathlib import Path
 import numpy as np
-from llmsherpa.readers import LayoutPDFReader
-import openai
-from openai import OpenAI
+from layout_readers import READERS, create_reader, read_documents
+import metrics
+from embedding_store import EmbeddingStore
+from vector_db import VectorDBWriter, read_vector_db, vector_db_exists
+from chunking import get_encoding
+from embedding_batcher import EmbeddingBatcher, OpenAIEmbeddingClient, RateLimiter
 import os
 from tqdm import tqdm
 from urllib3.exceptions import ProtocolError
-import tiktoken
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(
-    # this is also the default, it can be omitted
-    api_key=os.environ['OPENAI_API_KEY'],
-)
+# created on first use, so importing this module needs neither the openai package nor OPENAI_API_KEY
+client = None
+
+
+def get_client():
+    """The shared OpenAI client, configured from OPENAI_API_KEY (and OPENAI_BASE_URL, e.g. a local fake server)."""
+    global client
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI()
+    return client
+
+
+# point this at a private parser instance or a local fake server, e.g. http://172.17.0.3:5001/api/parseDocument?renderFormat=all
+LLMSHERPA_API_URL = os.environ.get('LLMSHERPA_API_URL', "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all")
 
 
 def truncate_text_tokens(text, encoding_name= 'cl100k_base', max_tokens=8191):
     """Truncate a string to have `max_tokens` according to the given encoding."""
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(encoding_name)
     return encoding.encode(text)[:max_tokens]
 
 
-def get_embedding(text, model="text-embedding-3-small"):
+def get_embedding(text, model="text-embedding-3-small", store=None):
     text = text.replace("\n", " ")
+    if store is not None:
+        # only texts the shared store has not seen are sent to the API
+        return store.embed([text], lambda texts: [get_embedding(t, model=model) for t in texts])[0].tolist()
     text = truncate_text_tokens(text)
-    return client.embeddings.create(input=[text], model=model).data[0].embedding
+    return get_client().embeddings.create(input=[text], model=model).data[0].embedding
 
 
-def create_df(pdf_urls):
-    llmsherpa_api_url = "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all"
-    # llmsherpa_api_url = "http://172.17.0.3:5001/api/parseDocument?renderFormat=all"
-    pdf_reader = LayoutPDFReader(llmsherpa_api_url)
+def create_batcher(store=None, model="text-embedding-3-small", workers=4, requests_per_minute=3000, tokens_per_minute=1000000):
+    '''Embedding batcher packing chunks of many documents into concurrent, rate limited API requests'''
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    return EmbeddingBatcher(OpenAIEmbeddingClient(model, client=get_client()), workers=workers, limiter=limiter, store=store)
+
+
+def iter_chunks(pdf_urls, parse_cache='parse_cache', pdf_reader=None, parse_workers=1):
+    '''
+    Yields a row for every chunk of every pdf, writing the pdfs that failed to failed_pdfs
+    :param pdf_reader: layout reader, see layout_readers.py, defaults to the llmsherpa parser at LLMSHERPA_API_URL
+    :param parse_workers: number of pdfs parsed at once, ahead of the one being chunked
+    '''
+    if pdf_reader is None:
+        # parsed layouts are cached by PDF content hash, re-runs skip the parser entirely
+        pdf_reader = create_reader('llmsherpa', LLMSHERPA_API_URL, parse_cache=parse_cache)
+
+    def parse(pdf_url):
+        with metrics.span('parse', path=str(pdf_url)):
+            return pdf_reader.read_pdf(str(pdf_url))
 
-    # Initialize a list to hold the data
-    data = []
     failed = []
-    for pdf_url in tqdm(pdf_urls):
+    for pdf_url, doc, error in read_documents(parse, tqdm(pdf_urls), workers=parse_workers):
         print(f'Processing {pdf_url}')
-        try:
-            doc = pdf_reader.read_pdf(str(pdf_url))
-        except KeyError as e:
-            print(f'Skipping {pdf_url} due to KeyError: {e}')
-            failed.append(pdf_url)
-            continue
-        except ProtocolError as e:
-            print(f'Skipping {pdf_url} due to ProtocolError: {e}')
-            failed.append(pdf_url)
-            continue
-        except Exception as e:
-            print(f'Failed to process {pdf_url} due to {e}')
+        if error is not None:
+            if isinstance(error, (KeyError, ProtocolError)):
+                print(f'Skipping {pdf_url} due to {type(error).__name__}: {error}')
+            else:
+                print(f'Failed to process {pdf_url} due to {error}')
+            metrics.count('documents', stage='parse', status='failed')
             failed.append(pdf_url)
             continue
 
-        # Append to data for each chunk in the document
-        for i, chunk in enumerate(doc.chunks()):
+        chunks = doc.chunks()
+        metrics.count('documents', stage='parse', status='ok')
+        metrics.count('chunks', len(chunks))
+        for i, chunk in enumerate(chunks):
             text = chunk.to_context_text()
             section = str(chunk.parent.to_text())
-            data.append({"file_id": pdf_url.stem, "text": text, "vector_embedding": get_embedding(text), "section": section, "document_id": i})
+            yield {"file_id": pdf_url.stem, "text": text, "section": section, "document_id": i}
 
-    # Convert the list to a DataFrame
     print(f'Failed to process {len(failed)} pdfs')
     with open('failed_pdfs', 'w') as f:
         for pdf in failed:
             f.write(f'{pdf}\n')
+
+
+def iter_embedded_chunks(pdf_urls, parse_cache='parse_cache', store=None, batcher=None, pdf_reader=None, parse_workers=1):
+    '''Yields (row, embedding) for every chunk of every pdf, parsing later pdfs while earlier chunks are embedded'''
+    if batcher is None:
+        batcher = create_batcher(store=store)
+    rows = iter_chunks(pdf_urls, parse_cache=parse_cache, pdf_reader=pdf_reader, parse_workers=parse_workers)
+    return batcher.embed_iter((row, row["text"].replace("\n", " ")) for row in rows)
+
+
+def create_df(pdf_urls, parse_cache='parse_cache', store=None, batcher=None, pdf_reader=None, parse_workers=1):
+    # Initialize a list to hold the data
+    data = []
+    for row, embedding in iter_embedded_chunks(pdf_urls, parse_cache=parse_cache, store=store, batcher=batcher,
+                                               pdf_reader=pdf_reader, parse_workers=parse_workers):
+        data.append({**row, "vector_embedding": embedding.tolist()})
+    # Convert the list to a DataFrame
     return pd.DataFrame(data)
 
 
+def create_vector_db(pdf_urls, path, parse_cache='parse_cache', store=None, batcher=None, pdf_reader=None, parse_workers=1):
+    '''
+    Writes the chunks of pdf_urls and their embeddings to the columnar vector DB at path as they are
+    produced, see vector_db.py
+    '''
+    with VectorDBWriter(path) as writer:
+        for row, embedding in iter_embedded_chunks(pdf_urls, parse_cache=parse_cache, store=store, batcher=batcher,
+                                                   pdf_reader=pdf_reader, parse_workers=parse_workers):
+            writer.write([row], [embedding])
+    return read_vector_db(path)
+
+
 
 if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Embeds the chunks of the darwin query and candidate papers')
+    parser.add_argument('--reader', choices=READERS, default='llmsherpa',
+                        help='layout backend: llmsherpa sends every PDF to LLMSHERPA_API_URL, local parses them in a process pool')
+    parser.add_argument('--layout_workers', type=int, default=os.cpu_count(), help='processes of the local layout reader')
+    parser.add_argument('--parse_workers', type=int, default=0,
+                        help='PDFs parsed at once (default: --layout_workers for the local reader, 1 for llmsherpa)')
+    args = parser.parse_args()
+    parse_workers = args.parse_workers or (args.layout_workers if args.reader == 'local' else 1)
+    pdf_reader = create_reader(args.reader, LLMSHERPA_API_URL, parse_cache='parse_cache', workers=args.layout_workers)
+
+    # span and counter files are named by PIPELINE_METRICS_JSONL and PIPELINE_METRICS_PROM, off if unset
+    metrics.configure_from_env()
 
     redo_embedding = True
+    # re-embedding is cheap, unchanged chunks come from the shared embedding store
+    store = EmbeddingStore('embedding_store', model="text-embedding-3-small")
     with open('darwin/qpaper_to_emb', 'r') as f:
         query_papers = [line.strip() for line in f]
 
@@ -83,17 +150,20 @@ if __name__ == "__main__":
     qpdf_urls = [Path(f'darwin/query_papers/{pdf}.pdf') for pdf in query_papers]
     cdpdf_urls = [Path(f'darwin/candidate_papers/{pdf}.pdf') for pdf in candidate_papers]
 
-    # If the query_vector_db.csv exists, read it
-    if os.path.exists('query_vector_db.csv') and not redo_embedding:
-        print('Reading query_vector_db.csv')
-        query_df = pd.read_csv('query_vector_db.csv')
+    # Metadata columns go to <name>.arrow and embeddings to a float32 <name>.f32 matrix, both memory-mapped on read
+    if vector_db_exists('query_vector_db') and not redo_embedding:
+        print('Reading query_vector_db')
+        query_df, query_vectors = read_vector_db('query_vector_db')
     else:
-        query_df = create_df(qpdf_urls)
-        query_df.to_csv('query_vector_db.csv', index=False)
+        query_df, query_vectors = create_vector_db(qpdf_urls, 'query_vector_db', store=store, pdf_reader=pdf_reader,
+                                                   parse_workers=parse_workers)
 
-    if os.path.exists('candidate_vector_db.csv') and not redo_embedding:
-        print('Reading candidate_vector_db.csv')
-        candidade_df= pd.read_csv('candidate_vector_db.csv')
+    if vector_db_exists('candidate_vector_db') and not redo_embedding:
+        print('Reading candidate_vector_db')
+        candidate_df, candidate_vectors = read_vector_db('candidate_vector_db')
     else:
-        candidate_df = create_df(cdpdf_urls)
-        candidate_df.to_csv('candidate_vector_db.csv', index=False)
+        candidate_df, candidate_vectors = create_vector_db(cdpdf_urls, 'candidate_vector_db', store=store, pdf_reader=pdf_reader,
+                                                           parse_workers=parse_workers)
+    # shuts down the local reader's process pool, the llmsherpa reader holds nothing to close
+    if hasattr(pdf_reader, 'close'):
+        pdf_reader.close()
@@ -1,49 +1,63 @@
 import pandas as pd
 from pathlib import Path
 import os
-import openai
-from openai import OpenAI
-from PyPDF2 import PdfReader
-import tiktoken
-import tiktoken
 from PyPDF2 import PdfReader
 import concurrent.futures
+import multiprocessing
+import queue
+import threading
+import metrics
+from embedding_store import EmbeddingStore
+from chunking import TokenChunker
+from embedding_batcher import EmbeddingBatcher, OpenAIEmbeddingClient, RateLimiter
+from vector_db import VectorDBWriter, read_vector_db, vector_db_exists
+
+# Set up the OpenAI client on first use, so importing this module needs neither the openai package nor OPENAI_API_KEY
+client = None
+
+
+def get_client():
+    """The shared OpenAI client, configured from OPENAI_API_KEY (and OPENAI_BASE_URL, e.g. a local fake server)."""
+    global client
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI()
+    return client
 
-# Set up the OpenAI client
-openai.api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(
-    # this is also the default, it can be omitted
-    api_key=os.environ['OPENAI_API_KEY'],
-)
 
 def chunk_text_to_fit_tokens(text, encoding_name='cl100k_base', max_tokens=8191):
     """Chunk text to ensure each chunk fits within a specified number of tokens."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    tokens = encoding.encode(text)
-
-    # Chunk tokens to fit within the max_tokens limit
-    chunks = []
-    for i in range(0, len(tokens), max_tokens):
-        chunk_token_ids = tokens[i:i + max_tokens]
-        chunk_text = encoding.decode(chunk_token_ids)
-        chunks.append(chunk_text)
-    return chunks
+    # one encode of the whole text, chunks are slices at token boundaries
+    return [chunk for _, chunk in TokenChunker(max_tokens, encoding_name)(text)]
+
+def extract_pdf_text(file_path):
+    """Read the text of all pages of a PDF file."""
+    pdf = PdfReader(file_path)
+    full_text = ""
+    for page in pdf.pages:
+        page_text = page.extract_text()
+        if page_text:
+            full_text += page_text + " "  # Adding space to separate text between pages
+    return full_text.replace("\n", " ")
 
 def chunk_pdf_with_tiktoken(file_path, encoding_name='cl100k_base', max_tokens=8191):
     """Read PDF file and chunk its text into sections, each fitting within the token limit."""
     try:
-        pdf = PdfReader(file_path)
-        full_text = ""
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            if page_text:
-                full_text += page_text + " "  # Adding space to separate text between pages
-        full_text = full_text.replace("\n", " ")
-        return chunk_text_to_fit_tokens(full_text, encoding_name, max_tokens)
+        return chunk_text_to_fit_tokens(extract_pdf_text(file_path), encoding_name, max_tokens)
     except Exception as e:
         print(f"Failed to process {file_path} with error: {e}")
         return []
 
+def extract_chunk_records(file_path, encoding_name='cl100k_base', max_tokens=1000):
+    """Extract and chunk one PDF into (file_id, [(sanitized chunk, token count)]), run in worker processes."""
+    try:
+        text = extract_pdf_text(file_path)
+        spans = list(TokenChunker(max_tokens, encoding_name).spans(text))
+    except Exception as e:
+        print(f"Failed to process {file_path} with error: {e}")
+        return file_path.stem, []
+    return file_path.stem, [(sanitize_text(text[start:end]), n_tokens) for _, start, end, n_tokens in spans]
+
 def sanitize_text(text):
     """Sanitize text for safe CSV/TSV output."""
     text = text.replace('\n', ' ').replace('\r', ' ')
@@ -74,9 +88,14 @@ def create_df_debug(file_paths, encoding_name='cl100k_base', max_tokens=1000):
     return pd.DataFrame(data)
 
 
-def get_embeddings(texts, model="text-embedding-3-small"):
+def get_embeddings(texts, model="text-embedding-3-small", store=None):
     try:
-        response = client.embeddings.create(input=texts, model=model)
+        if store is not None:
+            # only texts the shared store has not seen are sent to the API, a failed call raises before
+            # anything is stored
+            return store.embed(texts, lambda batch: [embedding.embedding for embedding in
+                                                     get_client().embeddings.create(input=batch, model=model).data]).tolist()
+        response = get_client().embeddings.create(input=texts, model=model)
         # Extracting embeddings directly from the response object
         embeddings = [embedding.embedding for embedding in response.data]
         return embeddings
@@ -85,55 +104,126 @@ def get_embeddings(texts, model="text-embedding-3-small"):
         return []
 
 
-def create_df(file_paths, encoding_name='cl100k_base', max_tokens=1000, batch_size=10):
+def create_batcher(store=None, model="text-embedding-3-small", batch_size=512, workers=4, requests_per_minute=3000, tokens_per_minute=1000000):
+    """Create an embedding batcher packing chunks of many documents into concurrent, rate limited API requests."""
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    return EmbeddingBatcher(OpenAIEmbeddingClient(model, client=get_client()), max_batch_items=batch_size,
+                            workers=workers, limiter=limiter, store=store)
+
+
+def count_chunk_records(chunks):
+    """Counts one extracted document, its chunks and their tokens."""
+    metrics.count('documents', stage='extract', status='ok' if chunks else 'empty')
+    metrics.count('chunks', len(chunks))
+    metrics.count('tokens', sum(n_tokens for _, n_tokens in chunks), stage='chunking')
+
+
+def iter_chunk_records(file_paths, encoding_name='cl100k_base', max_tokens=1000, extract_workers=0, queue_size=10000):
+    """
+    Yield (row, text, token count) for the text chunks of file_paths.
+    With extract_workers > 0 a process pool extracts and tokenizes PDFs in parallel, and a producer thread
+    streams their chunks through a bounded queue, so extraction runs ahead of the consumer by at most
+    queue_size chunks while the consumer embeds.
+    """
+    if not extract_workers:
+        for file_path in file_paths:
+            with metrics.span('extract', path=str(file_path)) as span:
+                file_id, chunks = extract_chunk_records(file_path, encoding_name, max_tokens)
+                span.set(chunks=len(chunks))
+            count_chunk_records(chunks)
+            for i, (chunk, n_tokens) in enumerate(chunks):
+                yield {"file_id": file_id, "chunk_id": i, "text": chunk}, chunk, n_tokens
+        return
+
+    records = queue.Queue(maxsize=queue_size)
+    done = object()
+    stop = threading.Event()
+    errors = []
+
+    def produce():
+        try:
+            # spawned, not forked: this thread's process also runs the batcher's threads, whose locks a fork would copy held
+            with concurrent.futures.ProcessPoolExecutor(max_workers=extract_workers,
+                                                        mp_context=multiprocessing.get_context('spawn')) as executor:
+                # a sliding window of submissions keeps every worker busy while preserving document order
+                pending = []
+                paths = iter(file_paths)
+                for file_path in paths:
+                    pending.append(executor.submit(extract_chunk_records, file_path, encoding_name, max_tokens))
+                    if len(pending) == 2 * extract_workers:
+                        break
+                while pending and not stop.is_set():
+                    # time spent waiting on the pool, extraction itself runs in the workers
+                    with metrics.timer('extract_wait'):
+                        file_id, chunks = pending.pop(0).result()
+                    count_chunk_records(chunks)
+                    next_path = next(paths, None)
+                    if next_path is not None:
+                        pending.append(executor.submit(extract_chunk_records, next_path, encoding_name, max_tokens))
+                    for i, (chunk, n_tokens) in enumerate(chunks):
+                        records.put(({"file_id": file_id, "chunk_id": i, "text": chunk}, chunk, n_tokens))
+                for future in pending:
+                    future.cancel()
+        except Exception as e:
+            errors.append(e)
+        finally:
+            records.put(done)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while (record := records.get()) is not done:
+            yield record
+    finally:
+        # the consumer stopped early, unblock the producer and let it wind the pool down
+        stop.set()
+        while producer.is_alive():
+            try:
+                records.get(timeout=0.1)
+            except queue.Empty:
+                pass
+    if errors:
+        raise errors[0]
+
+
+def iter_embedded_chunks(file_paths, encoding_name='cl100k_base', max_tokens=1000, batch_size=512, store=None,
+                         batcher=None, extract_workers=0, queue_size=10000):
+    """Yield (row, embedding) for the text chunks of file_paths, embedding earlier chunks while later PDFs are extracted."""
+    if batcher is None:
+        batcher = create_batcher(store=store, batch_size=batch_size)
+    records = iter_chunk_records(file_paths, encoding_name, max_tokens, extract_workers, queue_size)
+    return batcher.embed_iter(records)
+
+
+def create_df(file_paths, encoding_name='cl100k_base', max_tokens=1000, batch_size=512, store=None, batcher=None,
+              extract_workers=0):
     """Create a DataFrame with file ID, text chunks, and their embeddings in batches."""
     data = []
-    batch_texts = []
-    batch_identifiers = []  # To track file_id and chunk_id for reassembly
+    for row, embedding in iter_embedded_chunks(file_paths, encoding_name, max_tokens, batch_size, store, batcher,
+                                               extract_workers):
+        data.append({**row, "vector_embedding": embedding_to_string(embedding)})
+    return pd.DataFrame(data)
 
-    for file_path in file_paths:
-        file_id = file_path.stem
-        chunks = chunk_pdf_with_tiktoken(file_path, encoding_name, max_tokens)
-        for i, chunk in enumerate(chunks):
-            sanitized_chunk = sanitize_text(chunk)
-            batch_texts.append(sanitized_chunk)
-            batch_identifiers.append((file_id, i))
-
-            # Process in batches
-            if len(batch_texts) == batch_size:
-                embeddings = get_embeddings(batch_texts)
-                for idx, embedding in enumerate(embeddings):
-                    file_id, chunk_id = batch_identifiers[idx]
-                    embedding_str = embedding_to_string(embedding)
-                    data.append({
-                        "file_id": file_id,
-                        "chunk_id": chunk_id,
-                        "text": batch_texts[idx],
-                        "vector_embedding": embedding_str
-                    })
-                # Clear batch lists
-                batch_texts = []
-                batch_identifiers = []
-
-    # Process any remaining items in the batch
-    if batch_texts:
-        embeddings = get_embeddings(batch_texts)
-        for idx, embedding in enumerate(embeddings):
-            file_id, chunk_id = batch_identifiers[idx]
-            embedding_str = embedding_to_string(embedding)
-            data.append({
-                "file_id": file_id,
-                "chunk_id": chunk_id,
-                "text": batch_texts[idx],
-                "vector_embedding": embedding_str
-            })
 
-    return pd.DataFrame(data)
+def create_vector_db(file_paths, path, encoding_name='cl100k_base', max_tokens=1000, batch_size=512, store=None,
+                     batcher=None, extract_workers=0):
+    """Write text chunks and their embeddings to the columnar vector DB at path as they are produced, see vector_db.py."""
+    with VectorDBWriter(path) as writer:
+        for row, embedding in iter_embedded_chunks(file_paths, encoding_name, max_tokens, batch_size, store, batcher,
+                                                   extract_workers):
+            writer.write([row], [embedding])
+    return read_vector_db(path)
 
 
 
 if __name__ == "__main__":
+    # span and counter files are named by PIPELINE_METRICS_JSONL and PIPELINE_METRICS_PROM, off if unset
+    metrics.configure_from_env()
     redo_embedding = True
+    # PDFs are extracted on all cores while earlier chunks are embedded
+    extract_workers = os.cpu_count()
+    # re-embedding is cheap, unchanged chunks come from the shared embedding store
+    store = EmbeddingStore('embedding_store', model="text-embedding-3-small")
     with open('darwin/qpaper_to_emb', 'r') as f:
         query_papers = [line.strip() for line in f]
 
@@ -148,18 +238,17 @@ if __name__ == "__main__":
     # # Example usage
     # print(truncate_text_tokens("Example text that might be too long and needs to be truncated.", 'cl100k_base', 10))
 
-    if os.path.exists('query_vector_db.csv') and not redo_embedding:
-        query_df = pd.read_csv('query_vector_db.csv')
-        print("Dataframe loaded from query_vector_db.csv.")
+    # Metadata columns go to <name>.arrow and embeddings to a float32 <name>.f32 matrix, both memory-mapped on read
+    if vector_db_exists('query_vector_db') and not redo_embedding:
+        query_df, query_vectors = read_vector_db('query_vector_db')
+        print("Dataframe loaded from query_vector_db.")
     else:
-        query_df = create_df(query_papers)
-        query_df.to_csv('query_vector_db.csv', index=False)
+        query_df, query_vectors = create_vector_db(query_papers, 'query_vector_db', store=store, extract_workers=extract_workers)
         print("Dataframe created and saved.")
         print(query_df.head())
     print('done with query_df')
-    if os.path.exists('candidate_vector_db.csv') and not redo_embedding:
-        print('Reading candidate_vector_db.csv')
-        candidade_df= pd.read_csv('candidate_vector_db.csv')
+    if vector_db_exists('candidate_vector_db') and not redo_embedding:
+        print('Reading candidate_vector_db')
+        candidate_df, candidate_vectors = read_vector_db('candidate_vector_db')
     else:
-        candidate_df = create_df(candidate_papers)
-        candidate_df.to_csv('candidate_vector_db.csv', index=False)
+        candidate_df, candidate_vectors = create_vector_db(candidate_papers, 'candidate_vector_db', store=store, extract_workers=extract_workers)
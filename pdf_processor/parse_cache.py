@@ -0,0 +1,101 @@
+'''
+Content-addressed cache for layout parser results.
+
+LayoutPDFReader sends the whole PDF to the llmsherpa parser on every call. CachedLayoutPDFReader keys
+each parse by the SHA-256 of the PDF bytes plus the parser URL and version, stores the layout blocks
+(`doc.json`) as gzipped compact JSON, and rebuilds the Document from disk without a network call on
+later runs. Re-ingesting or re-embedding a corpus after a schema or prompt change then only costs
+local disk reads.
+'''
+import gzip
+import hashlib
+import importlib.metadata
+import json
+import os
+import threading
+from pathlib import Path
+
+from llmsherpa.readers import Document, LayoutPDFReader
+
+import metrics
+
+
+def parser_version():
+    try:
+        return importlib.metadata.version('llmsherpa')
+    except importlib.metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+class CachedLayoutPDFReader:
+    '''
+    Drop-in replacement for LayoutPDFReader that caches parse results on disk
+    :param parser_api_url: API url of the llmsherpa parser, or the parser_id of another reader
+    :param cache_dir: directory holding the cached layouts
+    :param reader: reader used on a cache miss, defaults to a LayoutPDFReader for parser_api_url, see layout_readers.py
+    '''
+
+    def __init__(self, parser_api_url, cache_dir='parse_cache', reader=None):
+        self.reader = reader if reader is not None else LayoutPDFReader(parser_api_url)
+        self.cache_dir = Path(cache_dir)
+        self.parser_id = f'{parser_api_url}|llmsherpa {parser_version()}'
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        '''Closes the inner reader, e.g. the process pool of a local layout reader.'''
+        close = getattr(self.reader, 'close', None)
+        if close is not None:
+            close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def cache_key(self, contents):
+        sha = hashlib.sha256(contents)
+        sha.update(b'\0' + self.parser_id.encode('utf-8'))
+        return sha.hexdigest()
+
+    def cache_path(self, key):
+        return self.cache_dir / key[:2] / f'{key}.json.gz'
+
+    def read_pdf(self, path_or_url, contents=None):
+        '''
+        Reads a pdf from a path, or from its contents, using the cache when possible
+        :param path_or_url: path to the pdf file, urls are passed through to the reader uncached
+        :param contents: contents of the pdf file, read from path_or_url if not given
+        '''
+        if contents is None:
+            if '://' in str(path_or_url):
+                return self.reader.read_pdf(path_or_url)
+            with open(path_or_url, 'rb') as f:
+                contents = f.read()
+
+        cache_path = self.cache_path(self.cache_key(contents))
+        if cache_path.exists():
+            with gzip.open(cache_path, 'rt', encoding='utf-8') as f:
+                blocks = json.load(f)
+            with self._lock:
+                self.hits += 1
+            metrics.count('cache_hits', cache='parse_cache')
+            return Document(blocks)
+
+        metrics.count('cache_misses', cache='parse_cache')
+        metrics.count('bytes', len(contents), stage='layout_parse')
+        with metrics.span('layout_request', bytes=len(contents)):
+            doc = self.reader.read_pdf(os.path.basename(str(path_or_url)), contents=contents)
+        metrics.count('api_calls', service=getattr(self.reader, 'service', 'llmsherpa'))
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temp file first so a crash never leaves a truncated entry behind
+        tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump(doc.json, f, separators=(',', ':'))
+        os.replace(tmp_path, cache_path)
+        with self._lock:
+            self.misses += 1
+        return doc
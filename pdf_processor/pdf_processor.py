@@ -1,6 +1,6 @@
 #
 # This is the demo of:
-#   - using LayoutPDFReader to read PDF files
+#   - using LayoutPDFReader (or the local layout reader, see layout_readers.py) to read PDF files
 #   - mapping PDF elements into a property graph
 #   - saving PDF elements into Neo4j
 # Need to save the following variables to your own environment variables:
@@ -11,7 +11,16 @@
 # Arguments
 #  - file_location # the folder where the PDF files are stored
 #  - loglevel # log level (default: INFO)
-#  - citation_matrix # citation matrix pickle file, if None then will create random
+#  - citation_matrix # citation matrix pickle file, or sparse .npz with ID sidecars (see citation_matrix.py), if None then will create random
+#  - citation_edges # edge list, labeled citation matrix CSV or sparse .npz between corpus IDs, used instead of citation_matrix
+#  - batch_size # rows per UNWIND statement when ingesting a document (default: 1000)
+#  - parse_workers, write_workers, queue_size # sizes of the parse -> Neo4j ingest pipeline
+#  - parse_cache # directory caching parsed layouts by PDF content hash (default: parse_cache)
+#  - incremental # skip PDFs whose content hash and ingest version match their Document node
+#  - llmsherpa_api_url # layout parser endpoint (default: LLMSHERPA_API_URL or the public llmsherpa API)
+#  - reader # layout backend, llmsherpa (HTTP parser) or local (PyPDF2 layout in a process pool) (default: llmsherpa)
+#  - layout_workers # processes of the local layout reader (default: number of CPUs)
+#  - metrics_jsonl, metrics_prom # span and totals JSON-lines file and Prometheus textfile, see metrics.py (default: off)
 
 
 # TODO the citation matrix will be random if there is no citation matrix file
@@ -19,10 +28,14 @@
 
 import hashlib
 import os
+import queue
+import threading
 from datetime import datetime
 import logging
 
-from llmsherpa.readers import LayoutPDFReader
+import numpy as np
+import metrics
+from layout_readers import READERS, create_reader
 from neo4j import GraphDatabase
 
 logger = logging.getLogger()
@@ -32,139 +45,384 @@ logging.basicConfig(
     level   = logging.INFO
 )
 
-def ingestDocumentNeo4j(doc, doc_location, driver):
+# bump when the graph written for a document changes, so --incremental re-ingests everything
+INGEST_VERSION = 1
+
+# One UNWIND statement per node and relationship type, rows are bound to $rows
+cypher_pool = [
+    # Document
+    "MERGE (d:Document {url_hash: $doc_url_hash_val}) ON CREATE SET d.url = $doc_url_val;",
+    # Section
+    "UNWIND $rows AS row MERGE (p:Section {key: $doc_url_hash_val+'|'+row.block_idx_val+'|'+row.title_hash_val}) ON CREATE SET p.page_idx = row.page_idx_val, p.title_hash = row.title_hash_val, p.block_idx = row.block_idx_val, p.title = row.title_val, p.tag = row.tag_val, p.level = row.level_val;",
+    # Link Section with the Document
+    "UNWIND $rows AS row MATCH (d:Document {url_hash: $doc_url_hash_val}) MATCH (s:Section {key: $doc_url_hash_val+'|'+row.block_idx_val+'|'+row.title_hash_val}) MERGE (d)<-[:HAS_DOCUMENT]-(s);",
+    # Link Section with a parent section
+    "UNWIND $rows AS row MATCH (s1:Section {key: $doc_url_hash_val+'|'+row.parent_block_idx_val+'|'+row.parent_title_hash_val}) MATCH (s2:Section {key: $doc_url_hash_val+'|'+row.block_idx_val+'|'+row.title_hash_val}) MERGE (s1)<-[:UNDER_SECTION]-(s2);",
+    # Chunk
+    "UNWIND $rows AS row MERGE (c:Chunk {key: $doc_url_hash_val+'|'+row.block_idx_val+'|'+row.sentences_hash_val}) ON CREATE SET c.sentences = row.sentences_val, c.sentences_hash = row.sentences_hash_val, c.block_idx = row.block_idx_val, c.page_idx = row.page_idx_val, c.tag = row.tag_val, c.level = row.level_val;",
+    # Link Chunk to Section
+    "UNWIND $rows AS row MATCH (c:Chunk {key: $doc_url_hash_val+'|'+row.block_idx_val+'|'+row.sentences_hash_val}) MATCH (s:Section {key:$doc_url_hash_val+'|'+row.parent_block_idx_val+'|'+row.parent_hash_val}) MERGE (s)<-[:HAS_PARENT]-(c);",
+    # Record what was ingested, written last so an interrupted ingest is retried
+    "MATCH (d:Document {url_hash: $doc_url_hash_val}) SET d.content_hash = $content_hash_val, d.ingest_version = $ingest_version_val;"
+]
+
+
+def documentUrlHash(doc_location):
     '''
-    Ingests a document into Neo4j
-    :param doc: Document object
+    Returns the url_hash identifying the Document node of a file
     :param doc_location: Document location
+    '''
+    return hashlib.md5(doc_location.encode("utf-8")).hexdigest()
+
+
+def fileContentHash(path):
+    '''
+    Returns the SHA-256 of a file's bytes
+    :param path: file location
+    '''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def fetchDocumentHashes(driver):
+    '''
+    Fetches the content hash and ingest version of every Document node in one query
     :param driver: Neo4j driver instance
+    :return: dictionary mapping url_hash to (content_hash, ingest_version)
     '''
+    with driver.session() as session:
+        result = session.run("MATCH (d:Document) RETURN d.url_hash AS url_hash, d.content_hash AS content_hash, d.ingest_version AS ingest_version;")
+        return {record['url_hash']: (record['content_hash'], record['ingest_version']) for record in result}
+
 
-    cypher_pool = [
-        # Document
-        "MERGE (d:Document {url_hash: $doc_url_hash_val}) ON CREATE SET d.url = $doc_url_val RETURN d;",
-        # Section
-        "MERGE (p:Section {key: $doc_url_hash_val+'|'+$block_idx_val+'|'+$title_hash_val}) ON CREATE SET p.page_idx = $page_idx_val, p.title_hash = $title_hash_val, p.block_idx = $block_idx_val, p.title = $title_val, p.tag = $tag_val, p.level = $level_val RETURN p;",
-        # Link Section with the Document
-        "MATCH (d:Document {url_hash: $doc_url_hash_val}) MATCH (s:Section {key: $doc_url_hash_val+'|'+$block_idx_val+'|'+$title_hash_val}) MERGE (d)<-[:HAS_DOCUMENT]-(s);",
-        # Link Section with a parent section
-        "MATCH (s1:Section {key: $doc_url_hash_val+'|'+$parent_block_idx_val+'|'+$parent_title_hash_val}) MATCH (s2:Section {key: $doc_url_hash_val+'|'+$block_idx_val+'|'+$title_hash_val}) MERGE (s1)<-[:UNDER_SECTION]-(s2);",
-        # Chunk
-        "MERGE (c:Chunk {key: $doc_url_hash_val+'|'+$block_idx_val+'|'+$sentences_hash_val}) ON CREATE SET c.sentences = $sentences_val, c.sentences_hash = $sentences_hash_val, c.block_idx = $block_idx_val, c.page_idx = $page_idx_val, c.tag = $tag_val, c.level = $level_val RETURN c;",
-        # Link Chunk to Section
-        "MATCH (c:Chunk {key: $doc_url_hash_val+'|'+$block_idx_val+'|'+$sentences_hash_val}) MATCH (s:Section {key:$doc_url_hash_val+'|'+$parent_block_idx_val+'|'+$parent_hash_val}) MERGE (s)<-[:HAS_PARENT]-(c);"
-    ]
+def _deleteDocumentSubgraphs(tx, url_hashes):
+    # Section and Chunk keys are prefixed with the document url_hash, so the key constraints serve the prefix match
+    for label in ('Section', 'Chunk'):
+        tx.run(f"UNWIND $hashes AS h MATCH (n:{label}) WHERE n.key STARTS WITH h + '|' DETACH DELETE n;", hashes=url_hashes).consume()
 
+
+def deleteDocumentSubgraphs(driver, url_hashes, batch_size=100):
+    '''
+    Removes the Section and Chunk nodes of documents, keeping the Document nodes and their CITES links
+    :param driver: Neo4j driver instance
+    :param url_hashes: url_hash of every document to clear
+    :param batch_size: number of documents cleared per transaction
+    '''
+    url_hashes = list(url_hashes)
+    with driver.session() as session:
+        for start in range(0, len(url_hashes), batch_size):
+            session.execute_write(_deleteDocumentSubgraphs, url_hashes[start:start + batch_size])
+
+
+def selectChangedDocuments(pdf_files, driver):
+    '''
+    Compares the PDF files with the Document nodes already in the graph
+    :param pdf_files: PDF file paths
+    :param driver: Neo4j driver instance
+    :return: dictionary mapping each new or changed PDF file to its content hash, and the
+             url_hash of the changed documents whose old subgraph has to be removed
+    '''
+    existing = fetchDocumentHashes(driver)
+    content_hashes = {}
+    stale = []
+    for pdf_file in pdf_files:
+        doc_url_hash_val = documentUrlHash(str(pdf_file))
+        content_hash_val = fileContentHash(pdf_file)
+        if existing.get(doc_url_hash_val) == (content_hash_val, INGEST_VERSION):
+            continue
+        content_hashes[pdf_file] = content_hash_val
+        if doc_url_hash_val in existing:
+            stale.append(doc_url_hash_val)
+    return content_hashes, stale
+
+
+def collectDocumentRows(doc):
+    '''
+    Collects the Section and Chunk rows of a document for the batched UNWIND statements
+    :param doc: Document object
+    :return: dictionary of row lists keyed by the cypher_pool index they are written with
+    '''
+    rows = {1: [], 2: [], 3: [], 4: [], 5: []}
+
+    # Process Sections
+    for sec in doc.sections():
+        logger.debug(f'Processing Section: {sec.title}')
+        sec_title_val = sec.title
+        sec_title_hash_val = hashlib.md5(sec_title_val.encode("utf-8")).hexdigest()
+        sec_tag_val = sec.tag  # Assuming 'tag' differentiates sections, like 'introduction', 'methodology', etc.
+        sec_level_val = sec.level  # Assuming 'level' indicates the hierarchy level of the section
+        sec_page_idx_val = sec.page_idx  # Assuming 'page_idx' and 'block_idx' help uniquely identify the section
+        sec_block_idx_val = sec.block_idx
+        if not sec_tag_val == 'table':
+            # Section node
+            rows[1].append(dict(page_idx_val=sec_page_idx_val, title_hash_val=sec_title_hash_val,
+                                title_val=sec_title_val, tag_val=sec_tag_val, level_val=sec_level_val,
+                                block_idx_val=sec_block_idx_val))
+
+            # Link Section with the Document or its parent section
+            sec_parent_val = str(sec.parent.to_text())
+            if sec_parent_val == "None":  # use document
+                rows[2].append(dict(title_hash_val=sec_title_hash_val, block_idx_val=sec_block_idx_val))
+            else:   # use parent section
+                sec_parent_title_hash_val = hashlib.md5(sec_parent_val.encode("utf-8")).hexdigest()
+                rows[3].append(dict(title_hash_val=sec_title_hash_val, block_idx_val=sec_block_idx_val,
+                                    parent_title_hash_val=sec_parent_title_hash_val,
+                                    parent_block_idx_val=sec.parent.block_idx))
+
+    # Process Chunks
+    for chk in doc.chunks():
+        chunk_sentences = "\n".join(chk.sentences)  # Assuming 'sentences' is a list of sentences in the chunk
+        chunk_sentences_hash_val = hashlib.md5(chunk_sentences.encode("utf-8")).hexdigest()
+        chunk_block_idx_val = chk.block_idx
+        chunk_tag_val = chk.tag  # Assuming 'tag' provides some categorization of chunks
+
+        if not chunk_tag_val == 'table':
+            # Chunk node
+            rows[4].append(dict(sentences_hash_val=chunk_sentences_hash_val, sentences_val=chunk_sentences,
+                                block_idx_val=chunk_block_idx_val, page_idx_val=chk.page_idx, tag_val=chunk_tag_val,
+                                level_val=chk.level))
+
+            # Link Chunk to its parent Section
+            chk_parent_val = str(chk.parent.to_text())
+            if chk_parent_val != 'None':
+                chk_parent_hash_val = hashlib.md5(chk_parent_val.encode("utf-8")).hexdigest()
+                rows[5].append(dict(sentences_hash_val=chunk_sentences_hash_val, block_idx_val=chunk_block_idx_val,
+                                    parent_hash_val=chk_parent_hash_val, parent_block_idx_val=chk.parent.block_idx))
+    return rows
+
+
+def _writeDocumentRows(tx, doc_url_hash_val, doc_url_val, rows, batch_size, content_hash_val):
+    # nodes are written before the relationships that match on them, in cypher_pool order
+    tx.run(cypher_pool[0], doc_url_hash_val=doc_url_hash_val, doc_url_val=doc_url_val).consume()
+    for idx in sorted(rows):
+        for start in range(0, len(rows[idx]), batch_size):
+            tx.run(cypher_pool[idx], rows=rows[idx][start:start + batch_size],
+                   doc_url_hash_val=doc_url_hash_val).consume()
+            metrics.count('neo4j_statements')
+        metrics.count('neo4j_rows', len(rows[idx]))
+    if content_hash_val is not None:
+        tx.run(cypher_pool[6], doc_url_hash_val=doc_url_hash_val, content_hash_val=content_hash_val,
+               ingest_version_val=INGEST_VERSION).consume()
+
+
+def ingestDocumentNeo4j(doc, doc_location, driver, batch_size=1000, content_hash=None):
+    '''
+    Ingests a document into Neo4j
+    :param doc: Document object
+    :param doc_location: Document location
+    :param driver: Neo4j driver instance
+    :param batch_size: maximum number of rows sent with a single UNWIND statement
+    :param content_hash: content hash of the PDF, stored on the Document node for incremental ingests
+    '''
     logger.info(f'Ingesting Document: {doc_location}')
     logger.info(f'doc.sections: {len(doc.sections())}')
     logger.info(f'doc.chunks: {len(doc.chunks())}')
 
+    doc_url_val = doc_location
+    doc_url_hash_val = documentUrlHash(doc_url_val)
+    logger.info(f'Processing Document: {doc_location}')
+    rows = collectDocumentRows(doc)
 
-    with driver.session() as session:
-        # Create Document node
-        doc_url_val = doc_location
-        doc_url_hash_val = hashlib.md5(doc_url_val.encode("utf-8")).hexdigest()
-        session.run(cypher_pool[0], doc_url_hash_val=doc_url_hash_val, doc_url_val=doc_url_val)
-
-        # Process Sections
-        countSection = 0
-        logger.info(f'Processing Document: {doc_location}')
-        for sec in doc.sections():
-            logger.info(f'Processing Section: {sec.title}')
-            sec_title_val = sec.title
-            sec_title_hash_val = hashlib.md5(sec_title_val.encode("utf-8")).hexdigest()
-            sec_tag_val = sec.tag  # Assuming 'tag' differentiates sections, like 'introduction', 'methodology', etc.
-            sec_level_val = sec.level  # Assuming 'level' indicates the hierarchy level of the section
-            sec_page_idx_val = sec.page_idx  # Assuming 'page_idx' and 'block_idx' help uniquely identify the section
-            sec_block_idx_val = sec.block_idx
-            if not sec_tag_val == 'table':
-                # Create Section node
-                session.run(cypher_pool[1], page_idx_val=sec_page_idx_val, title_hash_val=sec_title_hash_val,
-                            title_val=sec_title_val, tag_val=sec_tag_val, level_val=sec_level_val,
-                            block_idx_val=sec_block_idx_val, doc_url_hash_val=doc_url_hash_val)
-
-                # Link Section with the Document or its parent section
-                sec_parent_val = str(sec.parent.to_text())
-                if sec_parent_val == "None":  # use document
-                    cypher = cypher_pool[2]
-                    session.run(cypher, page_idx_val=sec_page_idx_val
-                                    , title_hash_val=sec_title_hash_val
-                                    , doc_url_hash_val=doc_url_hash_val
-                                    , block_idx_val=sec_block_idx_val
-                                )
-
-                else:   # use parent section
-                    sec_parent_title_hash_val = hashlib.md5(sec_parent_val.encode("utf-8")).hexdigest()
-                    sec_parent_page_idx_val = sec.parent.page_idx
-                    sec_parent_block_idx_val = sec.parent.block_idx
-
-                    cypher = cypher_pool[3]
-                    session.run(cypher, page_idx_val=sec_page_idx_val
-                                    , title_hash_val=sec_title_hash_val
-                                    , block_idx_val=sec_block_idx_val
-                                    , parent_page_idx_val=sec_parent_page_idx_val
-                                    , parent_title_hash_val=sec_parent_title_hash_val
-                                    , parent_block_idx_val=sec_parent_block_idx_val
-                                    , doc_url_hash_val=doc_url_hash_val
-                                )
-                countSection += 1
-
-        # Process Chunks
-        countChunk = 0
-        for chk in doc.chunks():
-            chunk_sentences = "\n".join(chk.sentences)  # Assuming 'sentences' is a list of sentences in the chunk
-            chunk_sentences_hash_val = hashlib.md5(chunk_sentences.encode("utf-8")).hexdigest()
-            chunk_block_idx_val = chk.block_idx
-            chunk_page_idx_val = chk.page_idx
-            chunk_tag_val = chk.tag  # Assuming 'tag' provides some categorization of chunks
-            chunk_level_val = chk.level  # Assuming 'level' indicates the hierarchy level of the chunk
-
-            if not chunk_tag_val == 'table':
-                # Create Chunk node
-                session.run(cypher_pool[4], sentences_hash_val=chunk_sentences_hash_val, sentences_val=chunk_sentences,
-                            block_idx_val=chunk_block_idx_val, page_idx_val=chunk_page_idx_val, tag_val=chunk_tag_val,
-                            level_val=chunk_level_val, doc_url_hash_val=doc_url_hash_val)
-
-                # Link Chunk to its parent Section
-                chk_parent_val = str(chk.parent.to_text())
-                if chk_parent_val != 'None':
-                    # parent_title_hash_val = hashlib.md5(chk.parent.title.encode("utf-8")).hexdigest()
-                    chk_parent_hash_val = hashlib.md5(chk_parent_val.encode("utf-8")).hexdigest()
-                    parent_block_idx_val = chk.parent.block_idx
-                    session.run(cypher_pool[5], sentences_hash_val=chunk_sentences_hash_val, block_idx_val=chunk_block_idx_val,
-                                parent_hash_val=chk_parent_hash_val, parent_block_idx_val=parent_block_idx_val,
-                                doc_url_hash_val=doc_url_hash_val)
-                    countChunk += 1
+    # the whole document is written in one explicit transaction
+    with metrics.timer('neo4j_write', kind='document'), driver.session() as session:
+        session.execute_write(_writeDocumentRows, doc_url_hash_val, doc_url_val, rows, batch_size, content_hash)
 
     logger.info(f'\'{doc_location}\' Done! Summary: ')
-    logger.info(f'#Sections: {countSection}')
-    logger.info(f'#Chunks: {countChunk}')
+    logger.info(f'#Sections: {len(rows[2]) + len(rows[3])}')
+    logger.info(f'#Chunks: {len(rows[5])}')
 
 
     return doc_url_hash_val
 
 
-def create_document_links(driver, citation_matrix, doc_identifiers):
+def ingestDocuments(pdf_files, pdf_reader, driver, parse_workers=4, write_workers=2, queue_size=8, batch_size=1000,
+                    content_hashes=None):
+    '''
+    Parses and ingests documents in a pipeline: parse workers call the layout reader and feed a
+    bounded queue that Neo4j writer workers, sharing one driver, drain. The queue bounds the number
+    of parsed documents held in memory, and a document that fails to parse or ingest is logged and
+    skipped without stopping the others.
+    :param pdf_files: PDF file paths
+    :param pdf_reader: Reader with a `read_pdf(path)` method returning a Document object
+    :param driver: Neo4j driver instance shared by the writer workers
+    :param parse_workers: number of documents parsed concurrently
+    :param write_workers: number of documents written to Neo4j concurrently
+    :param queue_size: maximum number of parsed documents waiting to be written
+    :param batch_size: maximum number of rows sent with a single UNWIND statement
+    :param content_hashes: optional dictionary mapping PDF file to the content hash stored with its Document
+    :return: lists of the ingested and of the failed PDF files
+    '''
+    file_queue = queue.Queue()
+    for pdf_file in pdf_files:
+        file_queue.put(pdf_file)
+    doc_queue = queue.Queue(maxsize=queue_size)
+    ingested, failed = [], []
+
+    def parse_worker():
+        while True:
+            try:
+                pdf_file = file_queue.get_nowait()
+            except queue.Empty:
+                return
+            # the parse span is the root of the document's trace, its write span joins it from a writer thread
+            try:
+                with metrics.span('parse', path=str(pdf_file)) as parse_span:
+                    doc = pdf_reader.read_pdf(str(pdf_file))
+            except Exception as e:
+                logger.error(f'Failed to parse {pdf_file}: {e!r}')
+                metrics.count('documents', stage='ingest', status='parse_failed')
+                failed.append(pdf_file)
+                continue
+            # blocks while the writers are behind
+            with metrics.timer('queue_wait', queue='parsed_documents'):
+                doc_queue.put((pdf_file, doc, parse_span))
+
+    def write_worker():
+        while True:
+            item = doc_queue.get()
+            if item is None:
+                return
+            pdf_file, doc, parse_span = item
+            try:
+                content_hash = content_hashes.get(pdf_file) if content_hashes is not None else None
+                with metrics.span('write', parent=parse_span, path=str(pdf_file)):
+                    ingestDocumentNeo4j(doc, str(pdf_file), driver, batch_size=batch_size, content_hash=content_hash)
+                ingested.append(pdf_file)
+                metrics.count('documents', stage='ingest', status='ingested')
+            except Exception as e:
+                logger.error(f'Failed to ingest {pdf_file}: {e!r}')
+                metrics.count('documents', stage='ingest', status='write_failed')
+                failed.append(pdf_file)
+
+    parsers = [threading.Thread(target=parse_worker, daemon=True) for _ in range(parse_workers)]
+    writers = [threading.Thread(target=write_worker, daemon=True) for _ in range(write_workers)]
+    for worker in parsers + writers:
+        worker.start()
+    for worker in parsers:
+        worker.join()
+    for _ in writers:
+        doc_queue.put(None)
+    for worker in writers:
+        worker.join()
+    return ingested, failed
+
+
+def iter_citation_edges(citation_matrix):
+    """
+    Yields the (i, j) indices of the nonzero cells of a citation matrix.
+
+    :param citation_matrix: A 2D list or array, or a SciPy sparse matrix (CSR, COO, ...) which is never densified.
+    """
+    if hasattr(citation_matrix, 'tocoo'):
+        coo = citation_matrix.tocoo()
+        nonzero = coo.data != 0
+        return zip(coo.row[nonzero].tolist(), coo.col[nonzero].tolist())
+    rows, cols = np.nonzero(np.asarray(citation_matrix))
+    return zip(rows.tolist(), cols.tolist())
+
+
+def sparse_citation_edges(path, doc_identifiers_by_id):
+    """
+    Reads a sparse citation matrix saved with its corpus ID sidecars and maps its edges to document identifiers.
+    Only the nonzero cells are visited, the matrix is never densified.
+
+    :param path: .npz file written by citation_matrix.save_citation_matrix, e.g. candidate_retrieved_citation_matrix.npz.
+    :param doc_identifiers_by_id: Dictionary mapping corpus ID (PDF file stem) to document identifier.
+    :return: List of (citing document identifier, cited document identifier) pairs for the documents that were ingested.
+    """
+    from citation_matrix import load_citation_matrix
+    matrix, row_ids, col_ids = load_citation_matrix(path)
+    row_docs = [doc_identifiers_by_id.get(corpus_id) for corpus_id in row_ids]
+    col_docs = [doc_identifiers_by_id.get(corpus_id) for corpus_id in col_ids]
+    return [(row_docs[i], col_docs[j]) for i, j in iter_citation_edges(matrix)
+            if row_docs[i] is not None and col_docs[j] is not None]
+
+
+def load_citation_edges(path, doc_identifiers_by_id, chunksize=1000):
+    """
+    Reads citation edges between corpus IDs and maps them to document identifiers.
+
+    :param path: Either the labeled candidate_retrieved_citation_matrix.csv written by analyze_pdf_s2_data.py --dense_csv,
+                 its sparse candidate_retrieved_citation_matrix.npz with ID sidecars,
+                 or an edge list with one `citing_id cited_id` pair per line (tab or space separated, e.g. a link recorder).
+    :param doc_identifiers_by_id: Dictionary mapping corpus ID (PDF file stem) to document identifier.
+    :param chunksize: Rows of the labeled matrix read at a time.
+    :return: List of (citing document identifier, cited document identifier) pairs for the documents that were ingested.
+    """
+    edges = []
+    path = str(path)
+    if path.endswith('.npz'):
+        return sparse_citation_edges(path, doc_identifiers_by_id)
+    if path.endswith('.csv'):
+        import pandas as pd
+        for chunk in pd.read_csv(path, index_col=0, chunksize=chunksize):
+            citing_ids = chunk.index.astype(str).to_numpy()
+            cited_ids = chunk.columns.astype(str).to_numpy()
+            rows, cols = np.nonzero(chunk.to_numpy())
+            edges.extend(zip(citing_ids[rows], cited_ids[cols]))
+    else:
+        with open(path, 'r') as f:
+            for line in f:
+                temp = line.split()
+                if len(temp) >= 2:
+                    edges.append((temp[0], temp[1]))
+    return [(doc_identifiers_by_id[citing], doc_identifiers_by_id[cited]) for citing, cited in edges
+            if citing in doc_identifiers_by_id and cited in doc_identifiers_by_id]
+
+
+def _writeCitationRows(tx, rows):
+    tx.run(
+        "UNWIND $rows AS row "
+        "MATCH (citingDoc:Document {url_hash: row.citingDocHash}), "
+        "(citedDoc:Document {url_hash: row.citedDocHash}) "
+        "MERGE (citingDoc)-[:CITES]->(citedDoc)",
+        rows=rows
+    ).consume()
+
+
+def create_citation_edges(driver, edges, batch_size=10000):
+    """
+    Create CITES links between document nodes, batch_size edges per UNWIND statement.
+
+    :param driver: Neo4j driver instance.
+    :param edges: Iterable of (citing document identifier, cited document identifier) pairs.
+    :param batch_size: Maximum number of edges per transaction.
+    :return: Number of edges sent.
+    """
+    count = 0
+    batch = []
+    with driver.session() as session:
+        for citing_doc_hash, cited_doc_hash in edges:
+            batch.append({'citingDocHash': citing_doc_hash, 'citedDocHash': cited_doc_hash})
+            if len(batch) == batch_size:
+                with metrics.timer('neo4j_write', kind='citations'):
+                    session.execute_write(_writeCitationRows, batch)
+                metrics.count('neo4j_rows', len(batch))
+                count += len(batch)
+                batch = []
+        if batch:
+            with metrics.timer('neo4j_write', kind='citations'):
+                session.execute_write(_writeCitationRows, batch)
+            metrics.count('neo4j_rows', len(batch))
+            count += len(batch)
+    return count
+
+
+def create_document_links(driver, citation_matrix, doc_identifiers, batch_size=10000):
     """
     Create links between document nodes based on the citation matrix.
 
     :param driver: Neo4j driver instance.
-    :param citation_matrix: A 2D list where each element citation_matrix[i][j] is 1 if document i cites document j.
+    :param citation_matrix: A 2D list where each element citation_matrix[i][j] is 1 if document i cites document j,
+                            or an equivalent NumPy array or SciPy sparse matrix.
     :param doc_identifiers: List of document identifiers corresponding to the indices in the citation matrix.
+    :param batch_size: Maximum number of edges per transaction.
     """
-    with driver.session() as session:
-        for i, row in enumerate(citation_matrix):
-            for j, cites in enumerate(row):
-                if cites:  # If document i cites document j
-                    citing_doc_hash = doc_identifiers[i]
-                    cited_doc_hash = doc_identifiers[j]
-                    session.run(
-                        "MATCH (citingDoc:Document {url_hash: $citingDocHash}), "
-                        "(citedDoc:Document {url_hash: $citedDocHash}) "
-                        "MERGE (citingDoc)-[:CITES]->(citedDoc)",
-                        citingDocHash=citing_doc_hash,
-                        citedDocHash=cited_doc_hash
-                    )
+    edges = ((doc_identifiers[i], doc_identifiers[j]) for i, j in iter_citation_edges(citation_matrix))
+    return create_citation_edges(driver, edges, batch_size=batch_size)
 
 if __name__ == '__main__':
     import argparse
@@ -174,12 +432,28 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-l', '--loglevel', help='log level (default: INFO)', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'])
     parser.add_argument('-f', '--file_location', help='folder location of the PDF files', default=Path(__file__).parent / 'papers', type=Path)
-    parser.add_argument('-c', '--citation_matrix', help='citation matrix pickle file, if None then will create random', type=argparse.FileType('rb'), default=None)
+    parser.add_argument('-c', '--citation_matrix', help='citation matrix pickle file (dense or SciPy sparse) indexed like the PDF files, or .npz with corpus ID sidecars, if None then will create random', type=Path, default=None)
+    parser.add_argument('-e', '--citation_edges', help='edge list, labeled citation matrix CSV or .npz between corpus IDs, used instead of --citation_matrix', type=Path, default=None)
+    parser.add_argument('-b', '--batch_size', help='rows per UNWIND statement when ingesting a document (default: 1000)', type=int, default=1000)
+    parser.add_argument('-p', '--parse_workers', help='documents parsed concurrently (default: 4)', type=int, default=4)
+    parser.add_argument('-w', '--write_workers', help='documents written to Neo4j concurrently (default: 2)', type=int, default=2)
+    parser.add_argument('-i', '--incremental', help='only parse and ingest PDFs that are new or changed since the last run', action='store_true')
+    parser.add_argument('--parse_cache', help='directory caching parsed layouts by PDF content hash, empty string disables it (default: parse_cache)', type=str, default='parse_cache')
+    parser.add_argument('-q', '--queue_size', help='parsed documents waiting to be written at most (default: 8)', type=int, default=8)
+    # The LLM Sherpa API URL, a private instance or a local fake server can be set with LLMSHERPA_API_URL
+    parser.add_argument('--llmsherpa_api_url', help='layout parser endpoint (default: $LLMSHERPA_API_URL or the public llmsherpa API)', type=str,
+                        default=os.getenv('LLMSHERPA_API_URL', "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all"))
+    parser.add_argument('-r', '--reader', help='layout backend: llmsherpa sends every PDF to the parser, local parses them in a process pool (default: llmsherpa)',
+                        choices=READERS, default='llmsherpa')
+    parser.add_argument('--layout_workers', help='processes of the local layout reader (default: number of CPUs)', type=int, default=os.cpu_count())
+    parser.add_argument('--metrics_jsonl', help='JSON-lines file of per-document spans and totals (default: $PIPELINE_METRICS_JSONL, none)', type=str,
+                        default=os.getenv(metrics.JSONL_ENV))
+    parser.add_argument('--metrics_prom', help='Prometheus textfile of counters and timers (default: $PIPELINE_METRICS_PROM, none)', type=str,
+                        default=os.getenv(metrics.PROMETHEUS_ENV))
     args = parser.parse_args()
     logger.setLevel(args.loglevel)
-
-    # The LLM Sherpa API URL
-    llmsherpa_api_url = "https://readers.llmsherpa.com/api/document/developer/parseDocument?renderFormat=all"
+    llmsherpa_api_url = args.llmsherpa_api_url
+    metrics.configure(jsonl=args.metrics_jsonl, prometheus=args.metrics_prom)
 
     # Please change the following variables to your own Neo4j instance by setting the environment variables
     NEO4J_URL = os.getenv('NEO4J_URL')
@@ -209,35 +483,56 @@ if __name__ == '__main__':
 
     logger.info(f'#PDF files found: {len(pdf_files)}!')
     assert len(pdf_files) > 0, 'No PDF files found!'
-    pdf_reader = LayoutPDFReader(llmsherpa_api_url)
+    # parsed layouts are cached by PDF content hash and backend
+    pdf_reader = create_reader(args.reader, llmsherpa_api_url, parse_cache=args.parse_cache, workers=args.layout_workers)
 
     # parse documents and create graph
     startTime = datetime.now()
     driver = GraphDatabase.driver(NEO4J_URL, auth=(NEO4J_USER, NEO4J_PASSWORD), database=NEO4J_DATABASE)
     logger.info(f'Connecting to Neo4j at {NEO4J_URL}...')
 
-    doc_url_hash_values = []
-    for pdf_file in pdf_files:
-        doc = pdf_reader.read_pdf(str(pdf_file))
-
-        # # open a local file to write the JSON
-        # with open(f'{pdf_file.name} + '.json', 'w') as f:
-        #     # convert doc.json from a list to string
-        #     f.write(str(doc.json))
-
-        doc_url_hash_val = ingestDocumentNeo4j(doc, str(pdf_file), driver)
-        doc_url_hash_values.append(doc_url_hash_val)
-
-    logger.info(f'{len(pdf_files)} documents processed!')
-    # Example citation matrix and document identifiers
-    if args.citation_matrix is None:
-        # Create Random citation Matrix
-        import random
-        citation_matrix = [[random.randint(0, 1) for _ in range(len(pdf_files))] for _ in range(len(pdf_files))]
-    else:
-        citation_matrix = pickle.load(args.citation_matrix)
+    content_hashes = None
+    to_ingest = pdf_files
+    if args.incremental:
+        content_hashes, stale = selectChangedDocuments(pdf_files, driver)
+        to_ingest = [pdf_file for pdf_file in pdf_files if pdf_file in content_hashes]
+        logger.info(f'Incremental ingest: {len(pdf_files) - len(to_ingest)} unchanged, '
+                    f'{len(to_ingest) - len(stale)} new, {len(stale)} changed')
+        deleteDocumentSubgraphs(driver, stale)
+
+    ingested, failed = ingestDocuments(to_ingest, pdf_reader, driver, parse_workers=args.parse_workers,
+                                       write_workers=args.write_workers, queue_size=args.queue_size,
+                                       batch_size=args.batch_size, content_hashes=content_hashes)
+    # hashes stay aligned with pdf_files, failed documents simply have no node to link
+    doc_url_hash_values = [documentUrlHash(str(pdf_file)) for pdf_file in pdf_files]
+
+    logger.info(f'{len(ingested)} documents processed!')
+    if args.parse_cache:
+        logger.info(f'Parse cache: {pdf_reader.hits} hits, {pdf_reader.misses} misses')
+    if failed:
+        logger.warning(f'{len(failed)} documents failed: {", ".join(str(f) for f in failed)}')
     logger.info(f'Creating document links...')
-    create_document_links(driver, citation_matrix, doc_url_hash_values)
+    doc_url_hash_by_id = {pdf_file.stem: doc_url_hash_val for pdf_file, doc_url_hash_val in zip(pdf_files, doc_url_hash_values)}
+    if args.citation_edges is not None:
+        edges = load_citation_edges(args.citation_edges, doc_url_hash_by_id)
+        num_edges = create_citation_edges(driver, edges)
+    elif args.citation_matrix is not None and args.citation_matrix.suffix == '.npz':
+        # sparse matrix between corpus IDs, rows and columns are matched to the PDF files by their sidecars
+        num_edges = create_citation_edges(driver, sparse_citation_edges(args.citation_matrix, doc_url_hash_by_id))
+    else:
+        # Example citation matrix and document identifiers
+        if args.citation_matrix is None:
+            # Create Random citation Matrix
+            import random
+            citation_matrix = [[random.randint(0, 1) for _ in range(len(pdf_files))] for _ in range(len(pdf_files))]
+        else:
+            with open(args.citation_matrix, 'rb') as f:
+                citation_matrix = pickle.load(f)
+        num_edges = create_document_links(driver, citation_matrix, doc_url_hash_values)
+    logger.info(f'{num_edges} citation edges sent!')
     driver.close()
+    # shuts down the local reader's process pool, the llmsherpa reader holds nothing to close
+    if hasattr(pdf_reader, 'close'):
+        pdf_reader.close()
 
     logger.info(f'Total time: {datetime.now() - startTime}')
@@ -0,0 +1,236 @@
+'''
+Persistent memoization of DSPy predictor calls.
+
+Evaluate runs and optimizer trials send the same (query_chunk, candidate_chunk) pairs to the same
+ChainOfThought(PredictCitation) prompt over and over. PredictionCache stores predictions in a SQLite
+file keyed by the SHA-256 of everything that determines the LM's answer:
+    - the signature: instructions and every field's name, prefix and description
+    - the predictor's demos, so an optimizer trial with new demos is a different prompt
+    - the inputs (chunk texts)
+    - the LM's settings (model, temperature, max_tokens, n, ...)
+The file is bounded to max_entries with least-recently-used eviction, and hits, misses and evictions
+are counted per session and in total. A hit is a single read: its last_used time and the hit and miss
+counts are buffered and written in one transaction every flush_interval seconds (or flush_entries
+hits), before any eviction and on stats() and close(). Several processes may share the file, evictions
+count its rows again rather than trusting this process's view.
+
+Usage (in a dspy.Module):
+    prediction = cached_predict(prediction_cache, self.predict, query_chunk=..., candidate_chunk=...)
+'''
+import collections
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+import metrics
+
+
+def signature_spec(signature):
+    '''Instructions and fields of a DSPy signature as plain data.'''
+    spec = {'instructions': getattr(signature, 'instructions', None) or getattr(signature, '__doc__', None)}
+    fields = getattr(signature, 'fields', None)
+    if fields:
+        spec['fields'] = {name: getattr(field, 'json_schema_extra', None) or str(field) for name, field in fields.items()}
+    else:
+        spec['fields'] = str(signature)
+    return spec
+
+
+def lm_spec(lm):
+    '''The settings of an LM client that change its output.'''
+    if lm is None:
+        return None
+    kwargs = getattr(lm, 'kwargs', {})
+    return {'class': type(lm).__name__, 'model': getattr(lm, 'model', None) or kwargs.get('model'), 'kwargs': kwargs}
+
+
+def prediction_key(signatures, demos, inputs, lm):
+    '''
+    SHA-256 of everything a prediction depends on
+    :param signatures: DSPy signatures of the predictor, e.g. its signature and extended_signature
+    :param demos: the predictor's demos, Examples or dicts
+    :param inputs: dict of input field values
+    :param lm: LM client the prediction is requested from
+    '''
+    payload = {
+        'signatures': [signature_spec(signature) for signature in signatures if signature is not None],
+        'demos': [dict(demo) if not isinstance(demo, dict) else demo for demo in demos or []],
+        'inputs': inputs,
+        'lm': lm_spec(lm),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class PredictionCache:
+    '''
+    SQLite-backed LRU store of predictions
+    :param path: location of the SQLite file
+    :param max_entries: number of predictions kept, the least recently used are evicted beyond it
+    :param flush_interval: seconds the last_used times and statistics of lookups are buffered at most
+    :param flush_entries: number of hits whose last_used times are buffered at most
+    '''
+
+    def __init__(self, path='prediction_cache.sqlite', max_entries=200000, flush_interval=5.0, flush_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.flush_entries = flush_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # key -> last hit time, and stats increments, not written yet
+        self._touched = {}
+        self._pending_stats = collections.Counter()
+        self._last_flush = time.monotonic()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps readers and the single writer from blocking each other across processes
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS predictions ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT,'
+            ' created_at REAL,'
+            ' last_used REAL)'
+        )
+        self._conn.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+        self._conn.commit()
+        self._count = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+
+    def _bump(self, name, amount=1):
+        self._conn.execute(
+            'INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?',
+            (name, amount, amount)
+        )
+
+    def _flush(self):
+        '''Writes the buffered last_used times and statistics, the caller holds the lock and commits.'''
+        if self._touched:
+            self._conn.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                   [(used, key) for key, used in self._touched.items()])
+            self._touched.clear()
+        for name, amount in self._pending_stats.items():
+            self._bump(name, amount)
+        self._pending_stats.clear()
+        self._last_flush = time.monotonic()
+
+    def flush(self):
+        '''Writes the buffered last_used times and statistics now.'''
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+
+    def get(self, key):
+        '''Returns the cached prediction fields of key, or None.'''
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                self._pending_stats['misses'] += 1
+            else:
+                self.hits += 1
+                self._pending_stats['hits'] += 1
+                self._touched[key] = time.time()
+            if len(self._touched) >= self.flush_entries or time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+                self._conn.commit()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, key, value):
+        '''Stores the prediction fields of key, evicting the least recently used entries past max_entries.'''
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                'INSERT OR IGNORE INTO predictions (key, value, created_at, last_used) VALUES (?, ?, ?, ?)',
+                (key, json.dumps(value, default=str), now, now)
+            )
+            if cursor.rowcount:
+                # other processes insert into the same file, count its rows (under a millisecond) before evicting
+                self._count = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+            excess = self._count - self.max_entries
+            if excess > 0:
+                # recent hits have to count before the least recently used rows are chosen
+                self._flush()
+                cursor = self._conn.execute(
+                    'DELETE FROM predictions WHERE key IN (SELECT key FROM predictions ORDER BY last_used LIMIT ?)',
+                    (excess,)
+                )
+                self._count -= cursor.rowcount
+                self.evictions += cursor.rowcount
+                self._bump('evictions', cursor.rowcount)
+            elif time.monotonic() - self._last_flush >= self.flush_interval:
+                self._flush()
+            self._conn.commit()
+
+    def stats(self):
+        '''Hit/miss statistics of this session and of the file's whole lifetime.'''
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+            self._count = self._conn.execute('SELECT COUNT(*) FROM predictions').fetchone()[0]
+            totals = dict(self._conn.execute('SELECT name, value FROM stats').fetchall())
+        lookups = self.hits + self.misses
+        return {
+            'entries': self._count,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'total_hits': totals.get('hits', 0),
+            'total_misses': totals.get('misses', 0),
+            'total_evictions': totals.get('evictions', 0),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+            self._conn.execute('DELETE FROM predictions')
+            self._conn.commit()
+            self._count = 0
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self._conn.commit()
+            self._conn.close()
+
+    def __deepcopy__(self, memo):
+        # DSPy optimizers deep-copy programs, every copy shares the one connection
+        return self
+
+
+def cached_predict(cache, predictor, **inputs):
+    '''
+    Calls a DSPy predictor through the cache. The predictor stays an attribute of the calling module,
+    so optimizers still find it and set its demos, which are part of the key.
+    :param cache: PredictionCache, or None to call the predictor directly
+    :param predictor: dspy.Predict / dspy.ChainOfThought instance
+    '''
+    import dspy
+
+    if cache is None:
+        with metrics.timer('api_call', service='llm'):
+            prediction = predictor(**inputs)
+        metrics.count('api_calls', service='llm')
+        return prediction
+    lm = getattr(predictor, 'lm', None) or dspy.settings.lm
+    # ChainOfThought prompts with its extended signature, optimizers may rewrite either one
+    signatures = [predictor.signature, getattr(predictor, 'extended_signature', None)]
+    key = prediction_key(signatures, predictor.demos, inputs, lm)
+    fields = cache.get(key)
+    if fields is not None:
+        metrics.count('cache_hits', cache='predictions')
+        prediction = dspy.Prediction(**fields)
+        if dspy.settings.trace is not None:
+            # bootstrapping optimizers collect demos from the trace, a hit has to show up in it too
+            dspy.settings.trace.append((predictor, inputs, prediction))
+        return prediction
+    metrics.count('cache_misses', cache='predictions')
+    with metrics.timer('api_call', service='llm'):
+        prediction = predictor(**inputs)
+    metrics.count('api_calls', service='llm')
+    cache.put(key, {name: prediction[name] for name in prediction.keys()})
+    return prediction
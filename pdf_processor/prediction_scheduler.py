@@ -0,0 +1,165 @@
+'''
+Global scheduling of chunk-pair predictions across a whole devset.
+
+Evaluate(num_threads=8) runs 8 examples at a time and each example calls its predictor serially for
+up to max_windows query chunks, so at most 8 LM calls are ever in flight. PredictionScheduler instead
+flattens every (example, chunk pair) into one work queue and keeps up to `workers` calls in flight
+under a requests/tokens per minute RateLimiter, then hands the outputs back per example in pair order.
+
+Pairs are dispatched pair-major (the first pair of every example, then the second, ...). With stop_on,
+an example stops once one of its outputs satisfies it, pairs after that one are skipped if they have
+not started, and the outputs are truncated exactly as a serial `break` would truncate them.
+
+Programs run by evaluate_scheduled split their forward() into three methods:
+    pairs(**example_inputs) -> list of predictor input dicts, the cheap local part (chunking, retrieval)
+    predict_pair(inputs)    -> one predictor output, the LM call
+    resolve(pairs, outputs) -> the Prediction forward() would return
+and an optional stop_on(output) attribute for early stopping.
+
+Usage:
+    scheduler = PredictionScheduler(workers=64, requests_per_minute=3500, tokens_per_minute=160000)
+    score, outputs = evaluate_scheduled(program, devset, metric, scheduler)
+'''
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from embedding_batcher import RateLimiter
+
+SKIPPED = object()
+
+
+def estimate_tokens(inputs, completion_tokens=150):
+    '''Rough prompt plus completion token count of a call, 4 characters per token.'''
+    return sum(len(str(value)) for value in inputs.values()) // 4 + completion_tokens
+
+
+class PredictionScheduler:
+    '''
+    Runs predictor calls of many examples concurrently under rate limits
+    :param workers: maximum number of calls in flight
+    :param requests_per_minute: request rate limit, None for no limit
+    :param tokens_per_minute: token rate limit, None for no limit
+    :param max_retries: number of retries of a failed call before the example is marked failed
+    :param backoff: seconds before the first retry, doubled on every retry
+    :param estimate_tokens: function of a call's inputs returning its token count
+    '''
+
+    def __init__(self, workers=64, requests_per_minute=None, tokens_per_minute=None, max_retries=3, backoff=1.0,
+                 estimate_tokens=estimate_tokens):
+        self.workers = workers
+        self.limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.estimate_tokens = estimate_tokens
+        self.calls = 0
+        self.skipped = 0
+        self.retries = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def _call(self, predict_fn, inputs):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire(self.estimate_tokens(inputs))
+            try:
+                with metrics.timer('prediction'):
+                    output = predict_fn(inputs)
+                with self._lock:
+                    self.calls += 1
+                metrics.count('predictions')
+                return output
+            except Exception as e:
+                if attempt == self.max_retries:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                metrics.count('retries', service='llm')
+                print(f'Prediction failed ({e}), retrying')
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def run(self, examples, predict_fn, stop_on=None):
+        '''
+        Runs predict_fn on every pair of every example
+        :param examples: list with one list of predictor input dicts per example
+        :param predict_fn: function of one input dict returning the predictor output
+        :param stop_on: function of an output, an example stops at the first output it returns True for
+        :return: per example, the list of outputs in pair order or the exception that failed it
+        '''
+        start = time.monotonic()
+        outputs = [[SKIPPED] * len(pairs) for pairs in examples]
+        errors = [None] * len(examples)
+        # index of the first stopping pair of every example, later pairs are not needed
+        first_stop = [len(pairs) for pairs in examples]
+
+        def task(i, j):
+            if j > first_stop[i] or errors[i] is not None:
+                with self._lock:
+                    self.skipped += 1
+                return
+            try:
+                output = self._call(predict_fn, examples[i][j])
+            except Exception as e:
+                errors[i] = e
+                return
+            outputs[i][j] = output
+            if stop_on is not None and stop_on(output):
+                with self._lock:
+                    first_stop[i] = min(first_stop[i], j)
+
+        max_pairs = max((len(pairs) for pairs in examples), default=0)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(task, i, j) for j in range(max_pairs)
+                       for i in range(len(examples)) if j < len(examples[i])]
+            for future in futures:
+                future.result()
+
+        results = []
+        for i in range(len(examples)):
+            if errors[i] is not None:
+                results.append(errors[i])
+            else:
+                results.append(outputs[i][:first_stop[i] + 1])
+        self.elapsed += time.monotonic() - start
+        return results
+
+    def stats(self):
+        return {'calls': self.calls, 'skipped': self.skipped, 'retries': self.retries, 'elapsed': self.elapsed,
+                'calls_per_second': self.calls / self.elapsed if self.elapsed else 0.0}
+
+
+def evaluate_scheduled(program, devset, metric, scheduler, prepare_workers=8):
+    '''
+    Evaluates a program with all of its predictor calls scheduled globally, the scheduled counterpart
+    of Evaluate(devset=devset, metric=metric, return_outputs=True)(program)
+    :param program: module with pairs, predict_pair and resolve methods, see the module docstring
+    :param devset: list of dspy Examples
+    :param metric: function of (example, prediction) returning a score
+    :param prepare_workers: threads running program.pairs, which may embed chunks
+    :return: average score in percent and a list of (example, prediction, score)
+    '''
+    def pairs(example):
+        try:
+            with metrics.span('pairs', **example.inputs()):
+                return program.pairs(**example.inputs())
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=prepare_workers) as executor:
+        example_pairs = list(executor.map(pairs, devset))
+    runnable = [i for i, p in enumerate(example_pairs) if not isinstance(p, Exception)]
+    outputs = scheduler.run([example_pairs[i] for i in runnable], program.predict_pair,
+                            stop_on=getattr(program, 'stop_on', None))
+    outputs = dict(zip(runnable, outputs))
+
+    results = []
+    for i, example in enumerate(devset):
+        failure = example_pairs[i] if i not in outputs else outputs[i]
+        if isinstance(failure, Exception):
+            print(f'Error for example {i}: {failure}')
+            results.append((example, None, 0))
+            continue
+        prediction = program.resolve(example_pairs[i], outputs[i])
+        results.append((example, prediction, metric(example, prediction)))
+    score = 100 * sum(score for _, _, score in results) / len(results) if results else 0.0
+    return round(score, 2), results
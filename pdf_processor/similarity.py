@@ -0,0 +1,197 @@
+'''
+Vectorized cosine-similarity search over chunk embeddings.
+
+    normalize_rows   float32 copy of a matrix with unit-norm rows, computed once per matrix
+    top_k            exact top-k of every query row against every candidate row, one matmul per block
+    IVFIndex         approximate nearest-neighbor index over a whole corpus of chunks: spherical k-means
+                     centroids and inverted lists stored contiguously, a query only scans the lists of
+                     its n_probe closest centroids
+    recall_at_k      fraction of the exact top-k an approximate search returns
+
+Usage:
+    best, scores = top_k(query_embeddings, candidate_embeddings, k=1)      # best[i, 0] for query chunk i
+    index = IVFIndex(n_probe=8).fit(corpus_embeddings)
+    ids, scores = index.search(query_embeddings, k=10)
+'''
+import math
+
+import numpy as np
+
+
+def normalize_rows(matrix):
+    '''
+    Returns a float32 copy of matrix with rows scaled to unit norm, all-zero rows stay zero.
+    An empty list of vectors is a matrix of no rows, not one row of no columns.
+    '''
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(0, 0) if matrix.size == 0 else matrix[None, :]
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def _top_k_rows(scores, k):
+    # argpartition selects the k best in linear time, only those k are sorted
+    if k < scores.shape[1]:
+        idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        idx = np.broadcast_to(np.arange(scores.shape[1]), scores.shape).copy()
+    top = np.take_along_axis(scores, idx, axis=1)
+    order = np.argsort(-top, axis=1, kind='stable')
+    return np.take_along_axis(idx, order, axis=1), np.take_along_axis(top, order, axis=1)
+
+
+def top_k(queries, candidates, k=1, normalized=False, block_size=4096):
+    '''
+    Exact cosine top-k of every query against all candidates
+    :param queries: (n_queries, dim) matrix, or one vector
+    :param candidates: (n_candidates, dim) matrix
+    :param normalized: whether both matrices already have unit-norm rows, see normalize_rows
+    :param block_size: queries scored per matmul, bounds memory to block_size x n_candidates scores
+    :return: (n_queries, min(k, n_candidates)) arrays of candidate indices and scores, best first
+    '''
+    if not normalized:
+        queries, candidates = normalize_rows(queries), normalize_rows(candidates)
+    elif queries.ndim == 1:
+        queries = queries[None, :]
+    k = min(k, len(candidates))
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    scores = np.empty((len(queries), k), dtype=np.float32)
+    if k == 0:
+        return indices, scores
+    for start in range(0, len(queries), block_size):
+        block = queries[start:start + block_size] @ candidates.T
+        indices[start:start + block_size], scores[start:start + block_size] = _top_k_rows(block, k)
+    return indices, scores
+
+
+def recall_at_k(approximate_ids, exact_ids):
+    '''Fraction of the exact top-k ids that the approximate search also returned, averaged over queries.'''
+    k = exact_ids.shape[1]
+    if k == 0:
+        return 1.0
+    hits = sum(len(set(a[:k]) & set(e)) for a, e in zip(approximate_ids, exact_ids))
+    return hits / (k * len(exact_ids))
+
+
+class IVFIndex:
+    '''
+    Inverted-file index for cosine search
+    :param n_lists: number of k-means clusters, sqrt(n) of the fitted vectors if None
+    :param n_probe: number of closest clusters scanned per query
+    :param n_iter: k-means iterations
+    :param sample_size: vectors k-means is trained on, all of them if None
+    :param seed: seed of the centroid initialization and of the training sample
+    '''
+
+    def __init__(self, n_lists=None, n_probe=8, n_iter=10, sample_size=None, seed=0):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.sample_size = sample_size
+        self.seed = seed
+        self.centroids = None
+        self.vectors = None
+        self.ids = None
+        self.offsets = None
+
+    @staticmethod
+    def _assign(vectors, centroids, block_size=8192):
+        assignment = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            assignment[start:start + block_size] = np.argmax(vectors[start:start + block_size] @ centroids.T, axis=1)
+        return assignment
+
+    def fit(self, vectors):
+        '''Trains the centroids on vectors and indexes them, ids are row numbers of vectors.'''
+        vectors = normalize_rows(vectors)
+        rng = np.random.default_rng(self.seed)
+        n_lists = self.n_lists or max(1, int(round(math.sqrt(len(vectors)))))
+        n_lists = min(n_lists, len(vectors))
+        sample = vectors
+        if self.sample_size is not None and self.sample_size < len(vectors):
+            sample = vectors[rng.choice(len(vectors), self.sample_size, replace=False)]
+        centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+        for _ in range(self.n_iter):
+            assignment = self._assign(sample, centroids)
+            # cluster sums via one sort and reduceat instead of a Python loop over clusters
+            order = np.argsort(assignment, kind='stable')
+            clusters, starts = np.unique(assignment[order], return_index=True)
+            sums = np.add.reduceat(sample[order], starts, axis=0)
+            centroids = centroids.copy()
+            centroids[clusters] = normalize_rows(sums)
+            empty = np.setdiff1d(np.arange(n_lists), clusters)
+            if len(empty):
+                # empty clusters are restarted on random vectors
+                centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        self.centroids = centroids
+        self._build(vectors, np.arange(len(vectors)))
+        return self
+
+    def _build(self, vectors, ids):
+        assignment = self._assign(vectors, self.centroids)
+        order = np.argsort(assignment, kind='stable')
+        # vectors of a list are contiguous, a probe scans a slice instead of gathering rows
+        self.vectors = np.ascontiguousarray(vectors[order])
+        self.ids = ids[order]
+        self.offsets = np.searchsorted(assignment[order], np.arange(len(self.centroids) + 1))
+
+    def add(self, vectors, ids=None):
+        '''Adds vectors to the trained index, ids default to the next row numbers.'''
+        vectors = normalize_rows(vectors)
+        if ids is None:
+            ids = np.arange(len(self.ids), len(self.ids) + len(vectors))
+        all_vectors = np.concatenate([self.vectors, vectors])
+        all_ids = np.concatenate([self.ids, np.asarray(ids, dtype=self.ids.dtype)])
+        self._build(all_vectors, all_ids)
+
+    def __len__(self):
+        return 0 if self.ids is None else len(self.ids)
+
+    def search(self, queries, k=1, n_probe=None):
+        '''
+        Approximate cosine top-k
+        :param queries: (n_queries, dim) matrix, or one vector
+        :param n_probe: overrides the index's n_probe for this search
+        :return: (n_queries, k) arrays of ids and scores, best first, padded with -1 and -inf
+        '''
+        queries = normalize_rows(queries)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+        probes, _ = top_k(queries, self.centroids, k=n_probe, normalized=True)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        # loop over lists rather than queries: every query probing a list is scored in one matmul,
+        # and merged into its running top-k
+        probed_lists = probes.ravel()
+        probing_queries = np.repeat(np.arange(len(queries)), probes.shape[1])
+        order = np.argsort(probed_lists, kind='stable')
+        lists, starts = np.unique(probed_lists[order], return_index=True)
+        for list_id, group in zip(lists, np.split(probing_queries[order], starts[1:])):
+            start, end = self.offsets[list_id], self.offsets[list_id + 1]
+            if start == end:
+                continue
+            best, best_scores = _top_k_rows(queries[group] @ self.vectors[start:end].T, min(k, end - start))
+            merged_ids = np.concatenate([ids[group], self.ids[start + best]], axis=1)
+            merged_scores = np.concatenate([scores[group], best_scores], axis=1)
+            keep, scores[group] = _top_k_rows(merged_scores, k)
+            ids[group] = np.take_along_axis(merged_ids, keep, axis=1)
+        return ids, scores
+
+    def recall(self, queries, k=10, n_probe=None):
+        '''recall@k of this index against exact search over the indexed vectors.'''
+        exact, _ = top_k(normalize_rows(queries), self.vectors, k=k, normalized=True)
+        approximate, _ = self.search(queries, k=k, n_probe=n_probe)
+        return recall_at_k(approximate, self.ids[exact])
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, vectors=self.vectors, ids=self.ids, offsets=self.offsets,
+                 n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(n_lists=len(data['centroids']), n_probe=int(data['n_probe']))
+        index.centroids, index.vectors, index.ids, index.offsets = (
+            data['centroids'], data['vectors'], data['ids'], data['offsets'])
+        return index
@@ -0,0 +1,229 @@
+'''
+Pair features and SVM training of the SPECTER citation experiment ("cs224u specter svm.ipynb").
+
+A training pair is the SPECTER embedding of a test-set paper (query or candidate) next to the embedding of a
+paper it retrieved, labeled 1, followed by n_negatives pairs of the same test-set paper with random other
+retrieved papers, labeled 0. Test pairs are the query/candidate pairs of the qrel file.
+
+    - corpus IDs map to embedding rows through dictionaries instead of list.index searches
+    - embeddings are parsed from text once and then loaded from a float32 .npy next to the text file
+    - pairs are first built as (left row, right row, label) index arrays, the feature matrix
+      [left embedding | right embedding] is one fancy-indexed copy into a float32 array
+    - fit_svm is the notebook's grid-searched LinearSVC on an in-memory matrix, fit_streaming trains a linear
+      SVM with SGDClassifier.partial_fit on mini-batches built from the index arrays, so only the indices
+      (17 bytes per pair) have to fit in memory and the embeddings can stay memory-mapped
+
+Usage:
+    qpaper, q_emb = read_ids('qpaper_to_emb'), load_embeddings('qpaper.specter')      # likewise cpaper, rpaper
+    targets, target_rows = stack_targets(qpaper, q_emb, cpaper, c_emb)
+    pairs = training_pairs(rpaper, read_links('link-recorder-final-1', target_rows), target_rows)
+    X_train, y_train = pair_features(targets, r_emb, pairs)
+    svm = fit_svm(X_train, y_train)                         # or fit_streaming(targets, r_emb, pairs)
+'''
+import os
+
+import numpy as np
+
+RANDOM_STATE = 42
+
+
+def read_ids(path):
+    '''Corpus IDs of a *_to_emb file, one per line, in embedding row order.'''
+    with open(path, 'r') as f:
+        return [line.strip() for line in f]
+
+
+def id_rows(ids, offset=0):
+    '''Dictionary of corpus ID to row, the first row of a repeated ID wins like list.index.'''
+    rows = {}
+    for row, corpus_id in enumerate(ids):
+        rows.setdefault(corpus_id, row + offset)
+    return rows
+
+
+def stack_targets(qpaper, q_emb, cpaper, c_emb):
+    '''
+    Query and candidate embeddings in one matrix, the left side of the training pairs
+    :return: the stacked embeddings and a dictionary of test-set ID to row, an ID in both lists maps to its query row
+    '''
+    rows = id_rows(cpaper, offset=len(qpaper))
+    rows.update(id_rows(qpaper))
+    return np.concatenate([q_emb, c_emb]).astype(np.float32, copy=False), rows
+
+
+def load_embeddings(path, mmap=False):
+    '''
+    Loads a text embedding matrix (e.g. qpaper.specter) as float32. The first load parses the text and writes
+    <path>.npy, later loads read the binary file unless the text file is newer
+    :param mmap: memory-map the .npy instead of reading it into memory
+    '''
+    npy_path = str(path) + '.npy'
+    if not os.path.exists(npy_path) or os.path.getmtime(npy_path) < os.path.getmtime(path):
+        embeddings = np.loadtxt(path, dtype=np.float32, ndmin=2)
+        np.save(npy_path + '.tmp.npy', embeddings)
+        os.replace(npy_path + '.tmp.npy', npy_path)
+    return np.load(npy_path, mmap_mode='r' if mmap else None)
+
+
+def read_links(path, paper_ids):
+    '''
+    Reads the link recorder and groups it by retrieved paper, for the citing papers in paper_ids
+    :param path: link recorder, one `citing_id<TAB>retrieved_id` per line
+    :param paper_ids: citing corpus IDs to keep, e.g. the query and candidate papers
+    :return: dictionary of retrieved ID to the set of citing IDs
+    '''
+    paper_ids = set(paper_ids)
+    r_corpus = {}
+    with open(path, 'r') as f:
+        for line in f:
+            temp = line.split('\t')
+            corpus_id = temp[0].strip()
+            if corpus_id in paper_ids:
+                r_corpus.setdefault(temp[1].strip(), set()).add(corpus_id)
+    return r_corpus
+
+
+def read_qrel(path):
+    '''
+    (query ID, candidate ID, label) triples of a qrel file, in the order the notebook's qid -> cid -> label
+    dict iterates: grouped by query in order of first appearance, a repeated (query, candidate) pair kept
+    once, at its first position, with its last label
+    '''
+    qrel = {}
+    with open(path, 'r') as f:
+        for line in f:
+            temp = line.split(' ')
+            qrel.setdefault(temp[0].strip(), {})[temp[1].strip()] = int(temp[2].strip())
+    return [(qid, cid, label) for qid, cdict in qrel.items() for cid, label in cdict.items()]
+
+
+def sample_negatives(positives, n_candidates, n_negatives, rng):
+    '''
+    n_negatives distinct indices in range(n_candidates) per positive, none equal to the positive itself
+    :param positives: (n,) positive index of every row
+    :return: (n, n_negatives) int64 array
+    '''
+    positives = np.asarray(positives, dtype=np.int64)
+    if n_negatives > n_candidates - 1:
+        raise ValueError(f'cannot sample {n_negatives} negatives from {n_candidates - 1} candidates')
+    # draw from n_candidates - 1 values and skip over the positive, rows with a repeated draw are redrawn
+    draws = rng.integers(0, n_candidates - 1, size=(len(positives), n_negatives))
+    while True:
+        ordered = np.sort(draws, axis=1)
+        repeated = np.flatnonzero((np.diff(ordered, axis=1) == 0).any(axis=1))
+        if len(repeated) == 0:
+            break
+        draws[repeated] = rng.integers(0, n_candidates - 1, size=(len(repeated), n_negatives))
+    return draws + (draws >= positives[:, None])
+
+
+def training_pairs(rpaper, r_corpus, target_rows, n_retrieved=None, n_negatives=8, seed=RANDOM_STATE):
+    '''
+    Index pairs of the training set: for every retrieved paper and every test-set paper that retrieved it,
+    one positive pair followed by n_negatives pairs with random other retrieved papers
+    :param rpaper: retrieved corpus IDs in embedding row order
+    :param r_corpus: dictionary of retrieved ID to the set of test-set IDs that retrieved it, see read_links
+    :param target_rows: dictionary of test-set ID to its row in the target embeddings
+    :param n_retrieved: number of retrieved embeddings negatives are drawn from, len(rpaper) if None
+    :return: (left rows into the targets, right rows into the retrieved embeddings, labels), int64/int64/int8
+    '''
+    n_retrieved = len(rpaper) if n_retrieved is None else n_retrieved
+    left, right = [], []
+    for idx, r_id in enumerate(rpaper):
+        # sorted for a deterministic order, the notebook iterated the set
+        for t_id in sorted(r_corpus.get(r_id, ())):
+            if t_id in target_rows:
+                left.append(target_rows[t_id])
+                right.append(idx)
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+    negatives = sample_negatives(right, n_retrieved, n_negatives, np.random.default_rng(seed))
+    group = n_negatives + 1
+    # one row per positive: the positive then its negatives, flattened into the notebook's 1, 0, ..., 0 order
+    return (np.repeat(left, group),
+            np.column_stack([right, negatives]).ravel(),
+            np.tile(np.array([1] + [0] * n_negatives, dtype=np.int8), len(left)))
+
+
+def test_pairs(triples, q_rows, c_rows):
+    '''Index pairs (query rows, candidate rows, labels) of qrel triples, see read_qrel.'''
+    return (np.array([q_rows[qid] for qid, _, _ in triples], dtype=np.int64),
+            np.array([c_rows[cid] for _, cid, _ in triples], dtype=np.int64),
+            np.array([label for _, _, label in triples], dtype=np.int8))
+
+
+def pair_features(left_embeddings, right_embeddings, pairs, out=None):
+    '''
+    Feature matrix of index pairs, each row the concatenation of its left and right embedding
+    :param pairs: (left rows, right rows, labels), see training_pairs
+    :param out: float32 array of shape (n_pairs, left dim + right dim) to fill instead of allocating one
+    :return: features and labels
+    '''
+    left, right, labels = pairs
+    dim = left_embeddings.shape[1]
+    if out is None:
+        out = np.empty((len(left), dim + right_embeddings.shape[1]), dtype=np.float32)
+    out[:, :dim] = left_embeddings[left]
+    out[:, dim:] = right_embeddings[right]
+    return out, labels
+
+
+def iter_pair_batches(left_embeddings, right_embeddings, pairs, batch_size=4096, shuffle=True, seed=RANDOM_STATE):
+    '''Yields (features, labels) mini-batches of index pairs, one reused float32 buffer per batch size.'''
+    left, right, labels = pairs
+    order = np.random.default_rng(seed).permutation(len(left)) if shuffle else np.arange(len(left))
+    buffer = np.empty((min(batch_size, len(left)), left_embeddings.shape[1] + right_embeddings.shape[1]),
+                      dtype=np.float32)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        # sorted rows read memory-mapped embeddings sequentially, the batch order does not matter to partial_fit
+        batch.sort()
+        yield pair_features(left_embeddings, right_embeddings, (left[batch], right[batch], labels[batch]),
+                            out=buffer[:len(batch)])
+
+
+def fit_svm(x_train, y_train, cv=3, n_jobs=5):
+    '''
+    Grid-searched linear SVM, as SciRepEval trains it
+    :return: the best estimator refitted on all of x_train
+    '''
+    from sklearn.model_selection import GridSearchCV
+    try:
+        from lightning.classification import LinearSVC
+    except ImportError:
+        # same loss and solver family when sklearn-contrib-lightning is not installed
+        from sklearn.svm import LinearSVC
+
+    Cs = np.logspace(-2, 2, 5)
+    estimator = LinearSVC(loss="squared_hinge", random_state=RANDOM_STATE)
+    svm = GridSearchCV(estimator=estimator, cv=cv, param_grid={'C': Cs}, verbose=1, n_jobs=n_jobs)
+    svm.fit(x_train, y_train)
+    return svm.best_estimator_
+
+
+def classify(x_train, x_test, y_train, cv=3, n_jobs=5):
+    '''The notebook's classify: fits fit_svm and predicts x_test.'''
+    return fit_svm(x_train, y_train, cv=cv, n_jobs=n_jobs).predict(x_test)
+
+
+def fit_streaming(left_embeddings, right_embeddings, pairs, batch_size=4096, epochs=5, alpha=1e-4,
+                  class_weight=None, seed=RANDOM_STATE):
+    '''
+    Linear SVM trained out of core with SGDClassifier.partial_fit, one pass over shuffled mini-batches per epoch
+    :param pairs: (left rows, right rows, labels) index arrays, see training_pairs
+    :param alpha: L2 regularization, roughly 1 / (C * n_pairs) of the LinearSVC
+    :param class_weight: dict of label to weight, partial_fit cannot compute 'balanced' itself
+    '''
+    from sklearn.linear_model import SGDClassifier
+
+    model = SGDClassifier(loss='squared_hinge', alpha=alpha, class_weight=class_weight, random_state=seed)
+    classes = np.array([0, 1])
+    for epoch in range(epochs):
+        for x_batch, y_batch in iter_pair_batches(left_embeddings, right_embeddings, pairs, batch_size=batch_size,
+                                                  seed=seed + epoch):
+            model.partial_fit(x_batch, y_batch, classes=classes)
+    return model
+
+
+def accuracy(predictions, labels):
+    return float(np.mean(np.asarray(predictions) == np.asarray(labels)))
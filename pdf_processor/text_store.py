@@ -0,0 +1,213 @@
+'''
+Extracted-text store for the evaluation notebooks.
+
+The DSPy modules used to open both PDFs of a (query, candidate) pair with PyPDF2 and extract every page
+on every forward call, so a query paper with 9 candidates was parsed 9 times per optimizer trial.
+TextStore extracts each paper once and keeps, per corpus ID:
+    - the extracted text, exactly as the notebooks built it (pages joined by spaces, newlines removed)
+    - the SHA-256 of the PDF it came from
+    - memoized chunk boundaries per Chunker configuration
+
+On disk, texts are gzipped under `<directory>/<sha[:2]>/<sha>.txt.gz` and `index.json` maps corpus IDs
+to their file's path, size, mtime and hash, so a warm process only stats files instead of hashing them.
+In memory the store is shared by all Evaluate threads (and by DSPy deep copies of a program), lookups
+of populated papers do no I/O at all.
+
+Usage:
+    text_store = TextStore('text_store')
+    text_store.populate(Path('darwin/query_papers').glob('*.pdf'), workers=os.cpu_count())
+    query_chunks = text_store.chunks(query_file, chunker, path=f'darwin/query_papers/{query_file}.pdf')
+'''
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import multiprocessing
+import os
+import threading
+from pathlib import Path
+
+from PyPDF2 import PdfReader
+
+import metrics
+
+
+def extract_text(path):
+    '''Extracts the text of a PDF the way the notebooks always have.'''
+    pdf = PdfReader(path)
+    text = ""
+    for page in pdf.pages:
+        page_text = page.extract_text()
+        if page_text:
+            text += page_text + " "  # Adding space to separate text between pages
+    return text.replace("\n", " ")
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class TextStore:
+    '''
+    Extracted PDF text keyed by corpus ID and file hash
+    :param directory: directory of the on-disk cache, None keeps everything in memory
+    '''
+
+    def __init__(self, directory='text_store'):
+        self.directory = Path(directory) if directory is not None else None
+        self._texts = {}
+        self._hashes = {}
+        self._spans = {}
+        self._index = {}
+        self._lock = threading.RLock()
+        self.extracted = 0
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            index_path = self.directory / 'index.json'
+            if index_path.exists():
+                with open(index_path) as f:
+                    self._index = json.load(f)
+
+    def _text_path(self, sha):
+        return self.directory / sha[:2] / f'{sha}.txt.gz'
+
+    def _stat(self, path):
+        stat = os.stat(path)
+        return [str(path), stat.st_size, stat.st_mtime_ns]
+
+    def _lookup(self, corpus_id, path):
+        '''Returns (hash, text or None) of path, using the index and the disk cache when they are valid.'''
+        entry = self._index.get(corpus_id)
+        stat = self._stat(path)
+        sha = entry[3] if entry is not None and entry[:3] == stat else file_hash(path)
+        self._index[corpus_id] = stat + [sha]
+        if self.directory is not None and self._text_path(sha).exists():
+            with gzip.open(self._text_path(sha), 'rt', encoding='utf-8') as f:
+                return sha, f.read()
+        return sha, None
+
+    def _add(self, corpus_id, sha, text, save):
+        if save and self.directory is not None:
+            text_path = self._text_path(sha)
+            text_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = text_path.with_name(f'{text_path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, text_path)
+        self._texts[corpus_id] = text
+        if self._hashes.get(corpus_id) != sha:
+            # the file changed, chunk boundaries of the old text are stale
+            self._spans = {key: spans for key, spans in self._spans.items() if key[0] != corpus_id}
+        self._hashes[corpus_id] = sha
+
+    def save_index(self):
+        if self.directory is None:
+            return
+        with self._lock:
+            tmp_path = self.directory / f'index.json.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._index, f)
+            os.replace(tmp_path, self.directory / 'index.json')
+
+    def populate(self, pdf_paths, workers=0):
+        '''
+        Loads or extracts the text of every PDF, the corpus ID being the file name without suffix
+        :param pdf_paths: iterable of PDF paths, or a dict of corpus ID to path
+        :param workers: number of processes extracting PDFs, 0 extracts in this process
+        :return: number of PDFs that had to be extracted
+        '''
+        items = pdf_paths.items() if isinstance(pdf_paths, dict) else ((Path(p).stem, p) for p in pdf_paths)
+        missing = {}
+        with self._lock:
+            for corpus_id, path in items:
+                corpus_id = str(corpus_id)
+                sha, text = self._lookup(corpus_id, path)
+                if text is not None:
+                    self._add(corpus_id, sha, text, save=False)
+                    metrics.count('cache_hits', cache='text_store')
+                else:
+                    missing[corpus_id] = (sha, path)
+
+        def added(corpus_id, text):
+            with self._lock:
+                self._add(corpus_id, missing[corpus_id][0], text, save=True)
+                self.extracted += 1
+            metrics.count('documents', stage='text_extraction')
+
+        metrics.count('cache_misses', len(missing), cache='text_store')
+
+        if workers and len(missing) > 1:
+            # spawned, not forked: the notebooks call this from a process running Evaluate and scheduler threads
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                futures = {executor.submit(extract_text, path): corpus_id for corpus_id, (_, path) in missing.items()}
+                for future in concurrent.futures.as_completed(futures):
+                    try:
+                        added(futures[future], future.result())
+                    except Exception as e:
+                        print(f'Failed to extract {missing[futures[future]][1]}: {e}')
+        else:
+            for corpus_id, (_, path) in missing.items():
+                try:
+                    with metrics.span('text_extraction', corpus_id=corpus_id):
+                        text = extract_text(path)
+                    added(corpus_id, text)
+                except Exception as e:
+                    print(f'Failed to extract {path}: {e}')
+        self.save_index()
+        return len(missing)
+
+    def get(self, corpus_id, path=None):
+        '''
+        Returns the extracted text of a paper, without any I/O once it is populated
+        :param path: PDF to extract from if the paper is not in the store yet
+        '''
+        corpus_id = str(corpus_id)
+        text = self._texts.get(corpus_id)
+        if text is not None:
+            return text
+        if path is None:
+            raise KeyError(f'{corpus_id} is not in the text store and no path was given')
+        with self._lock:
+            if corpus_id not in self._texts:
+                sha, text = self._lookup(corpus_id, path)
+                if text is not None:
+                    self._add(corpus_id, sha, text, save=False)
+                    metrics.count('cache_hits', cache='text_store')
+                else:
+                    metrics.count('cache_misses', cache='text_store')
+                    with metrics.span('text_extraction', corpus_id=corpus_id):
+                        self._add(corpus_id, sha, extract_text(path), save=True)
+                    self.extracted += 1
+                    metrics.count('documents', stage='text_extraction')
+                self.save_index()
+            return self._texts[corpus_id]
+
+    def spans(self, corpus_id, chunker, path=None):
+        '''Returns the memoized (start, end) chunk offsets of a paper under a Chunker configuration.'''
+        key = (str(corpus_id), chunker.context_window, chunker.max_windows, chunker.window_overlap)
+        spans = self._spans.get(key)
+        if spans is None:
+            text = self.get(corpus_id, path)
+            spans = [(start, end) for _, start, end in chunker.spans(text)]
+            with self._lock:
+                self._spans[key] = spans
+        return spans
+
+    def chunks(self, corpus_id, chunker, path=None):
+        '''Returns the chunks of a paper, the same list as [snippet for _, snippet in chunker(text)].'''
+        text = self.get(corpus_id, path)
+        return [text[start:end] for start, end in self.spans(corpus_id, chunker, path)]
+
+    def __contains__(self, corpus_id):
+        return str(corpus_id) in self._texts
+
+    def __len__(self):
+        return len(self._texts)
+
+    def __deepcopy__(self, memo):
+        # DSPy optimizers deep-copy programs, every copy shares the one in-memory store
+        return self
@@ -0,0 +1,200 @@
+'''
+Columnar storage for the query/candidate vector DBs.
+
+A vector DB `<path>` is two files written side by side:
+    <path>.arrow  Arrow IPC file with the metadata columns (file_id, text, section, ...)
+    <path>.f32    contiguous row-major float32 matrix, one embedding per metadata row
+
+The embedding dimension is kept in the Arrow schema metadata. Rows are written in record batches as
+they are produced, so building a DB never holds the whole corpus in memory, and both files are
+written under temporary names and renamed on close, so a crashed run never leaves a half-written DB.
+Reads memory-map both files: only the projected columns are converted to pandas and the vectors are
+an `np.memmap`, so opening a 100k-chunk DB costs milliseconds and pages in only what is touched.
+
+Usage:
+    with VectorDBWriter('candidate_vector_db') as writer:
+        writer.write([{'file_id': 'x', 'text': '...'}], [embedding])
+    df, vectors = read_vector_db('candidate_vector_db', columns=['file_id'])
+'''
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+def vector_db_paths(path):
+    '''Returns the metadata and vector file paths of the vector DB at path, with or without suffix.'''
+    path = Path(path)
+    if path.suffix in ('.arrow', '.f32'):
+        path = path.with_suffix('')
+    return path.with_name(f'{path.name}.arrow'), path.with_name(f'{path.name}.f32')
+
+
+def vector_db_exists(path):
+    return all(p.exists() for p in vector_db_paths(path))
+
+
+class VectorDBWriter:
+    '''
+    Streams metadata rows and their embeddings into a columnar vector DB
+    :param path: path of the vector DB, without suffix
+    :param batch_rows: number of rows buffered before a record batch is written
+    :param schema: pyarrow schema of the metadata columns, inferred from the rows if None: a column that is
+        all None so far, or an integer column later holding floats, is promoted when a batch needs it
+    '''
+
+    def __init__(self, path, batch_rows=1000, schema=None):
+        self.arrow_path, self.vectors_path = vector_db_paths(path)
+        self.arrow_path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_rows = batch_rows
+        self._tmp_arrow = self.arrow_path.with_name(f'{self.arrow_path.name}.{os.getpid()}.tmp')
+        self._tmp_vectors = self.vectors_path.with_name(f'{self.vectors_path.name}.{os.getpid()}.tmp')
+        self._vectors = open(self._tmp_vectors, 'wb')
+        self._writer = None
+        self._schema = schema
+        self._infer_schema = schema is None
+        self._promotions = 0
+        self._rows = []
+        self._embeddings = []
+        self.dim = None
+        self.n_rows = 0
+
+    def write(self, rows, embeddings):
+        '''
+        Buffers rows and their embeddings, writing a record batch every batch_rows rows
+        :param rows: list of dicts holding the metadata columns, the same keys for every row
+        :param embeddings: one vector per row
+        '''
+        if len(rows) != len(embeddings):
+            raise ValueError(f'Number of embeddings does not match number of rows {len(embeddings)} != {len(rows)}')
+        self._rows.extend(rows)
+        self._embeddings.extend(embeddings)
+        if len(self._rows) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._rows:
+            return
+        embeddings = np.asarray(self._embeddings, dtype=np.float32)
+        if self.dim is None and embeddings.ndim == 2:
+            self.dim = int(embeddings.shape[1])
+        if embeddings.ndim != 2 or embeddings.shape[1] != self.dim:
+            raise ValueError(f'Expected embeddings of dimension {self.dim}, got shape {embeddings.shape}')
+        if self._infer_schema:
+            batch_schema = pa.Table.from_pylist(self._rows).schema
+            if self._schema is None:
+                self._schema = batch_schema
+            else:
+                # e.g. a column that was all None in the batches so far gets its real type
+                schema = pa.unify_schemas([self._schema.remove_metadata(), batch_schema], promote_options='permissive')
+                if not schema.equals(self._schema.remove_metadata()):
+                    self._promote(schema)
+        if self._writer is None:
+            self._schema = self._schema.with_metadata({'dim': str(self.dim)})
+            self._writer = pa.ipc.new_file(str(self._tmp_arrow), self._schema)
+        table = pa.Table.from_pylist(self._rows, schema=self._schema)
+        self._writer.write_table(table)
+        self._vectors.write(embeddings.tobytes())
+        self.n_rows += len(self._rows)
+        self._rows = []
+        self._embeddings = []
+
+    def _promote(self, schema):
+        '''
+        Copies the record batches written so far, one at a time, to a new file with a wider schema and
+        keeps writing there, IPC files cannot change their schema or be reopened for appending
+        '''
+        schema = schema.with_metadata({'dim': str(self.dim)})
+        if self._writer is not None:
+            self._writer.close()
+            self._promotions += 1
+            promoted_path = self.arrow_path.with_name(f'{self.arrow_path.name}.{os.getpid()}.{self._promotions}.tmp')
+            reader = pa.ipc.open_file(pa.memory_map(str(self._tmp_arrow), 'r'))
+            self._writer = pa.ipc.new_file(str(promoted_path), schema)
+            for i in range(reader.num_record_batches):
+                self._writer.write_table(pa.Table.from_batches([reader.get_batch(i)]).cast(schema))
+            del reader
+            self._tmp_arrow.unlink()
+            self._tmp_arrow = promoted_path
+        self._schema = schema
+
+    def close(self):
+        '''Writes the remaining rows and moves the finished DB into place.'''
+        self.flush()
+        self._vectors.close()
+        if self._writer is None:
+            # an empty DB still has a readable metadata file
+            self._schema = pa.schema([]).with_metadata({'dim': '0'})
+            self._writer = pa.ipc.new_file(str(self._tmp_arrow), self._schema)
+        self._writer.close()
+        os.replace(self._tmp_vectors, self.vectors_path)
+        os.replace(self._tmp_arrow, self.arrow_path)
+
+    def abort(self):
+        '''Discards everything written so far, leaving any previous DB at path untouched.'''
+        self._vectors.close()
+        if self._writer is not None:
+            self._writer.close()
+        for path in (self._tmp_vectors, self._tmp_arrow):
+            if path.exists():
+                path.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def write_vector_db(path, df, embeddings, batch_rows=10000):
+    '''
+    Writes a DataFrame of metadata columns and its embeddings as a vector DB
+    :param embeddings: (len(df), dim) array, or a list of vectors
+    '''
+    with VectorDBWriter(path, batch_rows=batch_rows) as writer:
+        rows = df.to_dict('records')
+        for start in range(0, len(rows), batch_rows):
+            writer.write(rows[start:start + batch_rows], embeddings[start:start + batch_rows])
+
+
+def read_vector_db(path, columns=None, vectors=True):
+    '''
+    Memory-maps a vector DB
+    :param path: path of the vector DB, with or without suffix
+    :param columns: metadata columns to load, all of them if None
+    :param vectors: whether to map the embedding matrix
+    :return: DataFrame of the projected columns and a read-only (n_rows, dim) float32 memmap, or None
+    '''
+    arrow_path, vectors_path = vector_db_paths(path)
+    # record batches are read zero-copy from the map, only projected columns are materialized
+    table = pa.ipc.open_file(pa.memory_map(str(arrow_path), 'r')).read_all()
+    dim = int(table.schema.metadata[b'dim'])
+    n_rows = table.num_rows
+    if columns is not None:
+        table = table.select(columns)
+    df = table.to_pandas()
+    if not vectors:
+        return df, None
+    if vectors_path.stat().st_size != 4 * n_rows * dim:
+        raise ValueError(f'{vectors_path} does not hold {n_rows} vectors of dimension {dim}')
+    if n_rows == 0:
+        return df, np.zeros((0, dim), dtype=np.float32)
+    return df, np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(n_rows, dim))
+
+
+def csv_to_vector_db(csv_path, path, embedding_column='vector_embedding', chunksize=10000):
+    '''
+    Converts a legacy *_vector_db.csv, with embeddings stored as comma-joined strings or list
+    literals, into a vector DB without loading the whole CSV at once
+    '''
+    with VectorDBWriter(path, batch_rows=chunksize) as writer:
+        for chunk in pd.read_csv(csv_path, chunksize=chunksize):
+            embeddings = [json.loads(e) if e.startswith('[') else [float(x) for x in e.split(',')]
+                          for e in chunk.pop(embedding_column).astype(str)]
+            writer.write(chunk.to_dict('records'), embeddings)